@@ -0,0 +1,484 @@
+"""Load test the annotator server with concurrent simulated annotators.
+
+Every concurrency level starts a fresh server (``run.py`` or ``wsgi.py``) on a
+scratch copy of the data, then runs that many annotator sessions against it
+for a fixed time. A session loads an image (metadata and image file), fetches
+the image status, saves a few annotations, sometimes edits or deletes one of
+them, and moves on to the next image.
+
+Per level, throughput, per-endpoint p50/p99 latency and error rates are
+reported. After the server has been stopped, the final output file (plus any
+annotator shards) is checked against every save and delete the server
+acknowledged. The check reports lost updates (acknowledged saves missing from
+the file), stale ones (an older version of the annotation was kept) and
+resurrected ones (acknowledged deletes still in the file).
+
+Example:
+    python benchmarks/load_test.py --annotators 1 4 16 32 --duration 60
+    python benchmarks/load_test.py --annotators 8 --server wsgi --think-time 2
+    python benchmarks/load_test.py --url http://localhost:5555 --annotators 4   # running server, no file check
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+# Add parent directory to path to import from refcocos_annotator
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.run_benchmarks import RESULTS_DIR, _git_commit, percentile
+from benchmarks.synthetic_data import CAPTION_WORDS, TYPES, generate_dataset
+from refcocos_annotator.services import shard_service
+from refcocos_annotator.services.image_service import calculate_normalized_solution, convert_bbox_format
+from refcocos_annotator.utils.file_utils import iter_json_array
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_SCRIPTS = {"run": "run.py", "wsgi": "wsgi.py"}
+DEFAULT_LEVELS = [1, 4, 16]
+REQUEST_TIMEOUT = 60
+STARTUP_TIMEOUT = 300
+
+
+class EndpointStats:
+    """Latencies and errors of the requests made to each endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.error_examples: List[str] = []
+
+    def record(self, endpoint: str, latency: float, error: Optional[str]) -> None:
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            if error is not None:
+                self.errors[endpoint] += 1
+                if len(self.error_examples) < 10:
+                    self.error_examples.append(f"{endpoint}: {error}")
+
+    def summary(self, elapsed: float) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            result[endpoint] = {
+                "requests": len(latencies),
+                "errors": self.errors[endpoint],
+                "error_rate": self.errors[endpoint] / len(latencies),
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+            }
+        return result
+
+
+class AnnotationIds:
+    """Annotation IDs in the UI's ``<image_id>_<ms>`` format, unique across sessions.
+
+    The UI derives IDs from the current time; simulated annotators save far
+    faster than people, so the millisecond part is bumped to stay unique
+    rather than letting the harness manufacture collisions.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last = 0
+
+    def next(self, image_id: Any) -> str:
+        with self.lock:
+            self.last = max(self.last + 1, int(time.time() * 1000))
+            return f"{image_id}_{self.last}"
+
+
+class Session:
+    """One simulated annotator."""
+
+    def __init__(self, number: int, base_url: str, stats: EndpointStats, ids: AnnotationIds,
+                 args: argparse.Namespace, deadline: float):
+        self.annotator = f"load{number:03d}"
+        self.base_url = base_url
+        self.stats = stats
+        self.ids = ids
+        self.args = args
+        self.deadline = deadline
+        self.rng = random.Random(args.seed * 1000 + number)
+        # Final acknowledged state per annotation ID: the record, or None once deleted
+        self.acknowledged: Dict[str, Optional[Dict[str, Any]]] = {}
+        # Stored version of each annotation, sent as If-Match when changing it
+        self.versions: Dict[str, int] = {}
+        self.saves = 0
+        self.deletes = 0
+
+    def request(self, method: str, endpoint: str, path: str, body: Optional[Dict[str, Any]] = None,
+                version: Optional[int] = None) -> Tuple[int, Any]:
+        """Make a request and record its latency under ``endpoint``.
+
+        With ``version`` the request only applies to that annotation version
+        (If-Match); sessions only change their own annotations, so a 409
+        counts as an error.
+        """
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        headers = {"Content-Type": "application/json", "Accept": "image/webp,*/*", "X-Annotator": self.annotator}
+        if version is not None:
+            headers["If-Match"] = f'"{version}"'
+        req = urllib.request.Request(self.base_url + path, data=data, method=method, headers=headers)
+        status, payload, error = 0, None, None
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+                status = response.status
+                content = response.read()
+                if response.headers.get_content_type() == "application/json":
+                    payload = json.loads(content)
+        except urllib.error.HTTPError as e:
+            status, error = e.code, f"HTTP {e.code}"
+            e.read()
+        except (OSError, ValueError) as e:
+            error = f"{type(e).__name__}: {e}"
+        if error is None and isinstance(payload, dict) and payload.get("success") is False:
+            error = payload.get("message", "success: false")
+        self.stats.record(endpoint, time.perf_counter() - started, error)
+        return (status if error is None else 0), payload
+
+    def think(self) -> None:
+        if self.args.think_time > 0:
+            time.sleep(self.args.think_time * self.rng.uniform(0.5, 1.5))
+
+    def annotation_for(self, image: Dict[str, Any], annotation_id: str) -> Dict[str, Any]:
+        """Annotation on a random instance of an image, built like the UI builds it."""
+        category = self.rng.choice(image["categories_with_multiple_instances"])
+        bbox = convert_bbox_format(self.rng.choice(category["instances"]))
+        caption = " ".join(self.rng.choice(CAPTION_WORDS) for _ in range(self.rng.randint(3, 8)))
+        # The marker makes every saved version distinguishable in the final file
+        caption = f"{caption} [{self.annotator} {self.saves}]"
+        return {
+            "annotation_id": annotation_id,
+            "dataset": "refcocos_test",
+            "text_type": "caption",
+            "height": image["height"],
+            "width": image["width"],
+            "normal_caption": caption,
+            "image": "val2017/" + image["file_name"],
+            "file_name": image["file_name"],
+            "problem": f"Please provide the bounding box coordinate of the region this sentence describes: {caption}.",
+            "solution": bbox,
+            "normalized_solution": calculate_normalized_solution(bbox, image["width"], image["height"]),
+            "categories": {
+                "empty_case": False,
+                "hops": str(self.rng.randint(2, 5)),
+                "type": self.rng.sample(TYPES, self.rng.randint(1, 2)),
+                "occluded": self.rng.random() < 0.2,
+                "distractors": str(category["count"] - 1),
+            },
+            "image_index": image["index"],
+        }
+
+    def save(self, image: Dict[str, Any], annotation: Dict[str, Any]) -> None:
+        annotation_id = annotation["annotation_id"]
+        status, response = self.request("POST", "POST /api/save_reference", "/api/save_reference",
+                                        {"image_id": image["image_id"], "annotation": annotation},
+                                        self.versions.get(annotation_id))
+        self.saves += 1
+        if status == 200:
+            self.acknowledged[annotation_id] = annotation
+            self.versions[annotation_id] = response["version"]
+
+    def run(self, num_images: int) -> None:
+        index = self.rng.randrange(num_images)
+        while time.time() < self.deadline:
+            # Load the image as the UI does: metadata, then the image file
+            status, image = self.request("GET", "GET /api/image/<index>", f"/api/image/{index}?embed=0")
+            if status != 200:
+                index = (index + 1) % num_images
+                continue
+            if self.args.fetch_images:
+                self.request("GET", "GET /api/image_file/<index>", f"/api/image_file/{index}")
+            self.request("GET", "GET /api/image_status", "/api/image_status")
+            self.think()
+
+            saved_here = []
+            if image.get("categories_with_multiple_instances"):
+                for _ in range(self.rng.randint(1, 2 * self.args.saves_per_image - 1)):
+                    if time.time() >= self.deadline:
+                        break
+                    if saved_here and self.rng.random() < self.args.edit_rate:
+                        # Edit one of this image's annotations
+                        annotation_id = self.rng.choice(saved_here)
+                    else:
+                        annotation_id = self.ids.next(image["image_id"])
+                        saved_here.append(annotation_id)
+                    self.save(image, self.annotation_for(image, annotation_id))
+                    self.think()
+
+            if saved_here and self.rng.random() < self.args.delete_rate:
+                annotation_id = saved_here.pop(self.rng.randrange(len(saved_here)))
+                status, _ = self.request("POST", "POST /api/delete_annotation", "/api/delete_annotation",
+                                         {"image_id": image["image_id"], "annotation_id": annotation_id},
+                                         self.versions.pop(annotation_id, None))
+                self.deletes += 1
+                if status == 200:
+                    self.acknowledged[annotation_id] = None
+                self.think()
+
+            # Navigate to the next image
+            index = (index + 1) % num_images
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args: argparse.Namespace, level_dir: str, instances_file: str,
+                 output_file: str) -> Tuple[subprocess.Popen, str, Optional[str]]:
+    """Start a server on the given data files and wait until it answers.
+
+    Returns:
+        Tuple: The server process, its base URL and its annotator shard directory (if sharded)
+    """
+    port = _free_port()
+    shard_dir = os.path.join(level_dir, "shards") if args.shards else None
+    env = dict(os.environ, PORT=str(port), DEBUG="0", MULTIPLE_INSTANCES_FILE=instances_file,
+               OUTPUT_FILE=output_file, SNAPSHOT_DIR="", ANNOTATOR_SHARD_DIR=shard_dir or "")
+    log = open(os.path.join(level_dir, "server.log"), "wb")
+    # The server runs in the level directory so files it creates stay out of the checkout
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, SERVER_SCRIPTS[args.server])],
+                               cwd=level_dir, env=env, stdout=log, stderr=subprocess.STDOUT,
+                               start_new_session=True)
+    log.close()
+
+    base_url = f"http://127.0.0.1:{port}"
+    started = time.time()
+    while time.time() - started < STARTUP_TIMEOUT:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with status {process.returncode}, see {level_dir}/server.log")
+        try:
+            with urllib.request.urlopen(base_url + "/api/tasks", timeout=5):
+                return process, base_url, shard_dir
+        except OSError:
+            time.sleep(0.2)
+    stop_server(process)
+    raise RuntimeError(f"Server did not start within {STARTUP_TIMEOUT}s, see {level_dir}/server.log")
+
+
+def stop_server(process: subprocess.Popen) -> None:
+    """Stop a server and everything it spawned."""
+    if process.poll() is None:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+
+
+def check_final_state(output_file: str, shard_dir: Optional[str],
+                      sessions: List[Session]) -> Dict[str, Any]:
+    """Compare the annotations on disk with the acknowledged saves and deletes."""
+    records = iter_json_array(output_file, key="annotations")
+    if shard_dir and os.path.isdir(shard_dir):
+        ops, _ = shard_service.read_all_operations(shard_service.list_shards(shard_dir))
+        records = shard_service.stream_with_operations(records, ops)
+    final = {}
+    for record in records:
+        final[record.get("annotation_id")] = record
+
+    result = {"checked": 0, "lost": [], "stale": [], "resurrected": []}
+    for session in sessions:
+        for annotation_id, expected in session.acknowledged.items():
+            result["checked"] += 1
+            actual = final.get(annotation_id)
+            if expected is None:
+                if actual is not None:
+                    result["resurrected"].append(annotation_id)
+            elif actual is None:
+                result["lost"].append(annotation_id)
+            elif actual.get("normal_caption") != expected["normal_caption"]:
+                result["stale"].append(annotation_id)
+    return result
+
+
+def prepare_data(args: argparse.Namespace, level_dir: str) -> Tuple[str, str]:
+    """Scratch copy of the data files (or a generated dataset) for one level."""
+    if args.instances_file:
+        instances_file = os.path.join(level_dir, "multiple_instances.json")
+        output_file = os.path.join(level_dir, "output.json")
+        shutil.copyfile(args.instances_file, instances_file)
+        if args.output_file:
+            shutil.copyfile(args.output_file, output_file)
+        return instances_file, output_file
+
+    info = generate_dataset(level_dir, args.images, annotations_per_image=args.annotations_per_image,
+                            seed=args.seed)
+    return info["instances_file"], info["output_file"]
+
+
+def run_level(annotators: int, work_dir: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Run ``annotators`` concurrent sessions and collect their results."""
+    process, output_file, shard_dir = None, None, None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        level_dir = os.path.abspath(os.path.join(work_dir, f"level_{annotators}"))
+        os.makedirs(level_dir, exist_ok=True)
+        instances_file, output_file = prepare_data(args, level_dir)
+        process, base_url, shard_dir = start_server(args, level_dir, instances_file, output_file)
+
+    try:
+        with urllib.request.urlopen(base_url + "/api/image/0?embed=0", timeout=REQUEST_TIMEOUT) as response:
+            num_images = json.loads(response.read())["total_images"]
+
+        stats = EndpointStats()
+        ids = AnnotationIds()
+        deadline = time.time() + args.duration
+        sessions = [Session(n, base_url, stats, ids, args, deadline) for n in range(annotators)]
+        threads = [threading.Thread(target=session.run, args=(num_images,), daemon=True) for session in sessions]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        if process is not None:
+            stop_server(process)
+
+    endpoints = stats.summary(elapsed)
+    requests = sum(e["requests"] for e in endpoints.values())
+    errors = sum(e["errors"] for e in endpoints.values())
+    result = {
+        "annotators": annotators,
+        "duration_s": elapsed,
+        "requests": requests,
+        "throughput_rps": requests / elapsed if elapsed else 0.0,
+        "saves_per_s": sum(s.saves for s in sessions) / elapsed if elapsed else 0.0,
+        "error_rate": errors / requests if requests else 0.0,
+        "error_examples": stats.error_examples,
+        "endpoints": endpoints,
+    }
+    if output_file is not None:
+        result["final_state"] = check_final_state(output_file, shard_dir, sessions)
+    return result
+
+
+def print_level(result: Dict[str, Any]) -> None:
+    print(f"\n{result['annotators']} annotators: {result['requests']} requests in {result['duration_s']:.1f}s, "
+          f"{result['throughput_rps']:.1f} req/s, {result['saves_per_s']:.1f} saves/s, "
+          f"error rate {result['error_rate']:.2%}")
+    for endpoint, stats in result["endpoints"].items():
+        print(f"  {endpoint:<32} n={stats['requests']:<6} p50={stats['p50_ms']:9.2f}ms "
+              f"p99={stats['p99_ms']:9.2f}ms errors={stats['errors']}")
+    for example in result["error_examples"]:
+        print(f"  error: {example}")
+    final = result.get("final_state")
+    if final is not None:
+        print(f"  final file: {final['checked']} acknowledged annotations checked, {len(final['lost'])} lost, "
+              f"{len(final['stale'])} stale, {len(final['resurrected'])} resurrected")
+        for kind in ("lost", "stale", "resurrected"):
+            if final[kind]:
+                print(f"    {kind}: {', '.join(final[kind][:5])}{' ...' if len(final[kind]) > 5 else ''}")
+
+
+def within_limits(result: Dict[str, Any], args: argparse.Namespace) -> bool:
+    """Whether a level met the latency, error and durability targets."""
+    final = result.get("final_state") or {}
+    if any(final.get(kind) for kind in ("lost", "stale", "resurrected")):
+        return False
+    if result["error_rate"] > args.max_error_rate:
+        return False
+    return all(stats["p99_ms"] <= args.max_p99_ms for stats in result["endpoints"].values())
+
+
+def parse_args():
+    """Parse command-line arguments"""
+    parser = argparse.ArgumentParser(description='Load test the annotator server with concurrent annotators')
+    parser.add_argument('--annotators', type=int, nargs='+', default=DEFAULT_LEVELS,
+                        help='Concurrency levels to run, one after another (default: 1 4 16)')
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='Seconds to run each level (default: 30)')
+    parser.add_argument('--think-time', type=float, default=0.2,
+                        help='Average pause between an annotator\'s actions in seconds (default: 0.2)')
+    parser.add_argument('--saves-per-image', type=int, default=3,
+                        help='Average saves per visited image (default: 3)')
+    parser.add_argument('--edit-rate', type=float, default=0.2,
+                        help='Share of saves that edit an annotation saved before (default: 0.2)')
+    parser.add_argument('--delete-rate', type=float, default=0.1,
+                        help='Probability of deleting an annotation before leaving an image (default: 0.1)')
+    parser.add_argument('--no-image-files', dest='fetch_images', action='store_false',
+                        help='Do not fetch the image files, only their metadata')
+    parser.add_argument('--server', choices=sorted(SERVER_SCRIPTS), default='run',
+                        help='Entry point to start for each level (default: run)')
+    parser.add_argument('--shards', action='store_true',
+                        help='Run the server with per-annotator output shards')
+    parser.add_argument('--url', type=str, default=None,
+                        help='Test an already running server instead (its data is modified; no final file check)')
+    parser.add_argument('--images', type=int, default=1000,
+                        help='Images in the generated dataset (default: 1000)')
+    parser.add_argument('--annotations-per-image', type=float, default=2.0,
+                        help='Saved annotations per image in the generated dataset (default: 2.0)')
+    parser.add_argument('--instances-file', type=str, default=None,
+                        help='Use a copy of this multiple instances file instead of a generated dataset')
+    parser.add_argument('--output-file', type=str, default=None,
+                        help='Start from a copy of this output file (with --instances-file)')
+    parser.add_argument('--max-p99-ms', type=float, default=1000.0,
+                        help='p99 latency every endpoint must stay under (default: 1000)')
+    parser.add_argument('--max-error-rate', type=float, default=0.001,
+                        help='Highest acceptable error rate (default: 0.001)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    parser.add_argument('--work-dir', type=str, default=None,
+                        help='Directory for datasets and server logs (default: a temporary directory)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Results file (default: benchmarks/results/load_<commit>.json)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    commit = _git_commit()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for annotators in args.annotators:
+            result = run_level(annotators, args.work_dir or tmp_dir, args)
+            result["within_limits"] = within_limits(result, args)
+            print_level(result)
+            results.append(result)
+
+    supported = [r["annotators"] for r in results if r["within_limits"]]
+    print(f"\nTargets: p99 <= {args.max_p99_ms:.0f}ms, error rate <= {args.max_error_rate:.2%}, no lost updates")
+    for result in results:
+        print(f"  {result['annotators']:>4} annotators: {'ok' if result['within_limits'] else 'FAILED'}")
+    if supported:
+        print(f"Highest level within targets: {max(supported)} annotators")
+    else:
+        print("No level met the targets")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"load_{commit or 'results'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "commit": commit,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": {k: v for k, v in vars(args).items() if k not in ("output", "work_dir")},
+            "results": results,
+        }, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
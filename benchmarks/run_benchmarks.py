@@ -0,0 +1,231 @@
+"""Benchmark data_service and the Flask API at synthetic scale.
+
+For every scale a synthetic dataset is generated, loaded through
+``data_service.load_data`` and exercised both directly and through the Flask
+test client. Latency percentiles, throughput and peak Python memory are
+printed and written as JSON so runs on different commits can be compared.
+
+Example:
+    python benchmarks/run_benchmarks.py --scales 1000 10000
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/<old>.json
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+# Add parent directory to path to import from refcocos_annotator
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic_data import generate_dataset
+from refcocos_annotator import config
+from refcocos_annotator.services import data_service
+
+DEFAULT_SCALES = [1000, 10000, 100000]
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def measure(func: Callable[[int], Any], iterations: int, budget: float) -> Dict[str, Any]:
+    """Time ``func`` repeatedly, then measure its peak memory on one extra call.
+
+    Args:
+        func: Function called with the iteration number
+        iterations: Maximum number of timed calls
+        budget: Stop early once this many seconds have been spent (at least one call is made)
+
+    Returns:
+        Dict: Latency percentiles (ms), throughput (ops/s) and peak memory (bytes)
+    """
+    latencies = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - t0)
+        if time.perf_counter() - started > budget:
+            break
+    elapsed = time.perf_counter() - started
+
+    # Memory is traced separately so tracemalloc overhead does not skew the timings
+    tracemalloc.start()
+    func(len(latencies))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "iterations": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "throughput_ops": len(latencies) / elapsed if elapsed else 0.0,
+        "peak_memory_bytes": peak,
+    }
+
+
+def _use_dataset(info: Dict[str, Any], snapshot_dir: Optional[str] = None) -> None:
+    """Point data_service at a generated dataset and load it from scratch."""
+    config.SNAPSHOT_DIR = snapshot_dir
+    data_service.MULTIPLE_INSTANCES_FILE = info["instances_file"]
+    data_service.OUTPUT_FILE = info["output_file"]
+    success, message = data_service.load_data(force=True)
+    if not success:
+        raise RuntimeError(message)
+
+
+def run_scale(scale: int, work_dir: str, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Run every benchmark against a dataset with ``scale`` annotations."""
+    from refcocos_annotator.app import create_app
+
+    num_images = max(1, int(scale / args.annotations_per_image))
+    dataset_dir = os.path.join(work_dir, f"scale_{scale}")
+    info = generate_dataset(dataset_dir, num_images, args.instances_per_image,
+                            args.annotations_per_image, seed=args.seed)
+    print(f"\nScale {scale}: {info['num_images']} images, {info['num_annotations']} annotations")
+
+    results = []
+
+    def record(name: str, func: Callable[[int], Any], iterations: int) -> None:
+        stats = measure(func, iterations, args.budget)
+        stats.update({"scale": scale, "benchmark": name,
+                      "num_images": info["num_images"], "num_annotations": info["num_annotations"]})
+        results.append(stats)
+        print(f"  {name:<40} n={stats['iterations']:<5} p50={stats['p50_ms']:9.2f}ms "
+              f"p95={stats['p95_ms']:9.2f}ms p99={stats['p99_ms']:9.2f}ms "
+              f"{stats['throughput_ops']:9.1f} ops/s peak={stats['peak_memory_bytes'] / 1e6:8.1f}MB")
+
+    record("load_data", lambda i: _use_dataset(info), args.load_iterations)
+    snapshot_dir = os.path.join(dataset_dir, "snapshots")
+    _use_dataset(info, snapshot_dir)
+    record("load_data (snapshot)", lambda i: _use_dataset(info, snapshot_dir), args.load_iterations)
+
+    record("data_service.get_saved_data", lambda i: data_service.get_saved_data(), args.iterations)
+    record("data_service.get_image_status", lambda i: data_service.get_image_status(), args.iterations)
+
+    template = copy.deepcopy(data_service.output_data[0]) if data_service.output_data else None
+
+    def save(i: int) -> None:
+        annotation = copy.deepcopy(template)
+        annotation["annotation_id"] = f"bench_{i}"
+        success, message = data_service.save_reference_annotation(annotation["file_name"].split(".")[0], annotation)
+        if not success:
+            raise RuntimeError(message)
+
+    if template is not None:
+        record("data_service.save_reference_annotation", save, args.write_iterations)
+        # Restore the generated file for the API benchmarks
+        _use_dataset(generate_dataset(dataset_dir, num_images, args.instances_per_image,
+                                      args.annotations_per_image, seed=args.seed))
+
+    client = create_app().test_client()
+
+    def api_get(url_for: Callable[[int], str]) -> Callable[[int], Any]:
+        def call(i: int) -> None:
+            response = client.get(url_for(i))
+            if response.status_code != 200:
+                raise RuntimeError(f"{url_for(i)} returned {response.status_code}")
+        return call
+
+    record("GET /api/image/<index>", api_get(lambda i: f"/api/image/{i % info['num_images']}"), args.iterations)
+    record("GET /api/image_status", api_get(lambda i: "/api/image_status"), args.iterations)
+    record("GET /api/saved_data", api_get(lambda i: "/api/saved_data"), args.iterations)
+
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    """Current git commit, if the benchmarks run inside a checkout."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: List[Dict[str, Any]], baseline_path: str) -> None:
+    """Print the p50 latency change relative to an earlier results file."""
+    with open(baseline_path, "r") as f:
+        baseline = {(r["scale"], r["benchmark"]): r for r in json.load(f)["results"]}
+
+    print(f"\nComparison with {baseline_path}:")
+    for result in current:
+        old = baseline.get((result["scale"], result["benchmark"]))
+        if old is None or not old["p50_ms"]:
+            continue
+        change = (result["p50_ms"] - old["p50_ms"]) / old["p50_ms"] * 100
+        print(f"  {result['scale']:>7} {result['benchmark']:<40} p50 {old['p50_ms']:9.2f}ms -> "
+              f"{result['p50_ms']:9.2f}ms ({change:+.1f}%)")
+
+
+def parse_args():
+    """Parse command-line arguments"""
+    parser = argparse.ArgumentParser(description='Benchmark data_service and the Flask API at synthetic scale')
+    parser.add_argument('--scales', type=int, nargs='+', default=DEFAULT_SCALES,
+                        help='Numbers of annotations to benchmark (default: 1000 10000 100000)')
+    parser.add_argument('--annotations-per-image', type=float, default=2.0,
+                        help='Average saved annotations per image (default: 2.0)')
+    parser.add_argument('--instances-per-image', type=int, default=6,
+                        help='COCO instances per image (default: 6)')
+    parser.add_argument('--iterations', type=int, default=50,
+                        help='Maximum timed calls for read benchmarks (default: 50)')
+    parser.add_argument('--write-iterations', type=int, default=20,
+                        help='Maximum timed calls for write benchmarks (default: 20)')
+    parser.add_argument('--load-iterations', type=int, default=3,
+                        help='Maximum timed calls of load_data (default: 3)')
+    parser.add_argument('--budget', type=float, default=30.0,
+                        help='Time budget per benchmark in seconds (default: 30)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    parser.add_argument('--work-dir', type=str, default=None,
+                        help='Directory for generated datasets (default: a temporary directory)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Results file (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Earlier results file to compare against')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    commit = _git_commit()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir or tmp_dir
+        results = []
+        for scale in args.scales:
+            results.extend(run_scale(scale, work_dir, args))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit or 'results'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "commit": commit,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results,
+        }, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
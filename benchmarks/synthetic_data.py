@@ -0,0 +1,157 @@
+"""Synthetic dataset generator for benchmarking the RefCOCOS Annotator.
+
+Produces a multiple instances file, an output file with saved annotations and
+a small pool of JPEG images that the image records point to, all shaped like
+the real data.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+from typing import Any, Dict, List
+
+# Add parent directory to path to import from refcocos_annotator
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from refcocos_annotator.services import migration_service
+from refcocos_annotator.services.image_service import calculate_normalized_solution, convert_bbox_format
+
+CATEGORY_NAMES = ["person", "car", "chair", "bottle", "cup", "book", "bird", "sheep", "umbrella", "donut"]
+CAPTION_WORDS = ["left", "right", "front", "behind", "red", "blue", "small", "large", "holding",
+                 "sitting", "standing", "next", "to", "the", "person", "table", "not", "near", "second"]
+TYPES = ["spatial", "attr", "exclude", "verb"]
+
+# Number of distinct JPEG files shared by all synthetic image records
+IMAGE_POOL_SIZE = 8
+
+
+def _write_image_pool(image_dir: str, width: int, height: int) -> List[str]:
+    """Write a few JPEG images that all synthetic records point to."""
+    from PIL import Image
+
+    os.makedirs(image_dir, exist_ok=True)
+    paths = []
+    for i in range(IMAGE_POOL_SIZE):
+        path = os.path.join(image_dir, f"pool_{i}.jpg")
+        if not os.path.exists(path):
+            color = (40 * i % 256, 90, 255 - 30 * i % 256)
+            Image.new("RGB", (width, height), color).save(path, format="JPEG", quality=90)
+        paths.append(path)
+    return paths
+
+
+def _random_bbox(rng: random.Random, width: int, height: int) -> List[float]:
+    """Random COCO-format bbox [x, y, w, h] inside the image."""
+    w = rng.uniform(10, width / 3)
+    h = rng.uniform(10, height / 3)
+    return [round(rng.uniform(0, width - w), 2), round(rng.uniform(0, height - h), 2), round(w, 2), round(h, 2)]
+
+
+def generate_dataset(out_dir: str, num_images: int, instances_per_image: int = 6,
+                     annotations_per_image: float = 2.0, width: int = 640, height: int = 480,
+                     seed: int = 0) -> Dict[str, Any]:
+    """Generate a synthetic dataset on disk.
+
+    Args:
+        out_dir: Directory to write the dataset to
+        num_images: Number of images in the multiple instances file
+        instances_per_image: Number of COCO instances per image
+        annotations_per_image: Average number of saved annotations per image
+        width: Image width
+        height: Image height
+        seed: Random seed
+
+    Returns:
+        Dict: Paths of the generated files and dataset sizes
+    """
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    image_pool = _write_image_pool(os.path.join(out_dir, "images"), width, height)
+
+    images = []
+    for i in range(num_images):
+        # Split the instances over a few categories with at least 3 instances each
+        category_ids = rng.sample(range(len(CATEGORY_NAMES)), max(1, min(instances_per_image // 3, 3)))
+        category_counts = {category_id: [] for category_id in category_ids}
+        for n in range(instances_per_image):
+            category_counts[category_ids[n % len(category_ids)]].append(_random_bbox(rng, width, height))
+
+        images.append({
+            "image_id": 100000 + i,
+            "file_name": f"{100000 + i:012d}.jpg",
+            "width": width,
+            "height": height,
+            "path": image_pool[i % len(image_pool)],
+            "categories_with_multiple_instances": [
+                {
+                    "category_id": category_id + 1,
+                    "category_name": CATEGORY_NAMES[category_id],
+                    "count": len(bboxes),
+                    "instances": bboxes,
+                }
+                for category_id, bboxes in category_counts.items()
+            ],
+        })
+
+    annotations = []
+    num_annotations = int(num_images * annotations_per_image)
+    for n in range(num_annotations):
+        index = rng.randrange(num_images) if num_images else 0
+        image = images[index]
+        category = rng.choice(image["categories_with_multiple_instances"])
+        bbox = convert_bbox_format(rng.choice(category["instances"]))
+        caption = " ".join(rng.choice(CAPTION_WORDS) for _ in range(rng.randint(3, 10)))
+
+        annotations.append({
+            "annotation_id": f"{image['image_id']}_{n}",
+            "dataset": "refcocos_test",
+            "text_type": "caption",
+            "height": height,
+            "width": width,
+            "normal_caption": caption,
+            "image": "val2017/" + image["file_name"],
+            "file_name": image["file_name"],
+            "problem": f"Please provide the bounding box coordinate of the region this sentence describes: {caption}.",
+            "solution": bbox,
+            "normalized_solution": calculate_normalized_solution(bbox, width, height),
+            "categories": {
+                "empty_case": False,
+                "hops": str(rng.randint(2, 5)),
+                "type": rng.sample(TYPES, rng.randint(1, 2)),
+                "occluded": rng.random() < 0.2,
+                "distractors": str(category["count"] - 1),
+            },
+            "image_index": index,
+        })
+
+    instances_file = os.path.join(out_dir, "multiple_instances.json")
+    with open(instances_file, "w") as f:
+        json.dump({"min_instances": 3, "total_images_found": num_images, "images": images}, f)
+
+    output_file = os.path.join(out_dir, "output.json")
+    with open(output_file, "w") as f:
+        json.dump(migration_service.wrap_output(annotations), f)
+
+    return {
+        "instances_file": instances_file,
+        "output_file": output_file,
+        "num_images": num_images,
+        "num_annotations": num_annotations,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate a synthetic RefCOCOS dataset')
+    parser.add_argument('--out-dir', type=str, required=True, help='Directory to write the dataset to')
+    parser.add_argument('--images', type=int, default=1000, help='Number of images (default: 1000)')
+    parser.add_argument('--instances-per-image', type=int, default=6,
+                        help='COCO instances per image (default: 6)')
+    parser.add_argument('--annotations-per-image', type=float, default=2.0,
+                        help='Average saved annotations per image (default: 2.0)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    args = parser.parse_args()
+
+    info = generate_dataset(args.out_dir, args.images, args.instances_per_image,
+                            args.annotations_per_image, seed=args.seed)
+    print(f"Wrote {info['num_images']} images and {info['num_annotations']} annotations to {args.out_dir}")
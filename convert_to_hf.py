@@ -20,6 +20,10 @@ def convert_refcocos_to_hf(json_path, output_dir=None, image_root=""):
     with open(json_path, 'r') as f:
         data = json.load(f)
 
+    # Versioned output files wrap the records in an object
+    if isinstance(data, dict):
+        data = data.get('annotations', [])
+
     # Initialize dictionaries to hold our features
     features = {
         'annotation_id': [],
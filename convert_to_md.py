@@ -1,59 +1,207 @@
-import json
+import argparse
+import hashlib
 import os
+from concurrent.futures import ProcessPoolExecutor
 
-def convert_json_to_md(json_file_path, output_md_path):
-    # Read the JSON file
-    with open(json_file_path, 'r') as f:
-        data = json.load(f)
+from refcocos_annotator.utils.file_utils import iter_json_array
 
+DEFAULT_PAGE_SIZE = 200
+DEFAULT_THUMB_SIZE = 320
+
+
+class _ImageLookup:
+    """Resolve image paths using one directory listing per directory instead of a stat per item."""
+
+    def __init__(self, image_root):
+        self.image_root = image_root
+        self._listings = {}
+        self._stats = {}
+
+    def exists(self, relative_path):
+        full_path = os.path.join(self.image_root, relative_path)
+        directory, name = os.path.split(full_path)
+        if directory not in self._listings:
+            try:
+                self._listings[directory] = {entry.name: entry for entry in os.scandir(directory or ".")}
+            except OSError:
+                self._listings[directory] = {}
+        entry = self._listings[directory].get(name)
+        if entry is not None and full_path not in self._stats:
+            self._stats[full_path] = entry.stat()
+        return entry is not None
+
+    def stat(self, relative_path):
+        return self._stats[os.path.join(self.image_root, relative_path)]
+
+
+def thumbnail_name(image_path, st, thumb_size):
+    """Cache file name for a thumbnail, keyed by the source file's path, size and mtime."""
+    key = f"{image_path}|{st.st_size}|{st.st_mtime_ns}|{thumb_size}"
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    return f"{stem}_{digest}.jpg"
+
+
+def make_thumbnail(src_path, dst_path, thumb_size):
+    """Write a JPEG thumbnail of src_path to dst_path (runs in a worker process)."""
+    from PIL import Image as PILImage
+
+    with PILImage.open(src_path) as img:
+        # Let the JPEG decoder downscale in the DCT domain before resizing
+        img.draft("RGB", (thumb_size, thumb_size))
+        img = img.convert("RGB")
+        img.thumbnail((thumb_size, thumb_size))
+        tmp_path = dst_path + ".tmp"
+        img.save(tmp_path, format="JPEG", quality=85)
+    os.replace(tmp_path, dst_path)
+    return dst_path
+
+
+def format_item(item, image_link):
+    """Render the markdown block for a single annotation."""
+    # Get caption (if it exists and is not empty)
+    caption = item.get("normal_caption", "")
+    caption_text = f"**Caption:** {caption}\n\n" if caption else "**Caption:** *(empty)*\n\n"
+
+    # Get empty case status
+    empty_case = item.get("categories", {}).get("empty_case", None)
+    empty_case_text = f"**Empty Case:** {empty_case}\n\n" if empty_case is not None else ""
+
+    # Add separator line
+    return caption_text + empty_case_text + image_link + "---\n\n"
+
+
+def convert_json_to_md(json_file_path, output_md_path, page_size=DEFAULT_PAGE_SIZE, image_root="images",
+                       thumb_size=DEFAULT_THUMB_SIZE, thumbnail_dir=None, workers=None):
+    """
+    Convert a RefCOCOS JSON file to markdown review pages
+
+    Records are streamed from the JSON file and written straight to disk. With
+    a page size, items are split into pages of page_size items stored next to
+    output_md_path, which becomes an index linking to every page. Images are
+    linked through thumbnails generated in parallel and cached across runs.
+
+    Args:
+        json_file_path: Path to the input JSON file
+        output_md_path: Path of the markdown file (index page when paging)
+        page_size: Number of items per page, or 0 for a single file
+        image_root: Directory the image paths in the JSON are relative to
+        thumb_size: Maximum thumbnail edge in pixels, or 0 to link full-size images
+        thumbnail_dir: Thumbnail cache directory (default: <output dir>/thumbnails)
+        workers: Number of thumbnail worker processes (default: CPU count)
+    """
     # Create the output directory if it doesn't exist
     output_dir = os.path.dirname(output_md_path)
-    if output_dir and not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    # Generate markdown content
-    md_content = "# RefCOCOS Dataset\n\n"
-
-    for item in data:
-        # Get caption (if it exists and is not empty)
-        caption = item.get("normal_caption", "")
-        caption_text = f"**Caption:** {caption}\n\n" if caption else "**Caption:** *(empty)*\n\n"
-
-        # Get empty case status
-        empty_case = item.get("categories", {}).get("empty_case", None)
-        empty_case_text = f"**Empty Case:** {empty_case}\n\n" if empty_case is not None else ""
-
-        # Get and validate image path
-        original_image_path = item.get("image", "")
-        image_link = ""
-        if original_image_path:
-            # Check path relative to script location (assuming 'images' symlink exists)
-            script_relative_image_path = os.path.join("images", original_image_path)
-            if os.path.exists(script_relative_image_path):
-                # Path for markdown file (relative to 'results/' directory)
-                md_image_path = os.path.join("..", script_relative_image_path)
-                image_link = f"![Image]({md_image_path})\n\n"
-            else:
-                image_link = f"**Image:** *Not found at {script_relative_image_path}*\n\n"
-        else:
-            image_link = "**Image:** *Not specified*\n\n"
-
-        # Add separator line
-        separator = "---\n\n"
-
-        # Combine elements for this item
-        md_content += caption_text + empty_case_text + image_link + separator
-
-    # Write to markdown file
-    with open(output_md_path, 'w') as f:
-        f.write(md_content)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    stem = os.path.splitext(os.path.basename(output_md_path))[0]
+    pages_dir = os.path.join(output_dir, f"{stem}_pages") if page_size else output_dir
+    if page_size:
+        os.makedirs(pages_dir, exist_ok=True)
+
+    if thumb_size:
+        thumbnail_dir = thumbnail_dir or os.path.join(output_dir, "thumbnails")
+        os.makedirs(thumbnail_dir, exist_ok=True)
+
+    images = _ImageLookup(image_root)
+    scheduled = {}
+    pages = []
+    page_file = None
+    count = 0
+
+    def image_link_for(original_image_path):
+        if not original_image_path:
+            return "**Image:** *Not specified*\n\n"
+
+        script_relative_image_path = os.path.join(image_root, original_image_path)
+        if not images.exists(original_image_path):
+            return f"**Image:** *Not found at {script_relative_image_path}*\n\n"
+
+        target = script_relative_image_path
+        if thumb_size:
+            target = os.path.join(thumbnail_dir, thumbnail_name(original_image_path,
+                                                                images.stat(original_image_path), thumb_size))
+            if target not in scheduled:
+                # Thumbnails from earlier runs are reused as-is
+                scheduled[target] = None if os.path.exists(target) else pool.submit(
+                    make_thumbnail, script_relative_image_path, target, thumb_size)
+
+        # Path for markdown file (relative to the page it is linked from)
+        md_image_path = os.path.relpath(target, pages_dir or ".")
+        full_size_path = os.path.relpath(script_relative_image_path, pages_dir or ".")
+        if thumb_size:
+            return f"[![Image]({md_image_path})]({full_size_path})\n\n"
+        return f"![Image]({md_image_path})\n\n"
+
+    pool = ProcessPoolExecutor(max_workers=workers) if thumb_size else None
+    try:
+        for item in iter_json_array(json_file_path, key="annotations"):
+            if page_file is None or (page_size and count % page_size == 0):
+                if page_file is not None:
+                    page_file.close()
+                if page_size:
+                    page_number = len(pages) + 1
+                    page_path = os.path.join(pages_dir, f"page_{page_number:04d}.md")
+                    pages.append((page_path, count))
+                    page_file = open(page_path, "w")
+                    page_file.write(f"# RefCOCOS Dataset - Page {page_number}\n\n")
+                else:
+                    page_file = open(output_md_path, "w")
+                    page_file.write("# RefCOCOS Dataset\n\n")
+
+            page_file.write(format_item(item, image_link_for(item.get("image", ""))))
+            count += 1
+
+        if page_file is None and not page_size:
+            with open(output_md_path, "w") as f:
+                f.write("# RefCOCOS Dataset\n\n")
+    finally:
+        if page_file is not None:
+            page_file.close()
+        if pool is not None:
+            failures = 0
+            for target, future in scheduled.items():
+                if future is None:
+                    continue
+                try:
+                    future.result()
+                except Exception as e:
+                    failures += 1
+                    print(f"Warning: Could not create thumbnail {target}: {e}")
+            pool.shutdown()
+            generated = sum(1 for future in scheduled.values() if future is not None) - failures
+            print(f"Thumbnails: {generated} generated, {len(scheduled) - generated - failures} reused from cache")
+
+    if page_size:
+        with open(output_md_path, "w") as f:
+            f.write("# RefCOCOS Dataset\n\n")
+            f.write(f"{count} annotations on {len(pages)} pages of up to {page_size} items.\n\n")
+            for number, (page_path, first) in enumerate(pages, start=1):
+                last = min(first + page_size, count)
+                link = os.path.relpath(page_path, output_dir or ".")
+                f.write(f"- [Page {number}]({link}) - items {first + 1}-{last}\n")
 
     print(f"Conversion complete. Markdown file saved to: {output_md_path}")
 
+
 if __name__ == "__main__":
-    # json_file_path = "results/refcocos_test_cleaned.json"
-    # output_md_path = "results/refcocos_test_cleaned.md"
+    parser = argparse.ArgumentParser(description='Convert RefCOCOS JSON to paged markdown review reports')
+    parser.add_argument('--json_path', '-j', type=str, default="results/refcocos_test.json",
+                        help='Path to the RefCOCOS JSON file')
+    parser.add_argument('--output_md', '-o', type=str, default="results/refcocos_test.md",
+                        help='Output markdown file (index page when paging)')
+    parser.add_argument('--page_size', '-n', type=int, default=DEFAULT_PAGE_SIZE,
+                        help=f'Items per page, 0 for a single file (default: {DEFAULT_PAGE_SIZE})')
+    parser.add_argument('--image_root', '-i', type=str, default="images",
+                        help='Root directory containing the images (default: images)')
+    parser.add_argument('--thumb_size', type=int, default=DEFAULT_THUMB_SIZE,
+                        help=f'Thumbnail size in pixels, 0 to link full-size images (default: {DEFAULT_THUMB_SIZE})')
+    parser.add_argument('--thumbnail_dir', type=str, default=None,
+                        help='Thumbnail cache directory (default: <output dir>/thumbnails)')
+    parser.add_argument('--workers', '-w', type=int, default=None,
+                        help='Number of thumbnail worker processes (default: CPU count)')
 
-    json_file_path = "results/refcocos_test.json"
-    output_md_path = "results/refcocos_test.md"
-    convert_json_to_md(json_file_path, output_md_path)
\ No newline at end of file
+    args = parser.parse_args()
+    convert_json_to_md(args.json_path, args.output_md, args.page_size, args.image_root,
+                       args.thumb_size, args.thumbnail_dir, args.workers)
@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 import os
+import sys
 import json
 import argparse
 from collections import defaultdict
 
+# Add parent directory to path to import from refcocos_annotator
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from refcocos_annotator.services import image_manifest_service
+
 def parse_args():
     """Parse command-line arguments"""
     parser = argparse.ArgumentParser(
@@ -17,6 +23,10 @@ def parse_args():
                         help='Path to image directory (default: ./val2017)')
     parser.add_argument('--output-file', type=str, default="./val2017_multiple_instances.json",
                         help='Path to output JSON file (default: val2017_multiple_instances.json)')
+    parser.add_argument('--manifest-file', type=str, default="./val2017_image_manifest.json",
+                        help='Image manifest to build or refresh (default: val2017_image_manifest.json)')
+    parser.add_argument('--workers', type=int, default=image_manifest_service.DEFAULT_WORKERS,
+                        help=f'Threads scanning the image directory (default: {image_manifest_service.DEFAULT_WORKERS})')
     
     return parser.parse_args()
 
@@ -34,6 +44,15 @@ def filter_images_with_multiple_instances(args):
         print(f"Error: Invalid JSON format in {args.annotation_file}.")
         return
     
+    # Scan the image directory once instead of checking every image separately
+    print(f"Scanning images in {args.img_dir}...")
+    previous = image_manifest_service.read_manifest(args.manifest_file)
+    if previous is not None and previous["image_dir"] != os.path.abspath(args.img_dir):
+        previous = None
+    manifest, scanned = image_manifest_service.build_manifest(args.img_dir, previous, args.workers)
+    image_manifest_service.write_manifest(args.manifest_file, manifest)
+    print(f"Image manifest saved to {args.manifest_file} ({len(manifest['images'])} images, {scanned} read)")
+
     # Create mapping from image_id to image info
     image_id_to_info = {}
     for image_info in coco_data.get('images', []):
@@ -62,6 +81,8 @@ def filter_images_with_multiple_instances(args):
     
     # Filter images: keep those with at least min_instances of at least one category
     valid_images = []
+    missing_images = []
+    mismatched_images = []
     for image_id, category_counts in image_category_counts.items():
         has_enough_instances = False
         categories_with_instances = []
@@ -82,12 +103,18 @@ def filter_images_with_multiple_instances(args):
                 })
         
         if has_enough_instances and image_id in image_id_to_info:
-            # Verify that the image file exists
+            # Verify that the image file exists and has the dimensions the boxes refer to
             image_info = image_id_to_info[image_id]
             file_name = image_info['file_name']
             img_path = os.path.join(args.img_dir, file_name)
-            
-            if os.path.exists(img_path):
+            info = image_manifest_service.entry(manifest, img_path)
+
+            if info is None:
+                missing_images.append(file_name)
+            elif (info['width'], info['height']) != (image_info['width'], image_info['height']):
+                mismatched_images.append(f"{file_name}: {image_info['width']}x{image_info['height']} in COCO, "
+                                         f"{info['width']}x{info['height']} on disk")
+            else:
                 valid_images.append({
                     "image_id": image_id,
                     "file_name": file_name,
@@ -98,6 +125,12 @@ def filter_images_with_multiple_instances(args):
                 })
     
     print(f"Found {len(valid_images)} images with at least {args.min_instances} instances of the same object category")
+    if missing_images:
+        print(f"Skipped {len(missing_images)} images missing from {args.img_dir}")
+    if mismatched_images:
+        print(f"Skipped {len(mismatched_images)} images whose dimensions differ from COCO, e.g.:")
+        for mismatch in mismatched_images[:5]:
+            print(f"   - {mismatch}")
     
     # Save results to output file
     print(f"Saving results to {args.output_file}...")
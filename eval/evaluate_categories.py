@@ -16,6 +16,9 @@ def load_data(coco_json_path=None, results_json_path=None, coco_data=None):
     if coco_data is None and coco_json_path is not None:
         with open(coco_json_path, 'r') as f:
             coco_data = json.load(f)
+        # Versioned annotator output files wrap the records in an object
+        if isinstance(coco_data, dict):
+            coco_data = coco_data.get('annotations', [])
 
     # Load model prediction results
     results_data = []
@@ -285,6 +288,9 @@ def main():
     print(f"Loading annotations from {args.coco}...")
     with open(args.coco, 'r') as f:
         coco_data = json.load(f)
+    # Versioned annotator output files wrap the records in an object
+    if isinstance(coco_data, dict):
+        coco_data = coco_data.get('annotations', [])
     print(f"Loaded {len(coco_data)} annotations")
 
     # Find all JSON files in the results directory and subdirectories
@@ -0,0 +1,323 @@
+"""Export annotations to Parquet and/or sharded JSONL.
+
+The annotation file (optionally with the annotator shards replayed on top,
+i.e. the live store) is streamed record by record, so memory use is bounded
+by one Parquet row group or JSONL shard regardless of the dataset size. With
+``RANGE_SHARD_DIR`` set the range shards are read instead, one at a time.
+
+Parquet files keep captions, boxes and every category field in separate
+typed columns, so training jobs can read e.g. just ``caption`` and ``bbox``
+without touching the rest:
+
+    pyarrow.parquet.read_table("export/", columns=["caption", "bbox"])
+
+Every run writes new ``part-<timestamp>`` files and records itself in
+``manifest.json``. ``--since last`` exports only annotations saved or edited
+after the previous export; deletions are only reflected by a full export.
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+from refcocos_annotator.config import ANNOTATOR_SHARD_DIR, OUTPUT_FILE, RANGE_SHARD_DIR, RANGE_SHARD_SIZE
+from refcocos_annotator.services import shard_service
+from refcocos_annotator.services.range_shard_service import RangeStore
+from refcocos_annotator.utils.file_utils import atomic_write_json, iter_json_array
+
+DEFAULT_ROW_GROUP_SIZE = 10000
+# Smaller row groups when image bytes are included keep memory bounded
+DEFAULT_IMAGE_ROW_GROUP_SIZE = 500
+DEFAULT_SHARD_SIZE = 50000
+MANIFEST_NAME = "manifest.json"
+
+COLUMNS = [
+    "annotation_id", "dataset", "text_type", "image", "file_name", "image_index", "width", "height",
+    "caption", "problem", "bbox", "normalized_bbox", "hops", "distractors", "type", "occluded",
+    "empty_case", "updated_at",
+]
+
+
+def updated_at(record: Dict[str, Any]) -> int:
+    """Last modification time of a record in epoch milliseconds.
+
+    Records saved before ``updated_at`` was stamped fall back to the creation
+    time encoded in their annotation ID, or 0.
+    """
+    if record.get("updated_at") is not None:
+        return int(record["updated_at"])
+    suffix = str(record.get("annotation_id", "")).rsplit("_", 1)[-1]
+    return int(suffix) if suffix.isdigit() and len(suffix) >= 12 else 0
+
+
+def parse_since(value: Optional[str], output_dir: str) -> Optional[int]:
+    """Turn ``--since`` (epoch ms, ISO date/time or "last") into epoch milliseconds."""
+    if value is None:
+        return None
+    if value == "last":
+        manifest = _read_manifest(output_dir)
+        if not manifest["exports"]:
+            raise ValueError(f"No previous export in {output_dir}")
+        return manifest["exports"][-1]["until"]
+    if value.isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+
+def _to_int(value: Any) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _box(values: Any, cast=float) -> Optional[List]:
+    if not isinstance(values, list) or len(values) != 4:
+        return None
+    try:
+        return [cast(v) for v in values]
+    except (TypeError, ValueError):
+        return None
+
+
+def flatten(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Flatten an annotation into one value per export column."""
+    categories = record.get("categories") or {}
+    types = categories.get("type", [])
+    return {
+        "annotation_id": str(record.get("annotation_id", "")),
+        "dataset": record.get("dataset", ""),
+        "text_type": record.get("text_type", ""),
+        "image": record.get("image", ""),
+        "file_name": record.get("file_name", ""),
+        "image_index": _to_int(record.get("image_index")),
+        "width": _to_int(record.get("width")),
+        "height": _to_int(record.get("height")),
+        "caption": record.get("normal_caption", ""),
+        "problem": record.get("problem", ""),
+        "bbox": _box(record.get("solution")),
+        "normalized_bbox": _box(record.get("normalized_solution"), int),
+        "hops": _to_int(categories.get("hops")),
+        "distractors": _to_int(categories.get("distractors")),
+        "type": [str(t) for t in types] if isinstance(types, list) else [str(types)],
+        "occluded": bool(categories.get("occluded", False)),
+        "empty_case": bool(categories.get("empty_case", False)),
+        "updated_at": updated_at(record),
+    }
+
+
+def iter_records(output_file: str, shard_dir: Optional[str] = None,
+                 range_dir: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """Stream the annotations, with the annotator shards replayed if ``shard_dir`` is given.
+
+    With ``range_dir`` the annotations are read from its range shards instead of ``output_file``.
+    """
+    if range_dir:
+        store = RangeStore(range_dir, RANGE_SHARD_SIZE)
+        if not store.exists():
+            raise ValueError(f"{range_dir} holds no range shards")
+        return store.iter_records()
+    records = iter_json_array(output_file, key="annotations") if os.path.exists(output_file) else iter(())
+    if shard_dir:
+        ops, _ = shard_service.read_all_operations(shard_service.list_shards(shard_dir))
+        records = shard_service.stream_with_operations(records, ops)
+    return records
+
+
+class ParquetExporter:
+    """Writes flattened records to one Parquet file, one row group at a time."""
+
+    def __init__(self, path: str, row_group_size: int, image_root: Optional[str] = None):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Parquet export requires pyarrow: pip install pyarrow")
+
+        self.pa = pa
+        self.path = path
+        self.row_group_size = row_group_size
+        self.image_root = image_root
+        fields = [
+            ("annotation_id", pa.string()), ("dataset", pa.string()), ("text_type", pa.string()),
+            ("image", pa.string()), ("file_name", pa.string()), ("image_index", pa.int32()),
+            ("width", pa.int32()), ("height", pa.int32()), ("caption", pa.string()), ("problem", pa.string()),
+            ("bbox", pa.list_(pa.float32(), 4)), ("normalized_bbox", pa.list_(pa.int32(), 4)),
+            ("hops", pa.int32()), ("distractors", pa.int32()), ("type", pa.list_(pa.string())),
+            ("occluded", pa.bool_()), ("empty_case", pa.bool_()), ("updated_at", pa.timestamp("ms")),
+        ]
+        if image_root is not None:
+            fields.append(("image_bytes", pa.binary()))
+        self.schema = pa.schema(fields)
+        self.writer = pq.ParquetWriter(path + ".tmp", self.schema, compression="zstd")
+        self.columns = {name: [] for name in self.schema.names}
+        self.rows = 0
+
+    def _image_bytes(self, image: str) -> Optional[bytes]:
+        try:
+            with open(os.path.join(self.image_root, image), "rb") as f:
+                return f.read()
+        except OSError:
+            print(f"Warning: Image not found at {os.path.join(self.image_root, image)}")
+            return None
+
+    def write(self, row: Dict[str, Any]) -> None:
+        for name in COLUMNS:
+            self.columns[name].append(row[name])
+        if self.image_root is not None:
+            self.columns["image_bytes"].append(self._image_bytes(row["image"]))
+        self.rows += 1
+        if len(self.columns["annotation_id"]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.columns["annotation_id"]:
+            return
+        table = self.pa.Table.from_pydict(self.columns, schema=self.schema)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+        self.columns = {name: [] for name in self.schema.names}
+
+    def close(self) -> List[str]:
+        self.flush()
+        self.writer.close()
+        os.replace(self.path + ".tmp", self.path)
+        return [self.path]
+
+
+class JsonlExporter:
+    """Writes flattened records to JSONL files of at most ``shard_size`` lines."""
+
+    def __init__(self, prefix: str, shard_size: int):
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.files: List[str] = []
+        self.current = None
+        self.lines = 0
+        self.rows = 0
+
+    def write(self, row: Dict[str, Any]) -> None:
+        if self.current is None or self.lines >= self.shard_size:
+            self._next_shard()
+        self.current.write(json.dumps(row) + "\n")
+        self.lines += 1
+        self.rows += 1
+
+    def _next_shard(self) -> None:
+        self._close_current()
+        path = f"{self.prefix}-{len(self.files):05d}.jsonl"
+        self.files.append(path)
+        self.current = open(path + ".tmp", "w")
+        self.lines = 0
+
+    def _close_current(self) -> None:
+        if self.current is not None:
+            self.current.close()
+            os.replace(self.files[-1] + ".tmp", self.files[-1])
+            self.current = None
+
+    def close(self) -> List[str]:
+        self._close_current()
+        return self.files
+
+
+def _read_manifest(output_dir: str) -> Dict[str, Any]:
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"exports": []}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def export_annotations(output_file: str, output_dir: str, formats: List[str], since: Optional[int] = None,
+                       shard_dir: Optional[str] = None, image_root: Optional[str] = None,
+                       row_group_size: Optional[int] = None, shard_size: int = DEFAULT_SHARD_SIZE,
+                       range_dir: Optional[str] = None) -> Dict[str, Any]:
+    """Stream annotations into Parquet and/or JSONL files in ``output_dir``.
+
+    Args:
+        output_file: Annotation file to export
+        output_dir: Directory for the exported files and the manifest
+        formats: Any of "parquet" and "jsonl"
+        since: Only export annotations modified after this time (epoch ms)
+        shard_dir: Replay the annotator shards in this directory on top of the file
+        image_root: Include image bytes in the Parquet file, read from this directory
+        row_group_size: Rows per Parquet row group
+        shard_size: Lines per JSONL file
+        range_dir: Read the annotations from the range shards in this directory instead of ``output_file``
+
+    Returns:
+        Dict: The manifest entry of this export
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    stamp = time.strftime("%Y%m%dT%H%M%S")
+    if row_group_size is None:
+        row_group_size = DEFAULT_IMAGE_ROW_GROUP_SIZE if image_root is not None else DEFAULT_ROW_GROUP_SIZE
+
+    exporters = []
+    if "parquet" in formats:
+        exporters.append(ParquetExporter(os.path.join(output_dir, f"part-{stamp}.parquet"), row_group_size, image_root))
+    if "jsonl" in formats:
+        exporters.append(JsonlExporter(os.path.join(output_dir, f"part-{stamp}"), shard_size))
+
+    scanned = exported = 0
+    until = since or 0
+    for record in iter_records(output_file, shard_dir, range_dir):
+        scanned += 1
+        row = flatten(record)
+        if since is not None and row["updated_at"] <= since:
+            continue
+        until = max(until, row["updated_at"])
+        for exporter in exporters:
+            exporter.write(row)
+        exported += 1
+
+    files = [os.path.basename(path) for exporter in exporters for path in exporter.close()]
+    entry = {
+        "created_at": stamp,
+        "source": os.path.abspath(range_dir or output_file),
+        "since": since,
+        "until": until,
+        "scanned": scanned,
+        "rows": exported,
+        "files": files,
+    }
+    manifest = _read_manifest(output_dir)
+    manifest["exports"].append(entry)
+    atomic_write_json(os.path.join(output_dir, MANIFEST_NAME), manifest)
+    return entry
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export annotations to Parquet and/or sharded JSONL')
+    parser.add_argument('--json_path', '-j', type=str, default=OUTPUT_FILE,
+                        help=f'Annotation file to export (default: {OUTPUT_FILE})')
+    parser.add_argument('--output_dir', '-o', type=str, default='export', help='Export directory')
+    parser.add_argument('--format', '-f', type=str, nargs='+', default=['parquet'], choices=['parquet', 'jsonl'],
+                        help='Output formats (default: parquet)')
+    parser.add_argument('--since', type=str, default=None,
+                        help='Only export annotations saved after this time: epoch ms, ISO date/time, '
+                             'or "last" for the end of the previous export')
+    parser.add_argument('--live', action='store_true',
+                        help='Include unmerged annotator shards from ANNOTATOR_SHARD_DIR')
+    parser.add_argument('--shard_dir', type=str, default=ANNOTATOR_SHARD_DIR,
+                        help=f'Annotator shard directory used with --live (default: {ANNOTATOR_SHARD_DIR})')
+    parser.add_argument('--range_dir', type=str, default=RANGE_SHARD_DIR,
+                        help='Read the range shards in this directory instead of the annotation file '
+                             f'(default: {RANGE_SHARD_DIR or "off"})')
+    parser.add_argument('--image_root', '-i', type=str, default=None,
+                        help='Add an image_bytes column to the Parquet file with images from this directory')
+    parser.add_argument('--row_group_size', type=int, default=None,
+                        help=f'Rows per Parquet row group (default: {DEFAULT_ROW_GROUP_SIZE}, '
+                             f'{DEFAULT_IMAGE_ROW_GROUP_SIZE} with images)')
+    parser.add_argument('--shard_size', type=int, default=DEFAULT_SHARD_SIZE,
+                        help=f'Lines per JSONL file (default: {DEFAULT_SHARD_SIZE})')
+    args = parser.parse_args()
+
+    entry = export_annotations(args.json_path, args.output_dir, args.format,
+                               since=parse_since(args.since, args.output_dir),
+                               shard_dir=args.shard_dir if args.live else None, image_root=args.image_root,
+                               row_group_size=args.row_group_size, shard_size=args.shard_size,
+                               range_dir=args.range_dir)
+    print(f"Exported {entry['rows']} of {entry['scanned']} annotations to {len(entry['files'])} files in {args.output_dir}")
@@ -4,7 +4,7 @@ from flask import Flask
 
 from refcocos_annotator.config import DEBUG, HOST, PORT, STATIC_FOLDER, TEMPLATE_FOLDER
 from refcocos_annotator.routes import web_bp, api_bp
-from refcocos_annotator.services import data_service
+from refcocos_annotator.services import data_service, metrics_service, profiling_service
 
 # Import routes to ensure they're registered
 import refcocos_annotator.routes.views
@@ -23,6 +23,12 @@ def create_app():
     # Register blueprints
     app.register_blueprint(web_bp)
     app.register_blueprint(api_bp)
+
+    # Record per-endpoint latency, response size and error metrics
+    metrics_service.init_app(app)
+
+    # Optional per-request profiling (see PROFILE_* in config)
+    profiling_service.init_app(app)
     
     return app
 
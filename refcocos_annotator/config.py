@@ -1,17 +1,73 @@
 """Configuration settings for the RefCOCOS Annotator."""
 import os
 
-# Default configuration
+# Default configuration; the data files can be overridden from the environment,
+# e.g. to point a server at a scratch copy of the data
 IMAGE_BASE_DIR = "."
-MULTIPLE_INSTANCES_FILE = "data/val2017_multiple_instances.json"
-OUTPUT_FILE = "results/refcocos_test.json"
+MULTIPLE_INSTANCES_FILE = os.environ.get('MULTIPLE_INSTANCES_FILE', "data/val2017_multiple_instances.json")
+OUTPUT_FILE = os.environ.get('OUTPUT_FILE', "results/refcocos_test.json")
 
 # Flask configuration
-DEBUG = True
+DEBUG = os.environ.get('DEBUG', '1').lower() in ('1', 'true', 'yes')
 PORT = int(os.environ.get('PORT', 5555))
 HOST = '0.0.0.0'
 
 # Configure paths based on package location
 PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
 STATIC_FOLDER = os.path.join(PACKAGE_DIR, 'static')
-TEMPLATE_FOLDER = os.path.join(PACKAGE_DIR, 'templates') 
\ No newline at end of file
+TEMPLATE_FOLDER = os.path.join(PACKAGE_DIR, 'templates')
+
+# Profiling configuration
+# Profiling is opt-in; when enabled, a request is profiled if it carries an
+# "X-Profile: 1" header or "profile=1" query flag, or is picked by 1-in-N sampling
+PROFILE_ENABLED = os.environ.get('PROFILE_ENABLED', '').lower() in ('1', 'true', 'yes')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_SAMPLE_RATE = int(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_ENDPOINTS = [e for e in os.environ.get('PROFILE_ENDPOINTS', '').split(',') if e]
+
+# Per-annotator output shards
+# When set, saves and deletes are appended to <annotator>.jsonl files in this
+# directory instead of rewriting OUTPUT_FILE (see utils/merge_shards.py)
+ANNOTATOR_SHARD_DIR = os.environ.get('ANNOTATOR_SHARD_DIR') or None
+
+# Number of recent annotation events kept for clients resuming /api/events
+EVENT_BUFFER_SIZE = int(os.environ.get('EVENT_BUFFER_SIZE', '1000'))
+
+# Cache directory for rendered review overlays (served with send_file, so absolute)
+OVERLAY_CACHE_DIR = os.path.abspath(os.environ.get('OVERLAY_CACHE_DIR', 'overlays'))
+
+# Work scheduler: annotations wanted per image and how long a leased image
+# stays reserved for an annotator without activity
+TASK_TARGET_ANNOTATIONS = int(os.environ.get('TASK_TARGET_ANNOTATIONS', 1))
+TASK_LEASE_SECONDS = int(os.environ.get('TASK_LEASE_SECONDS', 900))
+
+# Directory for binary snapshots of the parsed data files; empty to disable
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', '.snapshots')
+
+# Cache directory for resized and transcoded (WebP/JPEG) images; absolute,
+# since Flask's send_file resolves relative paths against the package
+IMAGE_CACHE_DIR = os.path.abspath(os.environ.get('IMAGE_CACHE_DIR', 'image_cache'))
+
+# Manifest of the image directory (sizes, content hashes, real dimensions),
+# used when it exists (see utils/build_image_manifest.py)
+IMAGE_MANIFEST_FILE = os.environ.get('IMAGE_MANIFEST_FILE', 'data/val2017_image_manifest.json')
+
+# Validate all annotations (requires numpy) whenever the output file is loaded,
+# and the minimum IoU between a solution box and a COCO instance box
+VALIDATE_ON_LOAD = os.environ.get('VALIDATE_ON_LOAD', '').lower() in ('1', 'true', 'yes')
+VALIDATION_IOU_THRESHOLD = float(os.environ.get('VALIDATION_IOU_THRESHOLD', 0.5))
+
+# Content-addressed annotation snapshots for diffing the annotation set over time
+HISTORY_DIR = os.environ.get('HISTORY_DIR', '.history')
+
+# Undo/redo history kept per annotator: most recent operations, and how long
+# an operation can still be undone
+UNDO_MAX_OPERATIONS = int(os.environ.get('UNDO_MAX_OPERATIONS', 100))
+UNDO_MAX_AGE_SECONDS = int(os.environ.get('UNDO_MAX_AGE_SECONDS', 3600))
+
+# Output storage partitioned by image index range
+# When set, annotations are kept in shard files of RANGE_SHARD_SIZE images each
+# in this directory instead of OUTPUT_FILE, and a save rewrites only its shard
+# (see utils/range_shards.py)
+RANGE_SHARD_DIR = os.environ.get('RANGE_SHARD_DIR') or None
+RANGE_SHARD_SIZE = int(os.environ.get('RANGE_SHARD_SIZE', 500))
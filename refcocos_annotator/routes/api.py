@@ -1,27 +1,118 @@
 """API routes for the RefCOCOS Annotator."""
-from flask import jsonify, request
+import math
+
+from flask import Response, jsonify, request, send_file, url_for
+from refcocos_annotator import config
 from refcocos_annotator.routes import api_bp
-from refcocos_annotator.services import data_service
+from refcocos_annotator.services import (data_service, dedup_service, distractor_service, events_service,
+                                         history_service, image_service, match_service, metrics_service,
+                                         overlay_service, query_service, scheduler_service)
+from refcocos_annotator.services.metrics_service import timed
+
+def _annotator(data=None):
+    """Annotator name from the X-Annotator header, query string or JSON body."""
+    return (request.headers.get('X-Annotator') or request.args.get('annotator')
+            or (data or {}).get('annotator'))
+
+def _if_match():
+    """Annotation version required by the If-Match header, None without one (or for "*").
+
+    Raises:
+        ValueError: The header is not a single version number
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    tags = request.if_match.as_set()
+    if len(tags) != 1:
+        raise ValueError("If-Match must name exactly one version")
+    return int(tags.pop())
+
+def _conflict(e):
+    """409 response for a change based on an outdated annotation version."""
+    response = jsonify({"success": False, "message": str(e), "version": e.version, "current": e.current})
+    if e.current is not None:
+        response.set_etag(str(e.version))
+    return response, 409
+
+def _image_size_args():
+    """``max_width``, ``max_height`` and ``quality`` query parameters of an image request.
+
+    Raises:
+        ValueError: One of them is zero or negative
+    """
+    size = {name: request.args.get(name, type=int) for name in ('max_width', 'max_height', 'quality')}
+    if any(value is not None and value <= 0 for value in size.values()):
+        raise ValueError("max_width, max_height and quality must be positive")
+    return size
 
 @api_bp.route('/image/<int:index>')
 def get_image(index):
     """API endpoint to get image data.
     
+    Optional ``max_width``, ``max_height`` and ``quality`` query parameters
+    downscale and recompress the image; the response's ``scale`` maps box
+    coordinates to the delivered image. With ``embed=0`` the image is not
+    inlined and ``image_url`` points to ``/api/image_file/<index>`` instead.
+
     Args:
         index: The index of the image to get
         
     Returns:
         JSON response with image data
     """
-    result = data_service.get_image_data(int(index))
-    return jsonify(result)
+    try:
+        size = _image_size_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    embed = request.args.get('embed', '1') not in ('0', 'false')
+    result = data_service.get_image_data(int(index), embed=embed, **size)
+    if not embed and "error" not in result:
+        # Snapped like the transcode, so nearby sizes share one browser cache entry
+        snapped = dict(zip(size, image_service.snap_options(**size)))
+        result["image_url"] = url_for('api.get_image_file', index=index,
+                                      **{k: v for k, v in snapped.items() if v is not None})
+    with timed("response_serialize"):
+        return jsonify(result)
+
+@api_bp.route('/image_file/<int:index>')
+def get_image_file(index):
+    """API endpoint to get an image file in the best format the client accepts.
+
+    WebP is served to clients that list ``image/webp`` in their Accept
+    header and JPEG to all others. Takes the same ``max_width``,
+    ``max_height`` and ``quality`` parameters as ``/api/image/<index>``.
+
+    Args:
+        index: The index of the image to get
+
+    Returns:
+        Image response; the scale factor is in the X-Image-Scale header
+    """
+    try:
+        size = _image_size_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    fmt = image_service.negotiate_format(request.headers.get('Accept', ''))
+    result = data_service.get_image_file(int(index), fmt, **size)
+    if "error" in result:
+        return jsonify(result), 404
+
+    response = send_file(result["path"], mimetype=result["mimetype"], max_age=3600)
+    # Caches must keep the WebP and JPEG variants apart
+    response.headers["Vary"] = "Accept"
+    response.headers["X-Image-Scale"] = str(result["scale"])
+    return response
 
 @api_bp.route('/save_reference', methods=['POST'])
 def save_reference():
     """API endpoint to save reference annotation.
     
+    With an ``If-Match: "<version>"`` header the annotation is only replaced
+    if it is still at that version; otherwise the response is 409 with the
+    current annotation.
+
     Returns:
-        JSON response with success status
+        JSON response with success status and the new version (also the ETag)
     """
     try:
         data = request.json
@@ -30,9 +121,29 @@ def save_reference():
 
         if image_id is None or annotation is None:
             return jsonify({"success": False, "message": "Invalid data"}), 400
+        try:
+            expected_version = _if_match()
+        except ValueError:
+            return jsonify({"success": False, "message": "Invalid If-Match header"}), 400
 
-        success, message = data_service.save_reference_annotation(image_id, annotation)
-        return jsonify({"success": success, "message": message})
+        # Drawn boxes reach the server without a distractor count
+        distractor_service.fill_distractors(annotation)
+        try:
+            success, message = data_service.save_reference_annotation(image_id, annotation, _annotator(data),
+                                                                      expected_version)
+        except data_service.VersionConflict as e:
+            return _conflict(e)
+        response = {"success": success, "message": message}
+        if success:
+            response["version"] = annotation["version"]
+            # Warn about near-duplicate captions on the same image
+            warnings = dedup_service.duplicate_warnings(annotation)
+            if warnings:
+                response["warnings"] = warnings
+        response = jsonify(response)
+        if success:
+            response.set_etag(str(annotation["version"]))
+        return response
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
 
@@ -56,7 +167,8 @@ def get_image_status():
     status = data_service.get_image_status()
     if "error" in status:
         return jsonify(status), 404
-    return jsonify(status)
+    with timed("response_serialize"):
+        return jsonify(status)
 
 @api_bp.route('/saved_data')
 def get_saved_data():
@@ -65,12 +177,156 @@ def get_saved_data():
     Returns:
         JSON response with saved annotations
     """
-    return jsonify(data_service.get_saved_data())
+    saved_data = data_service.get_saved_data()
+    with timed("response_serialize"):
+        response = jsonify(saved_data)
+    # Clients pass this to /api/events to receive only later changes
+    response.headers["X-Store-Version"] = str(events_service.event_bus.version)
+    return response
+
+@api_bp.route('/events')
+def stream_events():
+    """API endpoint streaming annotation changes as Server-Sent Events.
+
+    Each save or delete is sent as an event whose id is the store version.
+    Clients resume with the ``Last-Event-ID`` header (sent automatically by
+    EventSource on reconnect) or a ``since`` query parameter.
+
+    Returns:
+        text/event-stream response
+    """
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        since = int(since) if since is not None else None
+    except ValueError:
+        return jsonify({"error": f"Invalid version: {since}"}), 400
+
+    return Response(events_service.stream_events(since), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@api_bp.route('/overlay/<int:index>')
+def get_overlay(index):
+    """API endpoint to get an image with its instance and solution boxes drawn in.
+
+    Optional query parameters are ``annotation_id`` to draw a single
+    annotation and ``max_size`` to limit the longest side in pixels.
+
+    Args:
+        index: The index of the image
+
+    Returns:
+        JPEG response
+    """
+    max_size = request.args.get('max_size', type=int)
+    if max_size is not None and max_size <= 0:
+        return jsonify({"error": "max_size must be positive"}), 400
+    path, message = overlay_service.overlay_for_image(config.OVERLAY_CACHE_DIR, index,
+                                                      request.args.get('annotation_id'), max_size)
+    if path is None:
+        return jsonify({"error": message}), 404
+    return send_file(path, mimetype="image/jpeg", max_age=0)
+
+@api_bp.route('/contact_sheet')
+def get_contact_sheet():
+    """API endpoint to tile the overlays of matching annotations into one image.
+
+    Takes the same filters and pagination as ``/api/query`` plus ``columns``
+    and ``tile`` (tile size in pixels).
+
+    Returns:
+        JPEG response; the number of matches is in the X-Total-Count header
+    """
+    args = request.args.to_dict(flat=False)
+    try:
+        columns = int(args.pop('columns', [overlay_service.DEFAULT_COLUMNS])[-1])
+        tile_size = int(args.pop('tile', [overlay_service.DEFAULT_TILE_SIZE])[-1])
+    except ValueError:
+        return jsonify({"error": "Invalid columns or tile"}), 400
+
+    result = query_service.query_annotations(args)
+    if "error" in result:
+        return jsonify(result), 400
+
+    sheet = overlay_service.render_contact_sheet(config.OVERLAY_CACHE_DIR, result["annotations"],
+                                                 columns, max(32, min(tile_size, 1024)))
+    response = Response(overlay_service.encode_jpeg(sheet), mimetype="image/jpeg")
+    response.headers["X-Total-Count"] = str(result["total"])
+    return response
+
+@api_bp.route('/match/<int:index>')
+def match_box(index):
+    """API endpoint to match a drawn box against the COCO instances of an image.
+
+    Query parameters: ``bbox`` as "x1,y1,x2,y2" in image coordinates, and
+    optional ``snap_iou`` and ``margin`` (IoU difference below which two
+    matches are ambiguous).
+
+    Args:
+        index: The index of the image
+
+    Returns:
+        JSON response with the best matching instances, the instance to snap to and an ambiguity flag
+    """
+    try:
+        box = [float(v) for v in request.args.get('bbox', '').split(',')]
+        snap_iou = float(request.args.get('snap_iou', match_service.DEFAULT_SNAP_IOU))
+        margin = float(request.args.get('margin', match_service.DEFAULT_AMBIGUITY_MARGIN))
+    except ValueError:
+        return jsonify({"error": "Invalid bbox, snap_iou or margin"}), 400
+    # float() accepts "nan" and "inf", which no box or threshold can use
+    if not all(math.isfinite(v) for v in box + [snap_iou, margin]):
+        return jsonify({"error": "Invalid bbox, snap_iou or margin"}), 400
+    if len(box) != 4 or box[2] <= box[0] or box[3] <= box[1]:
+        return jsonify({"error": "bbox must be x1,y1,x2,y2 with x2 > x1 and y2 > y1"}), 400
+
+    result = match_service.match_box(index, box, snap_iou, margin)
+    if "error" in result:
+        return jsonify(result), 404
+    return jsonify(result)
+
+@api_bp.route('/query')
+def query_annotations():
+    """API endpoint to query saved annotations.
+    
+    Filters are passed as query parameters, e.g.
+    ``/api/query?hops=3&type=exclude&occluded=true&distractors=5+&caption=left``,
+    together with optional ``sort`` (prefix "-" for descending), ``offset``
+    and ``limit``.
+    
+    Returns:
+        JSON response with the total number of matches and one page of annotations
+    """
+    result = query_service.query_annotations(request.args.to_dict(flat=False))
+    if "error" in result:
+        return jsonify(result), 400
+    with timed("response_serialize"):
+        return jsonify(result)
+
+@api_bp.route('/duplicates')
+def get_duplicates():
+    """API endpoint to get clusters of near-duplicate captions.
+    
+    Query parameters: ``threshold`` (minimum Jaccard similarity) and
+    ``same_image`` (only cluster captions on the same image).
+    
+    Returns:
+        JSON response with the duplicate clusters
+    """
+    try:
+        threshold = float(request.args.get('threshold', dedup_service.DEFAULT_THRESHOLD))
+    except ValueError:
+        return jsonify({"error": "Invalid threshold"}), 400
+    same_image = request.args.get('same_image', '').lower() in ('1', 'true', 'yes')
+
+    clusters = dedup_service.caption_index.clusters(threshold, same_image)
+    return jsonify({"total": len(clusters), "clusters": clusters})
 
 @api_bp.route('/delete_annotation', methods=['POST'])
 def delete_annotation():
     """API endpoint to delete a reference annotation.
     
+    Takes an ``If-Match`` header like ``/api/save_reference``.
+
     Returns:
         JSON response with success status
     """
@@ -81,8 +337,15 @@ def delete_annotation():
 
         if image_id is None or annotation_id is None:
             return jsonify({"success": False, "message": "Invalid data"}), 400
+        try:
+            expected_version = _if_match()
+        except ValueError:
+            return jsonify({"success": False, "message": "Invalid If-Match header"}), 400
 
-        success, message = data_service.delete_annotation(annotation_id)
+        try:
+            success, message = data_service.delete_annotation(annotation_id, _annotator(data), expected_version)
+        except data_service.VersionConflict as e:
+            return _conflict(e)
         if not success:
             return jsonify({"success": False, "message": message}), 404
         
@@ -90,6 +353,37 @@ def delete_annotation():
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
 
+def _undo_status(result):
+    """HTTP status of an undo/redo result: nothing to do, or the annotation changed meanwhile."""
+    if result["success"]:
+        return 200
+    return 409 if "op" in result else 404
+
+def _undo_response(result):
+    """Undo/redo response; a restored annotation's new version is also the ETag."""
+    response = jsonify(result)
+    if "version" in result:
+        response.set_etag(str(result["version"]))
+    return response, _undo_status(result)
+
+@api_bp.route('/undo', methods=['POST'])
+def undo():
+    """API endpoint to revert the annotator's most recent save or delete.
+
+    Returns:
+        JSON response with the reverted annotation and the remaining undo/redo depth
+    """
+    return _undo_response(data_service.undo(_annotator(request.get_json(silent=True))))
+
+@api_bp.route('/redo', methods=['POST'])
+def redo():
+    """API endpoint to re-apply the annotator's most recently undone operation.
+
+    Returns:
+        JSON response with the restored annotation and the remaining undo/redo depth
+    """
+    return _undo_response(data_service.redo(_annotator(request.get_json(silent=True))))
+
 @api_bp.route('/last_saved_index')
 def get_last_saved_index():
     """API endpoint to get the index of the last saved image.
@@ -108,4 +402,96 @@ def get_last_created_annotation_index():
         JSON response with the index of the most recently created annotation
     """
     index = data_service.get_last_created_annotation_index()
-    return jsonify({"index": index}) 
\ No newline at end of file
+    return jsonify({"index": index}) 
+
+@api_bp.route('/next_task', methods=['GET', 'POST'])
+def next_task():
+    """API endpoint to lease the next image that needs annotations.
+
+    The annotator is identified like for saves. Asking again while holding
+    a lease renews it and returns the same image until it has enough
+    annotations.
+
+    Returns:
+        JSON response with the image index and lease expiry
+    """
+    result = scheduler_service.next_task(_annotator(request.get_json(silent=True)))
+    if "error" in result:
+        return jsonify(result), 400
+    return jsonify(result)
+
+@api_bp.route('/release_task', methods=['POST'])
+def release_task():
+    """API endpoint to give up the lease on an image.
+
+    Returns:
+        JSON response with success status
+    """
+    data = request.get_json(silent=True) or {}
+    index = data.get('index')
+    if not isinstance(index, int):
+        return jsonify({"success": False, "message": "Invalid data"}), 400
+
+    if not scheduler_service.release_task(_annotator(data), index):
+        return jsonify({"success": False, "message": "No lease on this image"}), 404
+    return jsonify({"success": True, "message": "Lease released"})
+
+@api_bp.route('/tasks')
+def get_task_stats():
+    """API endpoint to get the number of queued, leased and finished images.
+
+    Returns:
+        JSON response with scheduler statistics
+    """
+    return jsonify(scheduler_service.scheduler.stats())
+
+@api_bp.route('/history/snapshots', methods=['GET', 'POST'])
+def history_snapshots():
+    """API endpoint to list annotation snapshots or snapshot the current annotations.
+
+    A POST stores the annotations currently held by the server under the
+    optional ``name`` from the JSON body.
+
+    Returns:
+        JSON response with the snapshots, or the new snapshot
+    """
+    if request.method == 'GET':
+        return jsonify({"snapshots": history_service.list_snapshots(config.HISTORY_DIR)})
+
+    data = request.get_json(silent=True) or {}
+    data_service.refresh_shards()
+    try:
+        ref = history_service.create_snapshot(config.HISTORY_DIR, list(data_service.output_data),
+                                              data.get('name'), source="server")
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    return jsonify({"success": True, "snapshot": ref})
+
+@api_bp.route('/history/diff')
+def history_diff():
+    """API endpoint to compare two annotation snapshots.
+
+    Query parameters: ``from`` and ``to`` snapshot names ("latest" for the
+    newest snapshot).
+
+    Returns:
+        JSON response with the added, removed and modified annotations
+    """
+    old_name, new_name = request.args.get('from'), request.args.get('to', 'latest')
+    if not old_name:
+        return jsonify({"error": "Missing snapshot name"}), 400
+    try:
+        return jsonify(history_service.diff_snapshots(config.HISTORY_DIR, old_name, new_name))
+    except KeyError as e:
+        return jsonify({"error": e.args[0]}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@api_bp.route('/metrics')
+def get_metrics():
+    """API endpoint exposing request and stage metrics.
+    
+    Returns:
+        Prometheus text format response
+    """
+    return Response(metrics_service.render_prometheus(), mimetype="text/plain; version=0.0.4")
\ No newline at end of file
@@ -1,123 +1,626 @@
 """Data handling service for the RefCOCOS Annotator."""
 import json
 import os
-from typing import Dict, List, Tuple, Any
-
-from refcocos_annotator.config import MULTIPLE_INSTANCES_FILE, OUTPUT_FILE
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from refcocos_annotator.config import (ANNOTATOR_SHARD_DIR, IMAGE_CACHE_DIR, IMAGE_MANIFEST_FILE,
+                                       MULTIPLE_INSTANCES_FILE, OUTPUT_FILE, RANGE_SHARD_DIR, RANGE_SHARD_SIZE,
+                                       UNDO_MAX_AGE_SECONDS, UNDO_MAX_OPERATIONS, VALIDATE_ON_LOAD,
+                                       VALIDATION_IOU_THRESHOLD)
+from refcocos_annotator.services import (migration_service, range_shard_service, shard_service, snapshot_service,
+                                         validation_service)
+from refcocos_annotator.services.metrics_service import timed
+from refcocos_annotator.utils.file_utils import atomic_writer
 
 # Global variables
 multiple_instances_data = None
 output_data = []
+# Schema version the output file was stored with when it was loaded
+output_schema_version = migration_service.SCHEMA_VERSION
+# Mapping of "val2017/<file_name>" to the image's index in multiple_instances_data
+image_path_to_index = {}
+
+# Callbacks notified after annotations change, see add_change_listener
+_change_listeners = []
+
+# (path, size, mtime) of the source files as of the data held in memory;
+# load_data skips files that have not changed since
+_instances_fingerprint = None
+_output_fingerprint = None
+
+# Per-annotator shard state: bytes consumed per shard file
+_shard_offsets = {}
+
+# Output storage partitioned by image index range, used instead of OUTPUT_FILE
+# when RANGE_SHARD_DIR is set
+_range_store = range_shard_service.RangeStore(RANGE_SHARD_DIR, RANGE_SHARD_SIZE) if RANGE_SHARD_DIR else None
+
+# Per-annotator stacks of operations that revert that annotator's saves and
+# deletes (undo) or their undos (redo), see undo()
+_undo_stacks = {}
+_redo_stacks = {}
+
+# Annotations of an image are changed under that image's lock, so annotators
+# working on different images do not wait for each other. The store lock only
+# guards the in-place changes to output_data (and reloads); the epoch counts
+# the changes that shift positions (removals, insertions, reloads and shard
+# replays), which invalidate searches made without the lock.
+_image_locks = {}
+_image_locks_guard = threading.Lock()
+_store_lock = threading.RLock()
+_store_epoch = 0
+
+# Changes to output_data are numbered; a rewrite of the output file covers
+# every change made before it started, so concurrent saves share one write
+_write_lock = threading.Lock()
+_generation = 0
+_written_generation = 0
+
+class VersionConflict(Exception):
+    """The stored annotation is not the version a change was based on."""
+
+    def __init__(self, current: Optional[Dict[str, Any]]):
+        self.current = current
+        self.version = annotation_version(current)
+        super().__init__(f"Annotation was changed since (now version {self.version})" if current is not None
+                         else "Annotation was deleted since")
+
+def annotation_version(annotation: Optional[Dict[str, Any]]) -> int:
+    """Version of a stored annotation; records saved before versioning (or missing) are version 0."""
+    return int((annotation or {}).get("version") or 0)
+
+def _image_lock(image: str) -> threading.Lock:
+    with _image_locks_guard:
+        return _image_locks.setdefault(image, threading.Lock())
+
+def _find(annotation_id: Any, image: Optional[str] = None) -> Tuple[int, Optional[Dict[str, Any]]]:
+    """Position and record of an annotation in output_data, (-1, None) if absent."""
+    for i, item in enumerate(output_data):
+        if item.get("annotation_id") == annotation_id and (image is None or item.get("image") == image):
+            return i, item
+    return -1, None
+
+def _locate(annotation_id: Any, image: Optional[str], hint: int, epoch: int) -> int:
+    """Recheck a position found without the store lock; called with it held.
+
+    The caller holds the image's lock, so no other save or delete added or
+    removed this annotation since the scan; only positions may have shifted.
+    """
+    if epoch == _store_epoch:
+        if hint < 0:
+            return -1
+        if hint < len(output_data):
+            item = output_data[hint]
+            if item.get("annotation_id") == annotation_id and (image is None or item.get("image") == image):
+                return hint
+    return _find(annotation_id, image)[0]
+
+def _changed(shifted: bool = False) -> int:
+    """Number a change to output_data; called with the store lock held.
+
+    Args:
+        shifted: The change moved other records (a removal or insertion)
+    """
+    global _generation, _store_epoch
+    if shifted:
+        _store_epoch += 1
+    _generation += 1
+    return _generation
+
+def add_change_listener(listener: Callable[[str, Optional[Dict[str, Any]], Optional[Dict[str, Any]]], None]) -> None:
+    """Register a callback that is notified after annotations change.
+
+    The callback is called as ``listener(event, annotation, previous)`` where
+    event is "load" (all annotations were replaced; both records are None),
+    "save" (previous is the replaced record or None) or "delete".
+
+    Args:
+        listener: The callback to register
+    """
+    _change_listeners.append(listener)
 
-def load_data() -> Tuple[bool, str]:
+def _notify(event: str, annotation: Optional[Dict[str, Any]] = None,
+            previous: Optional[Dict[str, Any]] = None) -> None:
+    """Notify change listeners about a mutation."""
+    for listener in _change_listeners:
+        listener(event, annotation, previous)
+
+def _fingerprint(path: str) -> Optional[Tuple[int, int]]:
+    """Size and mtime of a file, or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+def _source_fingerprint(path: str) -> Tuple[str, Optional[Tuple[int, int]]]:
+    """Fingerprint of a data file, including its path since tools repoint the module paths."""
+    return os.path.abspath(path), _fingerprint(path)
+
+def _output_source_fingerprint() -> Tuple[str, Any]:
+    """Fingerprint of the output file or, in range shard mode, of the shard directory."""
+    if _range_store is not None:
+        return os.path.abspath(_range_store.directory), _range_store.fingerprint()
+    return _source_fingerprint(OUTPUT_FILE)
+
+def refresh_shards() -> None:
+    """Merge operations appended to annotator shards since they were last read.
+
+    Other processes append to the shards independently, so the read paths
+    call this to pick up their changes lazily. If the base file was replaced
+    (e.g. by ``merge_shards.py``) everything is reloaded.
+    """
+    global _store_epoch
+
+    if not ANNOTATOR_SHARD_DIR or multiple_instances_data is None:
+        return
+
+    with _store_lock:
+        if _source_fingerprint(OUTPUT_FILE) != _output_fingerprint:
+            load_data()
+            return
+
+        paths = shard_service.list_shards(ANNOTATOR_SHARD_DIR)
+        for path in paths:
+            base = path[:-len(shard_service.MERGING_SUFFIX)]
+            if path.endswith(shard_service.MERGING_SUFFIX) and path not in _shard_offsets \
+                    and base in _shard_offsets:
+                # merge_shards.py renamed the shard: its operations up to the
+                # offset were already applied, and the live path starts over
+                _shard_offsets[path] = _shard_offsets.pop(base)
+
+        ops = []
+        for path in paths:
+            offset = _shard_offsets.get(path, 0)
+            size = _fingerprint(path)
+            if size is None or size[0] == offset:
+                continue
+            if size[0] < offset:
+                # A shard was truncated or replaced; start over
+                load_data(force=True)
+                return
+            new_ops, _shard_offsets[path] = shard_service.read_operations(path, offset)
+            ops.extend(((op.get("ts", 0), path, n), op) for n, op in enumerate(new_ops))
+        # A renamed shard's tail is older than the new shard at its old path
+        ops.sort(key=lambda item: item[0])
+        ops = [op for _, op in ops]
+
+        if ops:
+            _store_epoch += 1
+        for event, annotation, previous in shard_service.apply_operations(output_data, ops):
+            _notify(event, annotation, previous)
+
+def _build_image_path_index(images: List[Dict[str, Any]]) -> Dict[str, int]:
+    """Map image paths to their first index in the multiple instances list."""
+    index = {}
+    for i, img in enumerate(images):
+        index.setdefault("val2017/" + img["file_name"], i)
+    return index
+
+def _parse_instances(raw: bytes) -> Tuple[Dict[str, Any], Dict[str, int]]:
+    data = json.loads(raw)
+    return data, _build_image_path_index(data["images"])
+
+def _parse_output(raw: bytes) -> Tuple[int, List[Dict[str, Any]]]:
+    return migration_service.split_output(json.loads(raw))
+
+def load_data(force: bool = False) -> Tuple[bool, str]:
     """Load multiple instances data and any existing output data.
+
+    Files that have not changed since they were last loaded are kept in
+    memory, and parsed files are cached as binary snapshots so that later
+    starts do not have to parse the JSON again (see ``snapshot_service``).
+
+    Args:
+        force: Reload both files even if they have not changed
     
     Returns:
         Tuple[bool, str]: Success status and message
     """
-    global multiple_instances_data, output_data
+    global _store_epoch
+
+    # Saves and deletes wait for the reload rather than change replaced data
+    with _store_lock:
+        _store_epoch += 1
+        return _load_data(force)
+
+def _load_data(force: bool) -> Tuple[bool, str]:
+    global multiple_instances_data, output_data, output_schema_version, image_path_to_index
+    global _shard_offsets, _instances_fingerprint, _output_fingerprint
 
     try:
-        # Load multiple instances data
-        with open(MULTIPLE_INSTANCES_FILE, "r") as f:
-            multiple_instances_data = json.load(f)
+        instances_fingerprint = _source_fingerprint(MULTIPLE_INSTANCES_FILE)
+        output_fingerprint = _output_source_fingerprint()
+        first_load = force or multiple_instances_data is None
+        instances_changed = first_load or instances_fingerprint != _instances_fingerprint
+        output_changed = first_load or output_fingerprint != _output_fingerprint
+        if not instances_changed and not output_changed:
+            # Nothing to parse; only pick up new shard operations
+            refresh_shards()
+            return True, f"Loaded {len(multiple_instances_data['images'])} images with multiple instances (unchanged)"
 
-        # Try to load existing output data if it exists
-        if os.path.exists(OUTPUT_FILE):
-            with open(OUTPUT_FILE, "r") as f:
-                output_data = json.load(f)
+        # Load multiple instances data
+        if instances_changed:
+            (multiple_instances_data, image_path_to_index), _ = snapshot_service.load(
+                MULTIPLE_INSTANCES_FILE, "instances", _parse_instances)
+            _instances_fingerprint = instances_fingerprint
+
+        migrated = 0
+        if output_changed:
+            # Try to load existing output data if it exists
+            _output_fingerprint = output_fingerprint
+            if _range_store is not None:
+                if ANNOTATOR_SHARD_DIR:
+                    raise ValueError("RANGE_SHARD_DIR cannot be combined with ANNOTATOR_SHARD_DIR")
+                output_schema_version, output_data = _load_range_store()
+            elif os.path.exists(OUTPUT_FILE):
+                (output_schema_version, output_data), _ = snapshot_service.load(OUTPUT_FILE, "output", _parse_output)
+            else:
+                # If output file doesn't exist yet, initialize with empty array
+                output_schema_version, output_data = migration_service.SCHEMA_VERSION, []
+
+            # Upgrade old records in memory; they are persisted on the next write
+            if migration_service.needs_migration(output_schema_version):
+                migrated = migration_service.migrate_records(output_data, output_schema_version, image_path_to_index)
+            if _range_store is not None and migrated:
+                # Migrations can move records between shards, so write them all once
+                _range_store.write_all(output_data)
+                _output_fingerprint = _output_source_fingerprint()
+
+            # Replay the per-annotator shards on top of the merged base
+            _shard_offsets = {}
+            if ANNOTATOR_SHARD_DIR:
+                ops, _shard_offsets = shard_service.read_all_operations(shard_service.list_shards(ANNOTATOR_SHARD_DIR))
+                shard_service.apply_operations(output_data, ops)
+        else:
+            # The output file is unchanged; keep it and only pick up new shard operations
+            refresh_shards()
 
-        # If output file doesn't exist yet, initialize with empty array
-        if not isinstance(output_data, list):
-            output_data = []
+        _notify("load")
 
-        return True, f"Loaded {len(multiple_instances_data['images'])} images with multiple instances"
+        message = f"Loaded {len(multiple_instances_data['images'])} images with multiple instances"
+        if migrated:
+            message += f" (migrated {migrated} annotations from schema version {output_schema_version})"
+        if VALIDATE_ON_LOAD:
+            message += f"; {_validate()}"
+        return True, message
     except Exception as e:
         return False, f"Failed to load data: {str(e)}"
 
-def save_reference_annotation(image_id: str, annotation: Dict[str, Any]) -> Tuple[bool, str]:
+def _load_range_store() -> Tuple[int, List[Dict[str, Any]]]:
+    """Read the range shard store, creating it from OUTPUT_FILE on first use."""
+    global _output_fingerprint
+
+    if _range_store.exists():
+        with timed("range_shard_load"):
+            return _range_store.load()
+    if not os.path.exists(OUTPUT_FILE):
+        return migration_service.SCHEMA_VERSION, []
+
+    with open(OUTPUT_FILE, "rb") as f:
+        schema_version, records = _parse_output(f.read())
+    migration_service.migrate_records(records, schema_version, image_path_to_index)
+    count = _range_store.write_all(records)
+    print(f"Split {OUTPUT_FILE} into {count} range shards in {_range_store.directory}")
+    _output_fingerprint = _output_source_fingerprint()
+    return migration_service.SCHEMA_VERSION, records
+
+def _validate() -> str:
+    """Validate the loaded annotations and summarize the violations."""
+    try:
+        report = validation_service.validate_annotations(
+            output_data, multiple_instances_data["images"], image_path_to_index, VALIDATION_IOU_THRESHOLD)
+    except RuntimeError as e:
+        return f"validation skipped: {e}"
+    summary = validation_service.summarize(report)
+    print(f"Validation: {summary}")
+    return summary
+
+def _persist(op: str, annotation: Dict[str, Any], annotator: Optional[str], generation: int) -> None:
+    """Persist a mutation to the annotator's shard, the image's range shard or the whole output file.
+
+    ``generation`` is the number ``_changed`` gave the mutation.
+    """
+    global _output_fingerprint
+
+    if ANNOTATOR_SHARD_DIR:
+        with timed("output_persist"):
+            shard_service.append_operation(ANNOTATOR_SHARD_DIR, annotator, op, annotation)
+    elif _range_store is not None:
+        with timed("output_persist"):
+            _range_store.apply(op, annotation)
+        # Taken after the write, in order, so the last fingerprint covers every finished write
+        with _write_lock:
+            _output_fingerprint = _output_source_fingerprint()
+    else:
+        _write_output(generation)
+
+def _write_output(generation: Optional[int] = None) -> None:
+    """Atomically write all annotations to the output file using the current schema.
+
+    Args:
+        generation: Return without writing if a concurrent write already
+            covered the change with this number
+    """
+    global output_schema_version, _output_fingerprint, _written_generation
+
+    with _write_lock:
+        if generation is not None and _written_generation >= generation:
+            return
+        with _store_lock:
+            records = list(output_data)
+            written = _generation
+
+        with timed("output_serialize"):
+            content = json.dumps(migration_service.wrap_output(records), indent=2)
+        with timed("output_persist"):
+            with atomic_writer(OUTPUT_FILE) as f:
+                f.write(content)
+        output_schema_version = migration_service.SCHEMA_VERSION
+        _output_fingerprint = _source_fingerprint(OUTPUT_FILE)
+        _written_generation = written
+
+def save_reference_annotation(image_id: str, annotation: Dict[str, Any], annotator: Optional[str] = None,
+                              expected_version: Optional[int] = None) -> Tuple[bool, str]:
     """Save a reference annotation for the specified image.
     
+    The stored annotation gets the next ``version``.
+
     Args:
         image_id: The ID of the image
         annotation: The annotation data to save
+        annotator: Name of the annotator, selects the shard when sharding is enabled
+        expected_version: Only replace the stored annotation if it is at this version
         
     Returns:
         Tuple[bool, str]: Success status and message
-    """
-    global output_data
 
+    Raises:
+        VersionConflict: The stored annotation is missing or at another version than ``expected_version``
+    """
     try:
         # Each image can have multiple annotations
         # Check if this particular annotation already exists
-        existing_index = -1
         annotation_id = annotation.get("annotation_id", None)
-        
-        if annotation_id is not None:
-            for i, item in enumerate(output_data):
-                if item.get("image") == annotation["image"] and item.get("annotation_id") == annotation_id:
-                    existing_index = i
-                    break
-
-        # Update existing or add new
-        if existing_index >= 0:
-            output_data[existing_index] = annotation
-        else:
-            # Generate a new annotation ID if not provided
-            if not annotation_id:
-                annotation["annotation_id"] = f"{image_id}_{len([a for a in output_data if a.get('image') == 'val2017/' + annotation['file_name']])}"
-            output_data.append(annotation)
-
-        # Save to file
-        with open(OUTPUT_FILE, "w") as f:
-            json.dump(output_data, f, indent=2)
+        image = annotation["image"]
+
+        with _image_lock(image):
+            # Search without blocking other images; the position is rechecked below
+            epoch = _store_epoch
+            hint = _find(annotation_id, image)[0] if annotation_id is not None else -1
+
+            with _store_lock:
+                existing_index = _locate(annotation_id, image, hint, epoch) if annotation_id is not None else -1
+                previous = output_data[existing_index] if existing_index >= 0 else None
+                if expected_version is not None and (previous is None
+                                                     or annotation_version(previous) != expected_version):
+                    raise VersionConflict(previous)
+
+                # The server's index wins over the client's; range shards are keyed by it
+                if image in image_path_to_index:
+                    annotation["image_index"] = image_path_to_index[image]
+
+                # Lets incremental exports pick up new and edited annotations
+                annotation["updated_at"] = int(time.time() * 1000)
+                annotation["version"] = annotation_version(previous) + 1
+
+                # Update existing or add new
+                if previous is not None:
+                    output_data[existing_index] = annotation
+                else:
+                    # Generate a new annotation ID if not provided
+                    if not annotation_id:
+                        annotation["annotation_id"] = f"{image_id}_{len([a for a in output_data if a.get('image') == 'val2017/' + annotation['file_name']])}"
+                    output_data.append(annotation)
+                generation = _changed()
+
+            # Save to file
+            _persist("save", annotation, annotator, generation)
+            _notify("save", annotation, previous)
+            _record_undo(annotator, _inverse("save", annotation, previous))
 
         return True, "Annotation saved successfully"
+    except VersionConflict:
+        raise
     except Exception as e:
         return False, f"Failed to save annotation: {str(e)}"
 
-def delete_annotation(annotation_id: str) -> Tuple[bool, str]:
+def delete_annotation(annotation_id: str, annotator: Optional[str] = None,
+                      expected_version: Optional[int] = None) -> Tuple[bool, str]:
     """Delete an annotation by ID.
     
     Args:
         annotation_id: The ID of the annotation to delete
+        annotator: Name of the annotator, selects the shard when sharding is enabled
+        expected_version: Only delete the annotation if it is at this version
         
     Returns:
         Tuple[bool, str]: Success status and message
+
+    Raises:
+        VersionConflict: The annotation is at another version than ``expected_version``
     """
-    global output_data
-    
     try:
-        # Find and remove the annotation from output_data
-        found = False
-        for i, item in enumerate(output_data):
-            if item.get("annotation_id") == annotation_id:
-                output_data.pop(i)
-                found = True
-                break
-        
-        if not found:
+        # Find the annotation to learn its image, then lock that image
+        epoch = _store_epoch
+        hint, found = _find(annotation_id)
+        if found is None:
             return False, "Annotation not found"
-        
-        # Save updated data to file
-        with open(OUTPUT_FILE, "w") as f:
-            json.dump(output_data, f, indent=2)
-            
+
+        with _image_lock(found.get("image", "")):
+            with _store_lock:
+                i = _locate(annotation_id, None, hint, epoch)
+                if i < 0:
+                    return False, "Annotation not found"
+                if expected_version is not None and annotation_version(output_data[i]) != expected_version:
+                    raise VersionConflict(output_data[i])
+                removed = output_data.pop(i)
+                generation = _changed(shifted=True)
+
+            # Save updated data to file
+            _persist("delete", removed, annotator, generation)
+            _notify("delete", removed)
+            _record_undo(annotator, _inverse("delete", removed, removed, position=i))
+
         return True, "Annotation deleted successfully"
+    except VersionConflict:
+        raise
     except Exception as e:
         return False, f"Failed to delete annotation: {str(e)}"
 
-def get_image_data(index: int) -> Dict[str, Any]:
+def _inverse(op: str, annotation: Dict[str, Any], previous: Optional[Dict[str, Any]],
+             position: Optional[int] = None) -> Dict[str, Any]:
+    """Operation that reverts a save (of ``annotation`` over ``previous``) or a delete.
+
+    ``expected`` is the record the operation left in the store (None after a
+    delete); the inverse is only applied while that is still the case.
+    """
+    if op == "delete":
+        return {"op": "save", "annotation": previous, "position": position, "expected": None, "time": time.time()}
+    if previous is None:
+        return {"op": "delete", "annotation": annotation, "expected": annotation, "time": time.time()}
+    return {"op": "save", "annotation": previous, "expected": annotation, "time": time.time()}
+
+def _session_stack(stacks: Dict[str, deque], annotator: Optional[str]) -> deque:
+    """An annotator's undo or redo stack with expired operations dropped."""
+    stack = stacks.setdefault(shard_service.sanitize_annotator(annotator), deque(maxlen=UNDO_MAX_OPERATIONS))
+    cutoff = time.time() - UNDO_MAX_AGE_SECONDS
+    while stack and stack[0]["time"] < cutoff:
+        stack.popleft()
+    return stack
+
+def _record_undo(annotator: Optional[str], entry: Dict[str, Any]) -> None:
+    """Remember how to revert an annotator's operation; a new operation invalidates their redo stack."""
+    _session_stack(_undo_stacks, annotator).append(entry)
+    _session_stack(_redo_stacks, annotator).clear()
+
+def _apply_inverse(entry: Dict[str, Any],
+                   annotator: Optional[str]) -> Tuple[bool, str, Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """Apply one recorded inverse operation to the in-memory store and persist just that change.
+
+    Returns:
+        Tuple: Success status, message, the inverse of the applied operation
+        (for the opposite stack) and the record as stored (the restored
+        annotation with its new version, or the deleted one)
+    """
+    annotation_id = entry["annotation"].get("annotation_id")
+    with _image_lock(entry["annotation"].get("image", "")):
+        epoch = _store_epoch
+        hint = _find(annotation_id)[0]
+
+        with _store_lock:
+            index = _locate(annotation_id, None, hint, epoch)
+            current = output_data[index] if index >= 0 else None
+            if current != entry["expected"]:
+                return False, "Annotation was changed since; nothing was reverted", None, None
+
+            shifted = entry["op"] == "delete" or current is None
+            if entry["op"] == "delete":
+                output_data.pop(index)
+            else:
+                annotation = dict(entry["annotation"])
+                annotation["updated_at"] = int(time.time() * 1000)
+                # Restoring an older record still moves the version forward
+                annotation["version"] = max(annotation_version(current), annotation_version(annotation)) + 1
+                if current is not None:
+                    output_data[index] = annotation
+                else:
+                    position = entry.get("position")
+                    output_data.insert(len(output_data) if position is None else min(position, len(output_data)),
+                                       annotation)
+            generation = _changed(shifted)
+
+        if entry["op"] == "delete":
+            _persist("delete", current, annotator, generation)
+            _notify("delete", current)
+            return True, "Annotation deleted", _inverse("delete", current, current, position=index), current
+
+        _persist("save", annotation, annotator, generation)
+        _notify("save", annotation, current)
+        return True, "Annotation restored", _inverse("save", annotation, current), annotation
+
+def _undo_or_redo(annotator: Optional[str], from_stacks: Dict[str, deque],
+                  to_stacks: Dict[str, deque], action: str) -> Dict[str, Any]:
+    refresh_shards()
+    stack = _session_stack(from_stacks, annotator)
+    if not stack:
+        return {"success": False, "message": f"Nothing to {action}", **undo_state(annotator)}
+
+    entry = stack.pop()
+    try:
+        success, message, inverse, stored = _apply_inverse(entry, annotator)
+    except Exception as e:
+        stack.append(entry)
+        return {"success": False, "message": f"Failed to {action}: {str(e)}", "op": entry["op"],
+                **undo_state(annotator)}
+    if success:
+        _session_stack(to_stacks, annotator).append(inverse)
+
+    # Send what was stored, with its new version, so the client can base its next change on it
+    annotation = stored if success else entry["annotation"]
+    index = image_path_to_index.get(annotation.get("image", ""))
+    result = {
+        "success": success,
+        "message": message,
+        "op": entry["op"],
+        "annotation": annotation if entry["op"] == "save" else {"annotation_id": annotation.get("annotation_id")},
+        "image_index": index,
+        "image_id": multiple_instances_data["images"][index]["image_id"] if index is not None else None,
+        **undo_state(annotator),
+    }
+    if success and entry["op"] == "save":
+        result["version"] = annotation["version"]
+    return result
+
+def undo(annotator: Optional[str] = None) -> Dict[str, Any]:
+    """Revert the annotator's most recent save or delete.
+
+    Only the single affected annotation is changed and persisted. An
+    operation is not reverted if someone changed the annotation since.
+
+    Args:
+        annotator: Name of the annotator whose session is undone
+
+    Returns:
+        Dict: Success status, message, the applied operation and the
+        affected annotation and image, plus the remaining undo/redo depth
+    """
+    return _undo_or_redo(annotator, _undo_stacks, _redo_stacks, "undo")
+
+def redo(annotator: Optional[str] = None) -> Dict[str, Any]:
+    """Re-apply the annotator's most recently undone operation, see ``undo``."""
+    return _undo_or_redo(annotator, _redo_stacks, _undo_stacks, "redo")
+
+def undo_state(annotator: Optional[str] = None) -> Dict[str, int]:
+    """Number of operations the annotator can undo and redo."""
+    return {"undo": len(_session_stack(_undo_stacks, annotator)),
+            "redo": len(_session_stack(_redo_stacks, annotator))}
+
+def get_image_data(index: int, max_width: Optional[int] = None, max_height: Optional[int] = None,
+                   quality: Optional[int] = None, embed: bool = True) -> Dict[str, Any]:
     """Get image data for the given index.
     
+    Boxes are always in original image coordinates; ``scale`` maps them to
+    the pixels of the delivered, possibly downscaled, image.
+
     Args:
         index: The index of the image in the dataset
+        max_width: Downscale the image to about this width (see ``image_service.snap_options``)
+        max_height: Downscale the image to about this height
+        quality: JPEG quality of the delivered image
+        embed: Include the image as a base64 data URI; otherwise the client
+            fetches it separately (see ``get_image_file``)
         
     Returns:
         Dict: Image data or error
     """
-    from refcocos_annotator.services.image_service import encode_image
-    
+    from refcocos_annotator.services.image_service import encode_image, fit_scale, snap_options
+
+    # The same bounds as the cached transcodes, so ``scale`` matches get_image_file
+    max_width, max_height, quality = snap_options(max_width, max_height, quality)
     if not multiple_instances_data or index >= len(multiple_instances_data["images"]):
         return {"error": "Image not found"}
 
@@ -127,14 +630,10 @@ def get_image_data(index: int) -> Dict[str, Any]:
     image_path = image_data["path"]
 
     try:
-        # Get base64 encoded image
-        img_str = encode_image(image_path)
-
         # Create response with image data and all information
         result = {
             "index": index,
             "total_images": len(multiple_instances_data["images"]),
-            "image_data": f"data:image/jpeg;base64,{img_str}",
             "image_id": image_data["image_id"],
             "file_name": image_data["file_name"],
             "width": image_data["width"],
@@ -143,31 +642,65 @@ def get_image_data(index: int) -> Dict[str, Any]:
             "categories_with_multiple_instances": image_data["categories_with_multiple_instances"]
         }
 
+        if embed:
+            # Get base64 encoded image
+            img_str, result["scale"] = encode_image(image_path, max_width, max_height, quality)
+            result["image_data"] = f"data:image/jpeg;base64,{img_str}"
+        else:
+            width = image_data["width"]
+            result["scale"] = max(1, round(width * fit_scale(width, image_data["height"], max_width, max_height))) / width
+
         return result
     except Exception as e:
         return {"error": f"Failed to load image: {str(e)}"}
 
+def get_image_file(index: int, fmt: str, max_width: Optional[int] = None, max_height: Optional[int] = None,
+                   quality: Optional[int] = None) -> Dict[str, Any]:
+    """Get the cached transcode of an image in the given format.
+
+    Args:
+        index: The index of the image in the dataset
+        fmt: Output format, a key of ``image_service.IMAGE_FORMATS``
+        max_width: Downscale the image to about this width (see ``image_service.snap_options``)
+        max_height: Downscale the image to about this height
+        quality: Encoder quality of the delivered image
+
+    Returns:
+        Dict: Path, MIME type and scale of the transcoded file, or error
+    """
+    from refcocos_annotator.services.image_service import IMAGE_FORMATS, transcode_image
+
+    if not multiple_instances_data or index >= len(multiple_instances_data["images"]):
+        return {"error": "Image not found"}
+
+    try:
+        path, scale, _ = transcode_image(IMAGE_CACHE_DIR, multiple_instances_data["images"][index]["path"], fmt,
+                                         max_width, max_height, quality, IMAGE_MANIFEST_FILE)
+        return {"path": path, "mimetype": IMAGE_FORMATS[fmt][0], "scale": scale}
+    except Exception as e:
+        return {"error": f"Failed to load image: {str(e)}"}
+
 def get_saved_data() -> Dict[str, List[Dict[str, Any]]]:
     """Get all saved annotations grouped by image ID.
     
     Returns:
         Dict: Annotations by image ID
     """
+    refresh_shards()
+
     # Create a dictionary mapping image IDs to saved annotations (multiple per image)
     saved_data = {}
 
+    images = multiple_instances_data["images"]
     for item in output_data:
-        # Extract image ID from path
-        image_path = item.get("image", "")
-        if image_path:
-            # Try to find matching image from multiple_instances_data
-            for img in multiple_instances_data["images"]:
-                if "val2017/" + img["file_name"] == image_path:
-                    if img["image_id"] not in saved_data:
-                        saved_data[img["image_id"]] = []
-                    
-                    saved_data[img["image_id"]].append(item)
-                    break
+        # Find the matching image from multiple_instances_data by its path
+        index = image_path_to_index.get(item.get("image", ""))
+        if index is not None:
+            image_id = images[index]["image_id"]
+            if image_id not in saved_data:
+                saved_data[image_id] = []
+
+            saved_data[image_id].append(item)
 
     return saved_data
 
@@ -180,6 +713,8 @@ def get_last_saved_index() -> int:
     if not multiple_instances_data:
         return 0
 
+    refresh_shards()
+
     # If no output data, return the first image
     if not output_data:
         return 0
@@ -190,14 +725,12 @@ def get_last_saved_index() -> int:
         image_id_to_index[img["image_id"]] = i
 
     # Find all image IDs that have saved annotations
+    images = multiple_instances_data["images"]
     saved_image_ids = set()
     for item in output_data:
-        image_path = item.get("image", "")
-        if image_path:
-            for img in multiple_instances_data["images"]:
-                if "val2017/" + img["file_name"] == image_path:
-                    saved_image_ids.add(img["image_id"])
-                    break
+        index = image_path_to_index.get(item.get("image", ""))
+        if index is not None:
+            saved_image_ids.add(images[index]["image_id"])
 
     # Find the highest index (last in sequence) with saved annotations
     last_index = 0
@@ -213,6 +746,8 @@ def get_last_created_annotation_index() -> int:
     Returns:
         int: Index of the image with the most recently created annotation
     """
+    refresh_shards()
+
     if not multiple_instances_data or not output_data:
         return 0
         
@@ -225,13 +760,9 @@ def get_last_created_annotation_index() -> int:
     # Get the image path from the annotation
     image_path = last_annotation.get("image", "")
     
-    # Find the corresponding image in multiple_instances_data
-    for i, img in enumerate(multiple_instances_data["images"]):
-        if "val2017/" + img["file_name"] == image_path:
-            return i
-            
-    # If not found, return the first image
-    return 0
+    # Find the corresponding image in multiple_instances_data,
+    # falling back to the first image if it is not found
+    return image_path_to_index.get(image_path, 0)
 
 def get_image_status() -> Dict[str, Any]:
     """Get image status information.
@@ -242,6 +773,8 @@ def get_image_status() -> Dict[str, Any]:
     if not multiple_instances_data:
         return {"error": "No data loaded"}
 
+    refresh_shards()
+
     # Get total number of images
     total_images = len(multiple_instances_data["images"])
 
@@ -249,23 +782,20 @@ def get_image_status() -> Dict[str, Any]:
     saved_image_ids = []
     saved_annotations = {}
     
+    images = multiple_instances_data["images"]
     for item in output_data:
-        # Extract image ID from path
-        image_path = item.get("image", "")
-        if image_path:
-            # Try to find matching image from multiple_instances_data
-            for img in multiple_instances_data["images"]:
-                if "val2017/" + img["file_name"] == image_path:
-                    img_id = img["image_id"]
-                    if img_id not in saved_image_ids:
-                        saved_image_ids.append(img_id)
-                    
-                    # Group annotations by image_id
-                    if img_id not in saved_annotations:
-                        saved_annotations[img_id] = []
-                    
-                    saved_annotations[img_id].append(item)
-                    break
+        # Find the matching image from multiple_instances_data by its path
+        index = image_path_to_index.get(item.get("image", ""))
+        if index is not None:
+            img_id = images[index]["image_id"]
+
+            # Group annotations by image_id; saved_annotations doubles as the
+            # membership check so saved_image_ids keeps first-seen order
+            if img_id not in saved_annotations:
+                saved_image_ids.append(img_id)
+                saved_annotations[img_id] = []
+
+            saved_annotations[img_id].append(item)
 
     return {
         "total_images": total_images,
@@ -0,0 +1,355 @@
+"""Near-duplicate caption detection for the RefCOCOS Annotator.
+
+Captions are reduced to word unigram and bigram shingles, leaving out the
+ones made only of stop words, and sketched with MinHash using independent
+hash functions. Locality-sensitive hashing over bands of the signature finds
+candidate pairs without comparing every caption to every other one;
+candidates are confirmed with the exact Jaccard similarity of their shingle
+sets. The index follows ``data_service`` changes incrementally.
+"""
+import random
+import threading
+from functools import lru_cache
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from refcocos_annotator.services import data_service
+from refcocos_annotator.services.query_service import AnnotationKey, annotation_key, tokenize
+
+# Signature length and LSH banding; with 10 bands of 6 rows, pairs with a
+# Jaccard similarity of 0.8 share a band with probability 0.95 and pairs at
+# 0.4 with probability 0.04, so candidate sets stay small as the index grows
+NUM_HASHES = 60
+BANDS = 10
+ROWS = NUM_HASHES // BANDS
+
+# Minimum Jaccard similarity for two captions to count as near-duplicates
+DEFAULT_THRESHOLD = 0.8
+
+# Shingles made only of these words occur in most captions and would put
+# unrelated captions into the same buckets
+STOP_WORDS = frozenset("a an and are as at be by for from in is it its of on or that the their this to was "
+                       "which who whose with".split())
+
+_HASH_MASK = (1 << 64) - 1
+# Multiply-add-shift hash functions with odd multipliers
+_rng = random.Random(0x5EED)
+_HASH_PARAMS = [(_rng.getrandbits(64) | 1, _rng.getrandbits(64)) for _ in range(NUM_HASHES)]
+
+
+def shingles(caption: str) -> FrozenSet[str]:
+    """Word unigram and bigram shingles of a caption, without stop-word-only ones.
+
+    Args:
+        caption: Caption text
+
+    Returns:
+        FrozenSet[str]: The caption's shingles; all of them if the caption
+        consists of stop words only
+    """
+    tokens = tokenize(caption)
+    bigrams = list(zip(tokens, tokens[1:]))
+    kept = frozenset([t for t in tokens if t not in STOP_WORDS]
+                     + [f"{a} {b}" for a, b in bigrams if a not in STOP_WORDS or b not in STOP_WORDS])
+    return kept or frozenset(tokens + [f"{a} {b}" for a, b in bigrams])
+
+
+@lru_cache(maxsize=4096)
+def _shingle_hashes(shingle: str) -> Tuple[int, ...]:
+    """Values of all hash functions for one shingle; common shingles are cached."""
+    # The index only lives in memory, so Python's per-process string hash is sufficient
+    h = hash(shingle) & _HASH_MASK
+    return tuple(((a * h + b) & _HASH_MASK) >> 32 for a, b in _HASH_PARAMS)
+
+
+def signature(caption_shingles: FrozenSet[str]) -> Optional[Tuple[int, ...]]:
+    """MinHash signature of a shingle set.
+
+    Position ``i`` is the minimum of the ``i``-th hash function over the
+    shingles, so two sets agree at a position with probability equal to
+    their Jaccard similarity.
+
+    Args:
+        caption_shingles: Shingle set of a caption
+
+    Returns:
+        Tuple[int, ...]: The signature, or None for an empty set
+    """
+    if not caption_shingles:
+        return None
+    return tuple(map(min, zip(*map(_shingle_hashes, caption_shingles))))
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    """Jaccard similarity of two shingle sets."""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class CaptionIndex:
+    """MinHash/LSH index over annotation captions."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.records: Dict[AnnotationKey, Tuple[Dict[str, Any], FrozenSet[str], Optional[Tuple[int, ...]]]] = {}
+        self.buckets: List[Dict[Tuple[int, ...], Set[AnnotationKey]]] = [{} for _ in range(BANDS)]
+        # While a background build runs: changes reported meanwhile, replayed
+        # onto the new index when it is swapped in
+        self._pending: Optional[List[Tuple[str, Dict[str, Any]]]] = None
+        self._build_generation = 0
+        self._ready = threading.Event()
+        self._ready.set()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.records = {}
+            self.buckets = [{} for _ in range(BANDS)]
+
+    def invalidate(self, source: Callable[[], Iterable[Dict[str, Any]]]) -> None:
+        """Rebuild the index from ``source()`` on a background thread.
+
+        Signatures depend on the per-process string hash, so they cannot be
+        saved with the data snapshot, and building them for a large dataset
+        takes seconds. Until the build is done, lookups find nothing and
+        changes are queued rather than waiting for it.
+        """
+        with self._lock:
+            self._build_generation += 1
+            generation = self._build_generation
+            self.clear()
+            self._pending = []
+            self._ready.clear()
+        threading.Thread(target=self._build, args=(generation, source), name="caption-index", daemon=True).start()
+
+    def _build(self, generation: int, source: Callable[[], Iterable[Dict[str, Any]]]) -> None:
+        fresh = CaptionIndex()
+        try:
+            # Copy first: the source may be changed by a save while building
+            fresh.rebuild(list(source()))
+        except Exception as e:
+            print(f"Warning: Failed to build the caption index: {e}")
+        with self._lock:
+            if generation != self._build_generation:
+                # Another load started a newer build
+                return
+            self.records, self.buckets = fresh.records, fresh.buckets
+            pending, self._pending = self._pending, None
+            for op, annotation in pending:
+                # Replaying is idempotent for changes the copy already had
+                (self.add if op == "add" else self.remove)(annotation)
+            self._ready.set()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Wait for a background build; returns whether the index is complete."""
+        return self._ready.wait(timeout)
+
+    def _queue(self, op: str, annotation: Dict[str, Any]) -> bool:
+        """Queue a change while a build runs; called with the lock held."""
+        if self._pending is None:
+            return False
+        self._pending.append((op, annotation))
+        return True
+
+    def add(self, annotation: Dict[str, Any]) -> None:
+        with self._lock:
+            if self._queue("add", annotation):
+                return
+        key = annotation_key(annotation)
+        caption_shingles = shingles(annotation.get("normal_caption", ""))
+        sig = signature(caption_shingles)
+        with self._lock:
+            if self._queue("add", annotation):
+                return
+            if key in self.records:
+                self.remove(self.records[key][0])
+            self.records[key] = (annotation, caption_shingles, sig)
+            if sig is not None:
+                for band in range(BANDS):
+                    self.buckets[band].setdefault(sig[band * ROWS:(band + 1) * ROWS], set()).add(key)
+
+    def remove(self, annotation: Dict[str, Any]) -> None:
+        key = annotation_key(annotation)
+        with self._lock:
+            if self._queue("remove", annotation):
+                return
+            entry = self.records.get(key)
+            if entry is None or entry[0] is not annotation:
+                return
+            del self.records[key]
+            sig = entry[2]
+            if sig is not None:
+                for band in range(BANDS):
+                    band_key = sig[band * ROWS:(band + 1) * ROWS]
+                    keys = self.buckets[band].get(band_key)
+                    if keys is not None:
+                        keys.discard(key)
+                        if not keys:
+                            del self.buckets[band][band_key]
+
+    def rebuild(self, annotations) -> None:
+        with self._lock:
+            # Supersedes a background build
+            self._build_generation += 1
+            self._pending = None
+            self._ready.set()
+            self.clear()
+            for annotation in annotations:
+                self.add(annotation)
+
+    def _candidates(self, sig: Tuple[int, ...]) -> Set[AnnotationKey]:
+        candidates = set()
+        for band in range(BANDS):
+            candidates |= self.buckets[band].get(sig[band * ROWS:(band + 1) * ROWS], set())
+        return candidates
+
+    def find_similar(self, caption: str, image: Optional[str] = None,
+                     exclude: Optional[AnnotationKey] = None,
+                     threshold: float = DEFAULT_THRESHOLD) -> List[Dict[str, Any]]:
+        """Find indexed captions similar to ``caption``.
+
+        Does not wait for a background build; until it is done nothing is found.
+
+        Args:
+            caption: Caption to look up
+            image: Only return matches on this image
+            exclude: Key of an annotation to leave out (usually the caption's own)
+            threshold: Minimum Jaccard similarity
+
+        Returns:
+            List[Dict]: Matching annotations with their similarity, most similar first
+        """
+        caption_shingles = shingles(caption)
+        sig = signature(caption_shingles)
+        if sig is None:
+            return []
+
+        matches = []
+        with self._lock:
+            for key in self._candidates(sig):
+                if key == exclude or (image is not None and key[0] != image):
+                    continue
+                annotation, other_shingles, _ = self.records[key]
+                similarity = jaccard(caption_shingles, other_shingles)
+                if similarity >= threshold:
+                    matches.append(_summary(annotation, similarity))
+
+        matches.sort(key=lambda m: -m["similarity"])
+        return matches
+
+    def clusters(self, threshold: float = DEFAULT_THRESHOLD, same_image: bool = False) -> List[List[Dict[str, Any]]]:
+        """Group indexed captions into clusters of near-duplicates.
+
+        Only pairs that share an LSH bucket are compared, so the work depends
+        on the bucket sizes rather than on the square of the dataset size.
+        Waits for a background build to finish.
+
+        Args:
+            threshold: Minimum Jaccard similarity for two captions to be linked
+            same_image: Only link captions on the same image
+
+        Returns:
+            List[List[Dict]]: Clusters of two or more annotations, largest first
+        """
+        parent: Dict[AnnotationKey, AnnotationKey] = {}
+
+        def find(key):
+            while parent.get(key, key) != key:
+                parent[key] = parent.get(parent[key], parent[key])
+                key = parent[key]
+            return key
+
+        def link(a, b):
+            parent.setdefault(a, a)
+            parent.setdefault(b, b)
+            parent[find(a)] = find(b)
+
+        self.wait_ready()
+        with self._lock:
+            # Captions with identical shingles are linked directly; only one
+            # caption per distinct shingle set (and image, if same_image) is
+            # compared pairwise, so repeated captions do not blow up buckets
+            representative: Dict[Tuple[Any, FrozenSet[str]], AnnotationKey] = {}
+            for key, (_, caption_shingles, sig) in self.records.items():
+                if sig is None:
+                    continue
+                group = (key[0] if same_image else None, caption_shingles)
+                first = representative.setdefault(group, key)
+                if first != key:
+                    link(first, key)
+            distinct = set(representative.values())
+
+            compared = set()
+            for band_buckets in self.buckets:
+                for keys in band_buckets.values():
+                    members = sorted(keys & distinct) if len(keys) > 1 else ()
+                    for i, a in enumerate(members):
+                        for b in members[i + 1:]:
+                            if (a, b) in compared or (same_image and a[0] != b[0]):
+                                continue
+                            compared.add((a, b))
+                            if jaccard(self.records[a][1], self.records[b][1]) >= threshold:
+                                link(a, b)
+
+            groups: Dict[AnnotationKey, List[AnnotationKey]] = {}
+            for key in parent:
+                groups.setdefault(find(key), []).append(key)
+
+            clusters = []
+            for members in groups.values():
+                if len(members) < 2:
+                    continue
+                first = self.records[members[0]][1]
+                clusters.append([_summary(self.records[key][0], jaccard(first, self.records[key][1]))
+                                 for key in sorted(members)])
+
+        clusters.sort(key=len, reverse=True)
+        return clusters
+
+
+def _summary(annotation: Dict[str, Any], similarity: float) -> Dict[str, Any]:
+    return {
+        "annotation_id": annotation.get("annotation_id"),
+        "image": annotation.get("image"),
+        "image_index": annotation.get("image_index"),
+        "normal_caption": annotation.get("normal_caption", ""),
+        "similarity": round(similarity, 3),
+    }
+
+
+# Index over the captions currently held by data_service
+caption_index = CaptionIndex()
+
+
+def _handle_change(event: str, annotation: Optional[Dict[str, Any]],
+                   previous: Optional[Dict[str, Any]]) -> None:
+    if event == "load":
+        caption_index.invalidate(lambda: data_service.output_data)
+    elif event == "save":
+        if previous is not None:
+            caption_index.remove(previous)
+        caption_index.add(annotation)
+    elif event == "delete":
+        caption_index.remove(annotation)
+
+
+data_service.add_change_listener(_handle_change)
+caption_index.invalidate(lambda: data_service.output_data)
+
+
+def duplicate_warnings(annotation: Dict[str, Any], threshold: float = DEFAULT_THRESHOLD) -> List[str]:
+    """Warnings for captions on the same image that are near-duplicates of ``annotation``'s.
+
+    Args:
+        annotation: A saved annotation
+        threshold: Minimum Jaccard similarity
+
+    Returns:
+        List[str]: One warning per colliding annotation
+    """
+    matches = caption_index.find_similar(annotation.get("normal_caption", ""), image=annotation.get("image"),
+                                         exclude=annotation_key(annotation), threshold=threshold)
+    return [
+        f"Caption is a near-duplicate of annotation {m['annotation_id']} "
+        f"(similarity {m['similarity']:.2f}): {m['normal_caption']}"
+        for m in matches
+    ]
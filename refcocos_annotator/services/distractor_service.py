@@ -0,0 +1,110 @@
+"""Distractor counts for the RefCOCOS Annotator.
+
+The ``distractors`` category of an annotation follows from the image's
+``categories_with_multiple_instances``, the same way the UI computes it:
+
+- an annotation whose box is one of the instances (or matches one by IoU,
+  for drawn boxes) has the other instances of that category as distractors,
+  i.e. the category's count minus one;
+- an empty case annotation (no box) has every instance on the image as a
+  distractor.
+
+``compute_distractors`` handles a single annotation using the per-image
+instance grids of ``match_service``. ``expected_distractors`` computes the
+counts for a whole annotation set in one vectorized pass (requires numpy).
+"""
+from typing import Any, Dict, List, Optional
+
+from refcocos_annotator.services import data_service, match_service, validation_service
+
+# A drawn box counts as an instance from this IoU on
+DEFAULT_IOU_THRESHOLD = match_service.DEFAULT_SNAP_IOU
+# Values the UI stores when it could not compute a count
+UNSET_VALUES = (None, "", "N/A")
+
+
+def _is_empty_case(annotation: Dict[str, Any]) -> bool:
+    return not annotation.get("solution") and bool((annotation.get("categories") or {}).get("empty_case", True))
+
+
+def _total_instances(image_data: Dict[str, Any]) -> int:
+    return sum(category.get("count", len(category.get("instances", [])))
+               for category in image_data.get("categories_with_multiple_instances", []))
+
+
+def compute_distractors(annotation: Dict[str, Any], iou_threshold: float = DEFAULT_IOU_THRESHOLD) -> Optional[int]:
+    """Distractor count of an annotation from its image's instances.
+
+    Args:
+        annotation: The annotation; its image is looked up by path
+        iou_threshold: Minimum IoU for a drawn box to count as an instance
+
+    Returns:
+        int: The distractor count, or None if the image is unknown or the box matches no instance
+    """
+    index = data_service.image_path_to_index.get(annotation.get("image", ""))
+    if index is None:
+        return None
+    image_data = data_service.multiple_instances_data["images"][index]
+    if _is_empty_case(annotation):
+        return _total_instances(image_data)
+
+    box = validation_service.parse_box(annotation.get("solution"))
+    instance_index = match_service.get_index(index)
+    if box is None or instance_index is None:
+        return None
+    match = instance_index.match(box, iou_threshold)["snap"]
+    if match is None:
+        return None
+    return match["category_count"] - 1
+
+
+def fill_distractors(annotation: Dict[str, Any]) -> bool:
+    """Fill in an annotation's distractor count if it was left unset.
+
+    Returns:
+        bool: Whether the count was filled in
+    """
+    categories = annotation.get("categories")
+    if not isinstance(categories, dict) or categories.get("distractors") not in UNSET_VALUES:
+        return False
+    count = compute_distractors(annotation)
+    if count is None:
+        return False
+    categories["distractors"] = str(count)
+    return True
+
+
+def expected_distractors(annotations: List[Dict[str, Any]], images: List[Dict[str, Any]],
+                         image_path_to_index: Dict[str, int], iou_threshold: float = DEFAULT_IOU_THRESHOLD):
+    """Distractor counts of many annotations in one vectorized pass.
+
+    Args:
+        annotations: Annotations to compute counts for
+        images: Image entries from the multiple instances file
+        image_path_to_index: Mapping of "val2017/<file_name>" to image index
+        iou_threshold: Minimum IoU for a drawn box to count as an instance
+
+    Returns:
+        numpy.ndarray: One count per annotation, -1 where it cannot be derived
+    """
+    np = validation_service.require_numpy()
+
+    image_index = np.array([image_path_to_index.get(a.get("image", ""), -1) for a in annotations], dtype=np.int64)
+    empty = np.array([_is_empty_case(a) for a in annotations], dtype=bool)
+    solutions = validation_service.solution_array(np, annotations)
+    instances, offsets, category_counts = validation_service.instance_arrays(np, images)
+    totals = np.array([_total_instances(image) for image in images], dtype=np.int64)
+
+    expected = np.full(len(annotations), -1, dtype=np.int64)
+    known = image_index >= 0
+    expected[known & empty] = totals[image_index[known & empty]]
+
+    boxed = known & ~empty & ~np.isnan(solutions).any(axis=1)
+    if boxed.any():
+        best_iou, best_instance = validation_service.best_matches(
+            np, solutions[boxed], image_index[boxed], instances, offsets)
+        matched = best_iou >= iou_threshold
+        rows = np.flatnonzero(boxed)[matched]
+        expected[rows] = category_counts[best_instance[matched]] - 1
+    return expected
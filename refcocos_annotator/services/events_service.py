@@ -0,0 +1,141 @@
+"""Annotation change events for the RefCOCOS Annotator.
+
+Every save and delete in ``data_service`` is published as an event with a
+monotonically increasing store version. Recent events are kept in a bounded
+replay buffer so that a client streaming them from ``/api/events`` can
+reconnect and resume from the last version it saw; if that version has
+already dropped out of the buffer the client is told to reload instead.
+"""
+import json
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Iterator, List, Optional
+
+from refcocos_annotator import config
+from refcocos_annotator.services import data_service
+
+# How long a stream waits for new events before sending a keep-alive comment
+KEEPALIVE_SECONDS = 15
+
+# Reconnection delay suggested to EventSource clients, in milliseconds
+RETRY_MS = 3000
+
+Event = Dict[str, Any]
+
+
+class EventBus:
+    """Versioned publish/subscribe with a bounded replay buffer."""
+
+    def __init__(self, buffer_size: int):
+        self._condition = threading.Condition()
+        self._events = deque(maxlen=buffer_size)
+        self.version = 0
+
+    def publish(self, event_type: str, payload: Dict[str, Any]) -> Event:
+        """Append an event and wake up waiting streams.
+
+        Args:
+            event_type: "save", "delete" or "reload"
+            payload: Event data
+
+        Returns:
+            Dict: The published event including its version
+        """
+        with self._condition:
+            self.version += 1
+            event = {"version": self.version, "type": event_type, "time": time.time(), **payload}
+            self._events.append(event)
+            self._condition.notify_all()
+        return event
+
+    def since(self, version: int) -> Optional[List[Event]]:
+        """Events published after ``version``.
+
+        Returns:
+            List[Dict]: Missed events in order, or None if some of them are no
+            longer buffered and the client has to reload
+        """
+        with self._condition:
+            if version == self.version:
+                return []
+            if version > self.version:
+                # A version from before a server restart
+                return None
+            oldest = self._events[0]["version"] if self._events else self.version + 1
+            if version < oldest - 1:
+                return None
+            # Versions are contiguous, so the missed events are the buffer tail
+            return list(self._events)[len(self._events) - (self.version - version):]
+
+    def wait(self, version: int, timeout: float) -> bool:
+        """Block until an event newer than ``version`` exists or ``timeout`` passes."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self.version > version, timeout)
+
+
+event_bus = EventBus(config.EVENT_BUFFER_SIZE)
+
+
+def _image_id(annotation: Dict[str, Any]) -> Optional[str]:
+    """ID of the image an annotation belongs to, as used by ``/api/saved_data``."""
+    index = data_service.image_path_to_index.get(annotation.get("image", ""))
+    if index is None:
+        return None
+    return data_service.multiple_instances_data["images"][index]["image_id"]
+
+
+def _handle_change(event: str, annotation: Optional[Dict[str, Any]],
+                   previous: Optional[Dict[str, Any]]) -> None:
+    if event == "load":
+        # Everything may have changed; clients refetch /api/saved_data
+        event_bus.publish("reload", {})
+    elif event == "save":
+        event_bus.publish("save", {"image_id": _image_id(annotation), "annotation": annotation})
+    elif event == "delete":
+        event_bus.publish("delete", {
+            "image_id": _image_id(annotation),
+            "image": annotation.get("image"),
+            "annotation_id": annotation.get("annotation_id"),
+        })
+
+
+data_service.add_change_listener(_handle_change)
+
+
+def format_event(event: Event) -> str:
+    """Encode an event in the Server-Sent Events wire format."""
+    return f"id: {event['version']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+def stream_events(since: Optional[int]) -> Iterator[str]:
+    """Generate the SSE stream for one client.
+
+    Args:
+        since: Last version the client has seen, or None to start from now
+
+    Yields:
+        str: Encoded SSE messages
+    """
+    version = event_bus.version if since is None else since
+    yield f"retry: {RETRY_MS}\n\n"
+    # Tell the client which version its snapshot corresponds to
+    yield format_event({"version": version, "type": "hello", "current": event_bus.version})
+
+    while True:
+        events = event_bus.since(version)
+        if events is None:
+            # The client fell too far behind; it has to refetch everything
+            version = event_bus.version
+            yield format_event({"version": version, "type": "reload"})
+            continue
+
+        for event in events:
+            yield format_event(event)
+            version = event["version"]
+
+        if not event_bus.wait(version, KEEPALIVE_SECONDS):
+            # Pick up saves from other processes writing annotator shards
+            data_service.refresh_shards()
+            if event_bus.version == version:
+                yield ": keep-alive\n\n"
@@ -0,0 +1,273 @@
+"""Content-addressed history of the annotation set.
+
+A snapshot stores every annotation under the hash of its content, so
+records that did not change are stored once and shared by all snapshots.
+The records of a snapshot are organised in a two-level hash tree (Merkle
+tree) keyed by image and annotation ID (IDs are only unique per image): the
+root lists ``FANOUT`` nodes, each node lists ``FANOUT`` leaves, and each leaf
+lists the image, annotation ID, record hash and storage location of the
+annotations whose key hashes to it. Nodes and
+leaves are content-addressed too, so identical subtrees have identical
+hashes.
+
+Diffing two snapshots walks both trees and only descends into subtrees whose
+hashes differ, so its cost grows with the number of changed records rather
+than with the size of the dataset.
+
+Records new in a snapshot are appended to one pack file instead of one file
+each. Layout of ``HISTORY_DIR``::
+
+    packs/<id>.pack                records, one JSON line each
+    packs/<id>.idx                 record hash -> offset and length in the pack
+    objects/<2 hex>/<hash>.json    roots, nodes and leaves
+    snapshots/<name>.json          snapshot name, time, source and root hash
+"""
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from refcocos_annotator.utils.file_utils import atomic_write_json, atomic_writer
+
+FANOUT = 64
+# Layout of the leaf rows; snapshots of other formats cannot be diffed
+# against each other (those without one are format 1, keyed by ID alone)
+TREE_FORMAT = 2
+SNAPSHOT_NAME_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,100}$")
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def _canonical(obj: Any) -> bytes:
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def object_path(history_dir: str, digest: str) -> str:
+    """File of a stored tree object."""
+    return os.path.join(history_dir, "objects", digest[:2], digest[2:] + ".json")
+
+
+def _put(history_dir: str, obj: Any) -> str:
+    """Store a tree object unless an identical one exists and return its hash."""
+    data = _canonical(obj)
+    digest = _digest(data)
+    path = object_path(history_dir, digest)
+    if not os.path.exists(path):
+        with atomic_writer(path, "wb") as f:
+            f.write(data)
+    return digest
+
+
+def _get(history_dir: str, digest: str) -> Any:
+    with open(object_path(history_dir, digest), "rb") as f:
+        return json.loads(f.read())
+
+
+def _pack_dir(history_dir: str) -> str:
+    return os.path.join(history_dir, "packs")
+
+
+def _load_pack_index(history_dir: str) -> Dict[str, List[Any]]:
+    """Location [pack, offset, length] of every stored record by hash."""
+    locations = {}
+    directory = _pack_dir(history_dir)
+    if os.path.isdir(directory):
+        for file_name in os.listdir(directory):
+            if file_name.endswith(".idx"):
+                pack = file_name[:-len(".idx")]
+                with open(os.path.join(directory, file_name), "r") as f:
+                    for digest, (offset, length) in json.load(f).items():
+                        locations[digest] = [pack, offset, length]
+    return locations
+
+
+def _read_record(history_dir: str, location: List[Any]) -> Dict[str, Any]:
+    pack, offset, length = location
+    with open(os.path.join(_pack_dir(history_dir), pack + ".pack"), "rb") as f:
+        f.seek(offset)
+        return json.loads(f.read(length))
+
+
+def _bucket(key: Tuple[str, str]) -> Tuple[int, int]:
+    """Node and leaf position of an (image, annotation ID) key in the tree."""
+    h = hashlib.blake2b("\0".join(key).encode("utf-8"), digest_size=2).digest()
+    return h[0] % FANOUT, h[1] % FANOUT
+
+
+def _snapshot_path(history_dir: str, name: str) -> str:
+    return os.path.join(history_dir, "snapshots", name + ".json")
+
+
+def create_snapshot(history_dir: str, records: Iterable[Dict[str, Any]], name: Optional[str] = None,
+                    source: Optional[str] = None) -> Dict[str, Any]:
+    """Store a snapshot of an annotation set.
+
+    Args:
+        history_dir: History directory
+        records: Annotations to store
+        name: Snapshot name, defaults to the current time
+        source: Where the annotations came from, for reference
+
+    Returns:
+        Dict: The snapshot reference (name, creation time, count and root hash)
+    """
+    name = name or time.strftime("%Y%m%dT%H%M%S")
+    if not SNAPSHOT_NAME_PATTERN.match(name):
+        raise ValueError(f"Invalid snapshot name: {name}")
+    if os.path.exists(_snapshot_path(history_dir, name)):
+        raise ValueError(f"Snapshot already exists: {name}")
+
+    locations = _load_pack_index(history_dir)
+    # Packs are never rewritten, so each gets a fresh ID
+    pack = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.urandom(4).hex()}"
+    new_records: List[bytes] = []
+    new_index: Dict[str, List[int]] = {}
+    offset = 0
+
+    leaves: Dict[Tuple[int, int], Dict[Tuple[str, str], List[Any]]] = {}
+    count = 0
+    for record in records:
+        data = _canonical(record)
+        record_hash = _digest(data)
+        if record_hash not in locations:
+            new_records.append(data + b"\n")
+            new_index[record_hash] = [offset, len(data)]
+            locations[record_hash] = [pack, offset, len(data)]
+            offset += len(data) + 1
+        # Records without an ID are keyed by their content
+        key = (record.get("image") or "", str(record.get("annotation_id") or record_hash))
+        leaves.setdefault(_bucket(key), {})[key] = [record_hash] + locations[record_hash]
+        count += 1
+
+    if new_records:
+        # The index is written last; a pack without one is never referenced
+        with atomic_writer(os.path.join(_pack_dir(history_dir), pack + ".pack"), "wb") as f:
+            f.writelines(new_records)
+        atomic_write_json(os.path.join(_pack_dir(history_dir), pack + ".idx"), new_index, indent=None)
+
+    root = []
+    for node_index in range(FANOUT):
+        node = []
+        for leaf_index in range(FANOUT):
+            entries = leaves.get((node_index, leaf_index))
+            node.append(_put(history_dir, sorted(list(key) + entry for key, entry in entries.items()))
+                        if entries else None)
+        root.append(_put(history_dir, node) if any(node) else None)
+
+    ref = {
+        "name": name,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "timestamp": time.time(),
+        "source": source,
+        "format": TREE_FORMAT,
+        "count": count,
+        "new_records": len(new_records),
+        "root": _put(history_dir, root),
+    }
+    atomic_write_json(_snapshot_path(history_dir, name), ref)
+    return ref
+
+
+def list_snapshots(history_dir: str) -> List[Dict[str, Any]]:
+    """All snapshot references, oldest first."""
+    directory = os.path.join(history_dir, "snapshots")
+    if not os.path.isdir(directory):
+        return []
+    refs = []
+    for file_name in os.listdir(directory):
+        if file_name.endswith(".json"):
+            with open(os.path.join(directory, file_name), "r") as f:
+                refs.append(json.load(f))
+    return sorted(refs, key=lambda ref: ref["timestamp"])
+
+
+def get_snapshot(history_dir: str, name: str) -> Dict[str, Any]:
+    """Reference of a snapshot by name; "latest" is the newest snapshot."""
+    if name == "latest":
+        refs = list_snapshots(history_dir)
+        if not refs:
+            raise KeyError("No snapshots")
+        return refs[-1]
+    if not SNAPSHOT_NAME_PATTERN.match(name) or not os.path.exists(_snapshot_path(history_dir, name)):
+        raise KeyError(f"Snapshot not found: {name}")
+    with open(_snapshot_path(history_dir, name), "r") as f:
+        return json.load(f)
+
+
+def _children(history_dir: str, digest: Optional[str]) -> List[Optional[str]]:
+    return _get(history_dir, digest) if digest else [None] * FANOUT
+
+
+def _entries(history_dir: str, digest: Optional[str]) -> Dict[Tuple[str, str], List[Any]]:
+    """Leaf rows by (image, annotation ID): [record hash, pack, offset, length]."""
+    return {(row[0], row[1]): row[2:] for row in _get(history_dir, digest)} if digest else {}
+
+
+def _field_changes(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, List[Any]]:
+    return {
+        key: [old.get(key), new.get(key)]
+        for key in sorted(set(old) | set(new))
+        if old.get(key) != new.get(key)
+    }
+
+
+def diff_snapshots(history_dir: str, old_name: str, new_name: str) -> Dict[str, Any]:
+    """Annotations added, removed and modified between two snapshots.
+
+    Args:
+        history_dir: History directory
+        old_name: Name of the earlier snapshot
+        new_name: Name of the later snapshot
+
+    Returns:
+        Dict: Added and removed records, modified records with their changed
+        fields, and the number of leaves that had to be compared
+
+    Raises:
+        KeyError: A snapshot does not exist
+        ValueError: The snapshots use different tree formats
+    """
+    old_ref, new_ref = get_snapshot(history_dir, old_name), get_snapshot(history_dir, new_name)
+    for ref in (old_ref, new_ref):
+        if ref.get("format", 1) != TREE_FORMAT:
+            raise ValueError(f"Snapshot {ref['name']} was taken by an older version; take a new snapshot to diff")
+    added, removed, modified = [], [], []
+    leaves_compared = 0
+
+    if old_ref["root"] != new_ref["root"]:
+        old_nodes, new_nodes = _get(history_dir, old_ref["root"]), _get(history_dir, new_ref["root"])
+        for old_node, new_node in zip(old_nodes, new_nodes):
+            if old_node == new_node:
+                continue
+            for old_leaf, new_leaf in zip(_children(history_dir, old_node), _children(history_dir, new_node)):
+                if old_leaf == new_leaf:
+                    continue
+                leaves_compared += 1
+                old_entries, new_entries = _entries(history_dir, old_leaf), _entries(history_dir, new_leaf)
+                for key, entry in new_entries.items():
+                    if key not in old_entries:
+                        added.append(_read_record(history_dir, entry[1:]))
+                    elif old_entries[key][0] != entry[0]:
+                        old_record = _read_record(history_dir, old_entries[key][1:])
+                        new_record = _read_record(history_dir, entry[1:])
+                        modified.append({
+                            "annotation_id": key[1],
+                            "image": key[0],
+                            "changes": _field_changes(old_record, new_record),
+                        })
+                for key, entry in old_entries.items():
+                    if key not in new_entries:
+                        removed.append(_read_record(history_dir, entry[1:]))
+
+    return {
+        "from": old_ref["name"],
+        "to": new_ref["name"],
+        "added": added,
+        "removed": removed,
+        "modified": modified,
+        "leaves_compared": leaves_compared,
+    }
@@ -0,0 +1,227 @@
+"""Image directory manifest for the RefCOCOS Annotator.
+
+The manifest records, for every image in a directory, the file size, mtime,
+a BLAKE2b content hash and the real pixel dimensions, read from the JPEG
+header without decoding the image. It is built once by a thread pool (see
+``utils/build_image_manifest.py`` and ``data/find_multiple_instances.py``)
+and stored compactly as one list per image::
+
+    {"version": 1, "image_dir": "/abs/val2017",
+     "fields": ["size", "mtime_ns", "hash", "width", "height"],
+     "images": {"000000000139.jpg": [161811, 1588000000000000000, "8c1f...", 640, 426], ...}}
+
+Rebuilding only hashes files whose size or mtime changed. The server uses an
+entry only while the file's size and mtime still match it.
+"""
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from refcocos_annotator.utils.file_utils import atomic_writer
+
+MANIFEST_VERSION = 1
+FIELDS = ["size", "mtime_ns", "hash", "width", "height"]
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+# Hashing and file reads release the GIL, so threads scale with the disk
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Start-of-frame markers carry the dimensions; C4, C8 and CC are other segments
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers without a length field
+_STANDALONE_MARKERS = {0x01, 0xD8} | set(range(0xD0, 0xD8))
+
+# Manifests loaded by ``lookup``: path -> (size, mtime) of the file and its contents
+_loaded: Dict[str, Tuple[Optional[Tuple[int, int]], Optional[Dict[str, Any]]]] = {}
+_loaded_lock = threading.Lock()
+
+
+def jpeg_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    """Width and height from the start-of-frame segment of a JPEG.
+
+    Args:
+        data: The file content, or at least everything up to the frame header
+
+    Returns:
+        Tuple[int, int]: Width and height, or None if ``data`` is not a JPEG
+        or ends before the frame header
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            pos += 1
+            continue
+        if marker in _STANDALONE_MARKERS:
+            pos += 2
+            continue
+        if marker in _SOF_MARKERS:
+            if pos + 9 > len(data):
+                return None
+            height = int.from_bytes(data[pos + 5:pos + 7], "big")
+            width = int.from_bytes(data[pos + 7:pos + 9], "big")
+            return width, height
+        pos += 2 + int.from_bytes(data[pos + 2:pos + 4], "big")
+    return None
+
+
+def image_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    """Width and height of an image file's content, without decoding the pixels."""
+    size = jpeg_dimensions(data)
+    if size is not None:
+        return size
+    # Other formats: Pillow only parses the header until the pixels are accessed
+    from PIL import Image
+    try:
+        with Image.open(BytesIO(data)) as img:
+            return img.size
+    except OSError:
+        return None
+
+
+def scan_image(path: str) -> List[Any]:
+    """Manifest entry of one image file, in ``FIELDS`` order.
+
+    Args:
+        path: Image file
+
+    Returns:
+        List: Size, mtime, content hash, width and height; the dimensions are
+        None if the file is not a readable image
+    """
+    st = os.stat(path)
+    with open(path, "rb") as f:
+        data = f.read()
+    size = image_dimensions(data)
+    width, height = size if size is not None else (None, None)
+    return [st.st_size, st.st_mtime_ns, hashlib.blake2b(data, digest_size=16).hexdigest(), width, height]
+
+
+def _image_files(image_dir: str) -> Iterator[os.DirEntry]:
+    for entry in os.scandir(image_dir):
+        if entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file():
+            yield entry
+
+
+def build_manifest(image_dir: str, previous: Optional[Dict[str, Any]] = None,
+                   workers: int = DEFAULT_WORKERS) -> Tuple[Dict[str, Any], int]:
+    """Scan an image directory with a thread pool.
+
+    Args:
+        image_dir: Directory with the images
+        previous: Earlier manifest of the directory; its entries are reused
+            for files whose size and mtime did not change
+        workers: Number of files read at the same time
+
+    Returns:
+        Tuple[Dict, int]: The manifest and the number of files that were read
+    """
+    reused = (previous or {}).get("images", {})
+    if previous is not None and previous.get("fields") != FIELDS:
+        reused = {}
+
+    images, to_scan = {}, []
+    for entry in _image_files(image_dir):
+        st = entry.stat()
+        known = reused.get(entry.name)
+        if known is not None and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            images[entry.name] = known
+        else:
+            to_scan.append(entry.name)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for name, info in zip(to_scan, pool.map(scan_image, [os.path.join(image_dir, n) for n in to_scan])):
+            images[name] = info
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "image_dir": os.path.abspath(image_dir),
+        "fields": FIELDS,
+        "images": dict(sorted(images.items())),
+    }
+    return manifest, len(to_scan)
+
+
+def read_manifest(path: str) -> Optional[Dict[str, Any]]:
+    """Load a manifest file, or None if it does not exist or has an older version."""
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def write_manifest(path: str, manifest: Dict[str, Any]) -> None:
+    """Atomically write a manifest without indentation, one image per line."""
+    with atomic_writer(path) as f:
+        f.write('{"version": %d, "image_dir": %s, "fields": %s, "images": {'
+                % (manifest["version"], json.dumps(manifest["image_dir"]), json.dumps(manifest["fields"])))
+        for i, (name, info) in enumerate(manifest["images"].items()):
+            f.write(("\n" if i == 0 else ",\n") + json.dumps(name) + ": " + json.dumps(info))
+        f.write("\n}}\n")
+
+
+def entry(manifest: Dict[str, Any], image_path: str) -> Optional[Dict[str, Any]]:
+    """Manifest entry of an image as a dict, or None if the manifest does not list it."""
+    directory, name = os.path.split(os.path.abspath(image_path))
+    if directory != manifest["image_dir"]:
+        return None
+    info = manifest["images"].get(name)
+    return dict(zip(manifest["fields"], info)) if info is not None else None
+
+
+def _manifest_fingerprint(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def lookup(manifest_path: Optional[str], image_path: str,
+           st: Optional[os.stat_result] = None) -> Optional[Dict[str, Any]]:
+    """Current manifest entry of an image.
+
+    The manifest is loaded on first use and again whenever its file changes.
+
+    Args:
+        manifest_path: Manifest file, or None if no manifest is configured
+        image_path: Image file
+        st: ``os.stat`` of the image, if the caller already has it
+
+    Returns:
+        Dict: The entry, or None if there is no manifest, it does not list
+        the image or the image changed since the manifest was built
+    """
+    if not manifest_path:
+        return None
+    fingerprint = _manifest_fingerprint(manifest_path)
+    with _loaded_lock:
+        cached = _loaded.get(manifest_path)
+    if cached is None or cached[0] != fingerprint:
+        cached = (fingerprint, read_manifest(manifest_path) if fingerprint is not None else None)
+        with _loaded_lock:
+            _loaded[manifest_path] = cached
+    manifest = cached[1]
+    if manifest is None:
+        return None
+
+    info = entry(manifest, image_path)
+    if info is None:
+        return None
+    if st is None:
+        st = os.stat(image_path)
+    if info["size"] != st.st_size or info["mtime_ns"] != st.st_mtime_ns:
+        return None
+    return info
@@ -1,23 +1,198 @@
 """Image handling service for the RefCOCOS Annotator."""
 import base64
+import hashlib
+import os
 from io import BytesIO
-from typing import List, Tuple
-from PIL import Image
+from typing import Any, Dict, List, Optional, Tuple
+from PIL import Image, features
 
-def encode_image(image_path: str) -> str:
+from refcocos_annotator.services import image_manifest_service
+from refcocos_annotator.services.metrics_service import timed
+from refcocos_annotator.utils.file_utils import atomic_writer
+
+# Output formats the image endpoint can negotiate: PIL format -> (MIME type, extension)
+IMAGE_FORMATS = {
+    "WEBP": ("image/webp", ".webp"),
+    "JPEG": ("image/jpeg", ".jpg"),
+}
+# Default encoder quality per format; WebP at 80 looks like JPEG at about 90
+DEFAULT_QUALITY = {"WEBP": 80, "JPEG": 90}
+
+WEBP_SUPPORTED = features.check("webp")
+# Encoder qualities above this only grow the file
+MAX_QUALITY = 95
+
+# Transcodes are cached per requested size and quality, so requests are
+# snapped to these steps to bound the number of variants of an image. Sizes
+# round up (the delivered image never falls short of the request); larger
+# ones mean no limit.
+SIZE_STEPS = (256, 512, 768, 1024, 1536, 2048)
+QUALITY_STEP = 10
+
+def clamp_quality(quality: Optional[int]) -> Optional[int]:
+    """Encoder quality limited to 1-``MAX_QUALITY``, None for the format default."""
+    return None if quality is None else max(1, min(int(quality), MAX_QUALITY))
+
+def snap_size(size: Optional[int]) -> Optional[int]:
+    """Smallest of ``SIZE_STEPS`` that is at least ``size``, None above the largest."""
+    if size is None:
+        return None
+    return next((step for step in SIZE_STEPS if step >= size), None)
+
+def snap_options(max_width: Optional[int] = None, max_height: Optional[int] = None,
+                 quality: Optional[int] = None) -> Tuple[Optional[int], Optional[int], Optional[int]]:
+    """Size bounds and quality of a transcode, snapped to the cached steps."""
+    if quality is not None:
+        quality = clamp_quality(max(QUALITY_STEP, round(int(quality) / QUALITY_STEP) * QUALITY_STEP))
+    return snap_size(max_width), snap_size(max_height), quality
+
+def fit_scale(width: int, height: int, max_width: Optional[int] = None, max_height: Optional[int] = None) -> float:
+    """Scale factor that fits an image into the given bounds without enlarging it.
+
+    Args:
+        width: Image width
+        height: Image height
+        max_width: Maximum width, or None for no limit
+        max_height: Maximum height, or None for no limit
+
+    Returns:
+        float: Scale factor in (0, 1]
+    """
+    scale = 1.0
+    if max_width:
+        scale = min(scale, max_width / width)
+    if max_height:
+        scale = min(scale, max_height / height)
+    return scale
+
+def load_scaled(img: Image.Image, max_width: Optional[int] = None, max_height: Optional[int] = None) -> Image.Image:
+    """Decode an opened image, downscaled to fit the given bounds.
+
+    For JPEG files ``draft()`` makes the decoder reduce the image in the DCT
+    domain by a power of two, so far fewer pixels are decoded before the
+    final resize.
+
+    Args:
+        img: Opened image
+        max_width: Maximum width, or None for no limit
+        max_height: Maximum height, or None for no limit
+
+    Returns:
+        Image.Image: The decoded image, no larger than the bounds
+    """
+    scale = fit_scale(img.width, img.height, max_width, max_height)
+    if scale >= 1.0:
+        img.load()
+        return img
+
+    target = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    img.draft(img.mode, target)
+    img.load()
+    return img.resize(target, Image.BICUBIC) if img.size != target else img
+
+def encode_image(image_path: str, max_width: Optional[int] = None, max_height: Optional[int] = None,
+                 quality: Optional[int] = None) -> Tuple[str, float]:
     """Encode an image to base64 for embedding in HTML.
     
     Args:
         image_path: Path to the image file
+        max_width: Downscale the image to at most this width
+        max_height: Downscale the image to at most this height
+        quality: JPEG quality (1-95), or None for the encoder default
         
     Returns:
-        str: Base64 encoded image string
+        Tuple[str, float]: Base64 encoded image string and the scale factor
+        from original to delivered pixel coordinates
     """
     with Image.open(image_path) as img:
-        buffered = BytesIO()
-        img.save(buffered, format="JPEG")
-        img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        return img_str
+        original_width = img.width
+        with timed("image_decode"):
+            delivered = load_scaled(img, max_width, max_height)
+        with timed("image_encode"):
+            buffered = BytesIO()
+            quality = clamp_quality(quality)
+            options = {} if quality is None else {"quality": quality}
+            delivered.save(buffered, format="JPEG", **options)
+            img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
+        return img_str, delivered.width / original_width
+
+def negotiate_format(accept: str) -> str:
+    """Pick the output format for an ``Accept`` header.
+
+    Args:
+        accept: Value of the request's Accept header
+
+    Returns:
+        str: "WEBP" if the client accepts it and Pillow can write it, else "JPEG"
+    """
+    if WEBP_SUPPORTED and "image/webp" in (accept or ""):
+        return "WEBP"
+    return "JPEG"
+
+def transcode_cache_path(cache_dir: str, image_path: str, fmt: str, max_width: Optional[int] = None,
+                         max_height: Optional[int] = None, quality: Optional[int] = None,
+                         manifest_entry: Optional[Dict[str, Any]] = None) -> str:
+    """Cache file for a transcoded image, keyed by source file and output options.
+
+    With a manifest entry the key is the image's content hash, so the cache
+    survives touching, copying or moving the images.
+    """
+    if manifest_entry is not None:
+        source = manifest_entry["hash"]
+    else:
+        st = os.stat(image_path)
+        source = f"{os.path.abspath(image_path)}:{st.st_size}:{st.st_mtime_ns}"
+    key = f"{source}:{fmt}:{max_width}:{max_height}:{quality}"
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(cache_dir, f"{stem}_{digest}{IMAGE_FORMATS[fmt][1]}")
+
+def transcode_image(cache_dir: str, image_path: str, fmt: str, max_width: Optional[int] = None,
+                    max_height: Optional[int] = None, quality: Optional[int] = None,
+                    manifest_file: Optional[str] = None) -> Tuple[str, float, bool]:
+    """Return a cached transcode of an image, creating it if needed.
+
+    When the image manifest lists the image, a cached transcode is served
+    without opening the source image at all.
+
+    Args:
+        cache_dir: Transcode cache directory
+        image_path: Source image
+        fmt: Output format, a key of IMAGE_FORMATS
+        max_width: Downscale the image to about this width (see ``snap_options``)
+        max_height: Downscale the image to about this height
+        quality: Encoder quality (1-95), or None for the format default
+        manifest_file: Image manifest (see ``image_manifest_service``), or None
+
+    Returns:
+        Tuple[str, float, bool]: Path of the transcoded file, scale factor from
+        original to delivered pixels, and whether it was created now
+    """
+    # Snap first, so nearby requests share one cache entry
+    max_width, max_height, quality = snap_options(max_width, max_height, quality)
+    manifest_entry = image_manifest_service.lookup(manifest_file, image_path)
+    path = transcode_cache_path(cache_dir, image_path, fmt, max_width, max_height, quality, manifest_entry)
+    if manifest_entry is not None and manifest_entry["width"] and os.path.exists(path):
+        # The delivered width follows from the real dimensions, as in load_scaled
+        width, height = manifest_entry["width"], manifest_entry["height"]
+        delivered_width = max(1, round(width * fit_scale(width, height, max_width, max_height)))
+        return path, delivered_width / width, False
+
+    with Image.open(image_path) as img:
+        original_width = img.width
+        if os.path.exists(path):
+            # Opening only reads the header, which is all the scale needs
+            with Image.open(path) as cached:
+                return path, cached.width / original_width, False
+
+        with timed("image_decode"):
+            delivered = load_scaled(img, max_width, max_height)
+        if fmt == "JPEG" and delivered.mode not in ("RGB", "L"):
+            delivered = delivered.convert("RGB")
+        with timed("image_encode"):
+            with atomic_writer(path, "wb") as f:
+                delivered.save(f, format=fmt, quality=DEFAULT_QUALITY[fmt] if quality is None else quality)
+        return path, delivered.width / original_width, True
 
 def calculate_normalized_solution(bbox: List[float], width: int, height: int) -> List[int]:
     """Calculate normalized solution coordinates in 0-1000 range.
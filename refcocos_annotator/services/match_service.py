@@ -0,0 +1,154 @@
+"""Matching drawn boxes to COCO instances for the RefCOCOS Annotator.
+
+For each image the instance boxes from ``categories_with_multiple_instances``
+are put into a uniform grid over the image. A drawn box is only compared
+with the instances in the grid cells it covers, so a match costs a handful
+of IoU computations even on crowded images. Grids are built on first use and
+dropped when the data is reloaded.
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set
+
+from refcocos_annotator.services import data_service
+from refcocos_annotator.services.image_service import convert_bbox_format
+
+GRID_CELLS = 8
+# A box snaps to its best instance from this IoU on
+DEFAULT_SNAP_IOU = 0.5
+# Two instances within this IoU of each other make a match ambiguous
+DEFAULT_AMBIGUITY_MARGIN = 0.1
+MAX_CACHED_IMAGES = 4096
+
+
+def iou(a: List[float], b: List[float]) -> float:
+    """Intersection over union of two [x1, y1, x2, y2] boxes."""
+    inter_w = min(a[2], b[2]) - max(a[0], b[0])
+    inter_h = min(a[3], b[3]) - max(a[1], b[1])
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+    intersection = inter_w * inter_h
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+class InstanceIndex:
+    """Grid of the instance boxes of one image."""
+
+    def __init__(self, image_data: Dict[str, Any]):
+        self.cell_width = max(image_data["width"], 1) / GRID_CELLS
+        self.cell_height = max(image_data["height"], 1) / GRID_CELLS
+        self.instances: List[Dict[str, Any]] = []
+        self.cells: List[List[int]] = [[] for _ in range(GRID_CELLS * GRID_CELLS)]
+
+        for category_index, category in enumerate(image_data.get("categories_with_multiple_instances", [])):
+            instances = category.get("instances", [])
+            for instance_index, bbox in enumerate(instances):
+                box = convert_bbox_format(bbox)
+                self.instances.append({
+                    "category_index": category_index,
+                    "category_id": category.get("category_id"),
+                    "category_name": category.get("category_name"),
+                    "category_count": category.get("count", len(instances)),
+                    "instance_index": instance_index,
+                    "bbox": box,
+                })
+                for cell in self._cells(box):
+                    self.cells[cell].append(len(self.instances) - 1)
+
+    def _cells(self, box: List[float]) -> List[int]:
+        """Grid cells a box overlaps."""
+        def span(low, high, size):
+            first = min(max(int(low // size), 0), GRID_CELLS - 1)
+            last = min(max(int(high // size), 0), GRID_CELLS - 1)
+            return range(first, last + 1)
+
+        return [row * GRID_CELLS + column
+                for row in span(box[1], box[3], self.cell_height)
+                for column in span(box[0], box[2], self.cell_width)]
+
+    def candidates(self, box: List[float]) -> Set[int]:
+        """Instances sharing at least one grid cell with a box."""
+        found = set()
+        for cell in self._cells(box):
+            found.update(self.cells[cell])
+        return found
+
+    def match(self, box: List[float], snap_iou: float = DEFAULT_SNAP_IOU,
+              ambiguity_margin: float = DEFAULT_AMBIGUITY_MARGIN, limit: int = 3) -> Dict[str, Any]:
+        """Instances best matching a box.
+
+        Args:
+            box: Drawn box [x1, y1, x2, y2] in image coordinates
+            snap_iou: Minimum IoU for the best instance to be offered for snapping
+            ambiguity_margin: Matches are ambiguous when the runner-up is this close
+            limit: Number of overlapping instances to return
+
+        Returns:
+            Dict: Overlapping instances with their IoU (best first), the
+            instance to snap to (or None) and whether the match is ambiguous
+        """
+        scored = []
+        for i in self.candidates(box):
+            score = iou(box, self.instances[i]["bbox"])
+            if score > 0:
+                scored.append(dict(self.instances[i], iou=round(score, 4)))
+        scored.sort(key=lambda m: -m["iou"])
+
+        best = scored[0] if scored else None
+        snap = best if best is not None and best["iou"] >= snap_iou else None
+        ambiguous = (snap is not None and len(scored) > 1
+                     and scored[1]["iou"] >= snap_iou and best["iou"] - scored[1]["iou"] < ambiguity_margin)
+        return {"box": box, "matches": scored[:limit], "snap": snap, "ambiguous": ambiguous}
+
+
+_indexes: "OrderedDict[int, InstanceIndex]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_index(index: int) -> Optional[InstanceIndex]:
+    """Instance grid of an image, built on first use."""
+    images = (data_service.multiple_instances_data or {}).get("images", [])
+    if not 0 <= index < len(images):
+        return None
+    with _lock:
+        instance_index = _indexes.get(index)
+        if instance_index is not None:
+            _indexes.move_to_end(index)
+            return instance_index
+    instance_index = InstanceIndex(images[index])
+    with _lock:
+        _indexes[index] = instance_index
+        while len(_indexes) > MAX_CACHED_IMAGES:
+            _indexes.popitem(last=False)
+    return instance_index
+
+
+def _handle_change(event: str, annotation: Optional[Dict[str, Any]],
+                   previous: Optional[Dict[str, Any]]) -> None:
+    # Instance boxes only change when the data is reloaded
+    if event == "load":
+        with _lock:
+            _indexes.clear()
+
+
+data_service.add_change_listener(_handle_change)
+
+
+def match_box(index: int, box: List[float], snap_iou: float = DEFAULT_SNAP_IOU,
+              ambiguity_margin: float = DEFAULT_AMBIGUITY_MARGIN) -> Dict[str, Any]:
+    """Match a box drawn on an image against its COCO instances.
+
+    Args:
+        index: Image index
+        box: Drawn box [x1, y1, x2, y2] in image coordinates
+        snap_iou: Minimum IoU to offer snapping
+        ambiguity_margin: IoU difference below which two matches are ambiguous
+
+    Returns:
+        Dict: The match, or an error
+    """
+    instance_index = get_index(index)
+    if instance_index is None:
+        return {"error": "Invalid image index"}
+    return instance_index.match(box, snap_iou, ambiguity_margin)
@@ -0,0 +1,176 @@
+"""Request and stage timing metrics for the RefCOCOS Annotator.
+
+Metrics are kept in process memory and exposed in the Prometheus text
+exposition format through ``/api/metrics``.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from flask import Flask, g, request
+
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+SIZE_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216]
+
+LabelSet = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """A cumulative histogram with fixed bucket bounds, one series per label set."""
+
+    def __init__(self, name: str, help_text: str, buckets: List[float]):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series: Dict[LabelSet, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            # Per-bucket counts followed by total count and sum
+            series = self._series.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(key, list(series)) for key, series in sorted(self._series.items())]
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, le=_format_value(bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, le='+Inf')} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(series[-1])}")
+        return lines
+
+
+class Counter:
+    """A monotonically increasing counter, one series per label set."""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._series: Dict[LabelSet, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._series.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(key: LabelSet, **extra: str) -> str:
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+request_duration = Histogram("refcocos_request_duration_seconds",
+                             "Time spent handling HTTP requests.", LATENCY_BUCKETS)
+response_size = Histogram("refcocos_response_size_bytes",
+                          "Size of HTTP response bodies.", SIZE_BUCKETS)
+requests_total = Counter("refcocos_requests_total", "HTTP requests by endpoint, method and status.")
+request_errors = Counter("refcocos_request_errors_total",
+                         "HTTP requests that raised an exception or returned a 5xx status.")
+stage_duration = Histogram("refcocos_stage_duration_seconds",
+                           "Time spent in internal processing stages.", LATENCY_BUCKETS)
+
+METRICS = [request_duration, response_size, requests_total, request_errors, stage_duration]
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Record the duration of the enclosed block under ``stage``.
+
+    Args:
+        stage: Name of the internal stage, e.g. "image_decode"
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_duration.observe(time.perf_counter() - start, stage=stage)
+
+
+def _endpoint_label() -> str:
+    """Route pattern of the current request, so /api/image/1 and /api/image/2 share a series."""
+    rule = request.url_rule
+    return rule.rule if rule is not None else "unmatched"
+
+
+def _before_request() -> None:
+    g.metrics_start = time.perf_counter()
+
+
+def _after_request(response):
+    start = g.pop("metrics_start", None)
+    if start is None:
+        return response
+
+    endpoint = _endpoint_label()
+    request_duration.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+    requests_total.inc(endpoint=endpoint, method=request.method, status=str(response.status_code))
+    if response.status_code >= 500:
+        request_errors.inc(endpoint=endpoint)
+    if not response.is_streamed and response.content_length is not None:
+        response_size.observe(response.content_length, endpoint=endpoint)
+    return response
+
+
+def _teardown_request(exc: Optional[BaseException]) -> None:
+    # Unhandled exceptions skip after_request, so account for them here
+    start = g.pop("metrics_start", None)
+    if exc is None or start is None:
+        return
+
+    endpoint = _endpoint_label()
+    request_duration.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+    requests_total.inc(endpoint=endpoint, method=request.method, status="500")
+    request_errors.inc(endpoint=endpoint)
+
+
+def init_app(app: Flask) -> None:
+    """Install the request timing hooks on ``app``.
+
+    Args:
+        app: Flask application instance
+    """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+
+
+def render_prometheus() -> str:
+    """Render all metrics in the Prometheus text exposition format.
+
+    Returns:
+        str: Metrics text
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,168 @@
+"""Schema versioning and record migrations for the RefCOCOS Annotator output file.
+
+The output file is stored as ``{"schema_version": N, "annotations": [...]}``.
+Files written before versioning was introduced are plain lists and are treated
+as version 0. Each registered migration upgrades a record from one version to
+the next; ``data_service.load_data`` applies them in memory and the upgraded
+records are persisted on the next write.
+"""
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+# Current version of the output file schema
+SCHEMA_VERSION = 3
+
+# Registered migrations, keyed by the version they upgrade from
+MIGRATIONS: Dict[int, Callable[[Dict[str, Any], "MigrationContext"], None]] = {}
+
+
+class MigrationContext:
+    """Shared state passed to every migration of a single load."""
+
+    def __init__(self, image_path_to_index: Dict[str, int]):
+        self.image_path_to_index = image_path_to_index
+        self.used_ids: Set[str] = set()
+        self.position = 0
+
+
+def register_migration(from_version: int):
+    """Register a function that upgrades a record from ``from_version`` to ``from_version + 1``.
+
+    Args:
+        from_version: Schema version the migration starts from
+
+    Returns:
+        Decorator registering the migration
+    """
+    def decorator(func):
+        if from_version in MIGRATIONS:
+            raise ValueError(f"A migration from version {from_version} is already registered")
+        MIGRATIONS[from_version] = func
+        return func
+    return decorator
+
+
+def derive_annotation_id(item: Dict[str, Any], position: int, used_ids: Set[str]) -> str:
+    """Derive a unique annotation ID for a record that has none.
+
+    The ID only depends on the record's image and its position in the file,
+    so migrating the same input twice produces the same IDs.
+
+    Args:
+        item: The annotation record
+        position: Position of the record in the output file
+        used_ids: Annotation IDs seen so far; the new ID is added to it
+
+    Returns:
+        str: The new annotation ID
+    """
+    image_path = item.get("image", "")
+    if "file_name" in item:
+        img_id = item["file_name"].split(".")[0]
+    elif image_path:
+        img_id = image_path.split("/")[-1].split(".")[0]
+    else:
+        img_id = "unknown"
+
+    annotation_id = f"{img_id}_m{position}"
+    suffix = 1
+    while annotation_id in used_ids:
+        annotation_id = f"{img_id}_m{position}_{suffix}"
+        suffix += 1
+
+    used_ids.add(annotation_id)
+    return annotation_id
+
+
+@register_migration(0)
+def _add_file_name(item: Dict[str, Any], context: MigrationContext) -> None:
+    """Backfill file_name from the image path."""
+    image_path = item.get("image", "")
+    if "file_name" not in item and image_path:
+        item["file_name"] = image_path.split("/")[-1]
+
+
+@register_migration(1)
+def _add_image_index(item: Dict[str, Any], context: MigrationContext) -> None:
+    """Backfill image_index from the position of the image in the multiple instances file."""
+    index = context.image_path_to_index.get(item.get("image", ""))
+    if "image_index" not in item and index is not None:
+        item["image_index"] = index
+
+
+@register_migration(2)
+def _add_annotation_id(item: Dict[str, Any], context: MigrationContext) -> None:
+    """Backfill annotation_id with a deterministic, unique value."""
+    if "annotation_id" not in item:
+        item["annotation_id"] = derive_annotation_id(item, context.position, context.used_ids)
+
+
+def split_output(data: Any) -> Tuple[int, List[Dict[str, Any]]]:
+    """Split loaded output file contents into schema version and records.
+
+    Args:
+        data: Decoded JSON of the output file
+
+    Returns:
+        Tuple[int, List]: Schema version and list of annotation records
+    """
+    if isinstance(data, dict):
+        return data.get("schema_version", 0), data.get("annotations", [])
+    if isinstance(data, list):
+        return 0, data
+    return SCHEMA_VERSION, []
+
+
+def wrap_output(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Wrap annotation records in the current versioned output layout.
+
+    Args:
+        records: Annotation records
+
+    Returns:
+        Dict: Data to be written to the output file
+    """
+    return {"schema_version": SCHEMA_VERSION, "annotations": records}
+
+
+def needs_migration(version: int) -> bool:
+    """Return whether records at ``version`` have pending migrations."""
+    return version < SCHEMA_VERSION
+
+
+def migrate_record(item: Dict[str, Any], from_version: int, context: MigrationContext) -> Dict[str, Any]:
+    """Upgrade a single record from ``from_version`` to the current schema in place.
+
+    Args:
+        item: The annotation record
+        from_version: Schema version the record was stored with
+        context: Shared migration state
+
+    Returns:
+        Dict: The upgraded record
+    """
+    for version in range(from_version, SCHEMA_VERSION):
+        MIGRATIONS[version](item, context)
+    context.position += 1
+    return item
+
+
+def migrate_records(records: List[Dict[str, Any]], from_version: int,
+                    image_path_to_index: Optional[Dict[str, int]] = None) -> int:
+    """Upgrade a list of records to the current schema in place.
+
+    Args:
+        records: Annotation records
+        from_version: Schema version the records were stored with
+        image_path_to_index: Mapping of image path to image index
+
+    Returns:
+        int: Number of records that were migrated
+    """
+    if not needs_migration(from_version):
+        return 0
+
+    context = MigrationContext(image_path_to_index or {})
+    context.used_ids.update(item["annotation_id"] for item in records if "annotation_id" in item)
+    for item in records:
+        migrate_record(item, from_version, context)
+    return len(records)
@@ -0,0 +1,267 @@
+"""Server-side review overlays for the RefCOCOS Annotator.
+
+An overlay is the image with the COCO instance boxes of its
+``categories_with_multiple_instances`` and the saved ``solution`` boxes drawn
+on top, in the same colours as the annotation UI. Overlays are cached on disk
+under a name derived from the image file and the content of the annotations,
+so an overlay is only rendered again after the image or one of its
+annotations changes. Contact sheets tile many overlays into one image for
+fast QA browsing.
+"""
+import hashlib
+import json
+import math
+import os
+import textwrap
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageDraw
+
+from refcocos_annotator.services import data_service
+from refcocos_annotator.services.image_service import convert_bbox_format
+from refcocos_annotator.services.metrics_service import timed
+from refcocos_annotator.utils.file_utils import atomic_writer
+
+# Colours used by the annotation UI
+INSTANCE_COLOR = (0, 0, 255)
+SOLUTION_COLOR = (255, 0, 0)
+SOLUTION_FILL = (255, 0, 0, 51)
+CAPTION_BACKGROUND = (0, 0, 0)
+CAPTION_COLOR = (255, 255, 255)
+
+DEFAULT_TILE_SIZE = 320
+DEFAULT_COLUMNS = 6
+MAX_SHEET_TILES = 200
+JPEG_QUALITY = 85
+# Overlays are cached per size, so requested sizes are rounded up to one of
+# these; larger ones mean full size
+OVERLAY_SIZES = (160, 320, 480, 640, 960, 1280)
+
+# Bump to invalidate cached overlays when the rendering changes
+RENDER_VERSION = 1
+
+
+def snap_max_size(max_size: Optional[int]) -> Optional[int]:
+    """Smallest of ``OVERLAY_SIZES`` that is at least ``max_size``, None above the largest."""
+    if not max_size:
+        return None
+    return next((size for size in OVERLAY_SIZES if size >= max_size), None)
+
+
+def annotation_version(annotations: List[Dict[str, Any]]) -> str:
+    """Short hash of the annotation content drawn on an overlay."""
+    payload = json.dumps([[a.get("annotation_id"), a.get("solution"), a.get("normal_caption")] for a in annotations],
+                         sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:12]
+
+
+def overlay_cache_path(cache_dir: str, image_data: Dict[str, Any], annotations: List[Dict[str, Any]],
+                       max_size: Optional[int]) -> str:
+    """Cache file of an overlay, keyed by image file, annotation version and size.
+
+    Args:
+        cache_dir: Overlay cache directory
+        image_data: Image entry from the multiple instances file
+        annotations: Annotations drawn on the overlay
+        max_size: Longest side of the rendered overlay, or None for full size
+
+    Returns:
+        str: Path of the cached JPEG
+    """
+    st = os.stat(image_data["path"])
+    key = f"{image_data['path']}:{st.st_size}:{st.st_mtime_ns}:{max_size}:{RENDER_VERSION}:" \
+          f"{annotation_version(annotations)}"
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{image_data['image_id']}_{digest}.jpg")
+
+
+def _caption_lines(annotations: List[Dict[str, Any]], width: int) -> List[str]:
+    chars = max(width // 7, 10)
+    lines = []
+    for annotation in annotations:
+        caption = annotation.get("normal_caption", "")
+        lines.extend(textwrap.wrap(f"[{annotation.get('annotation_id')}] {caption}", chars) or [""])
+    return lines
+
+
+def render_overlay(image_data: Dict[str, Any], annotations: List[Dict[str, Any]],
+                   max_size: Optional[int] = None) -> Image.Image:
+    """Draw instance and solution boxes onto an image.
+
+    Args:
+        image_data: Image entry from the multiple instances file
+        annotations: Saved annotations whose solution boxes and captions to draw
+        max_size: Longest side of the result, or None for full size
+
+    Returns:
+        Image.Image: The rendered RGB overlay
+    """
+    with Image.open(image_data["path"]) as img:
+        if max_size and max(img.size) > max_size:
+            ratio = max_size / max(img.size)
+            target = (max(1, round(img.width * ratio)), max(1, round(img.height * ratio)))
+            # Let the JPEG decoder skip detail that would be scaled away anyway
+            img.draft("RGB", target)
+            base = img.convert("RGB").resize(target)
+        else:
+            base = img.convert("RGB")
+    scale = base.width / image_data["width"]
+
+    overlay = Image.new("RGBA", base.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+
+    def scaled(box):
+        return [round(v * scale) for v in box]
+
+    for category in image_data.get("categories_with_multiple_instances", []):
+        for number, bbox in enumerate(category.get("instances", []), start=1):
+            box = scaled(convert_bbox_format(bbox))
+            draw.rectangle(box, outline=INSTANCE_COLOR + (179,), width=1)
+            draw.text((box[0] + 2, box[1] + 1), f"{category.get('category_name', '')} {number}",
+                      fill=INSTANCE_COLOR + (255,))
+
+    for annotation in annotations:
+        if annotation.get("solution"):
+            box = scaled(annotation["solution"])
+            draw.rectangle(box, fill=SOLUTION_FILL, outline=SOLUTION_COLOR + (255,), width=3)
+
+    result = Image.alpha_composite(base.convert("RGBA"), overlay).convert("RGB")
+
+    lines = _caption_lines(annotations, result.width)
+    if lines:
+        # Captions go in a strip below the image so they never hide a box
+        line_height = 14
+        framed = Image.new("RGB", (result.width, result.height + line_height * len(lines) + 6), CAPTION_BACKGROUND)
+        framed.paste(result, (0, 0))
+        text = ImageDraw.Draw(framed)
+        for i, line in enumerate(lines):
+            text.text((4, result.height + 3 + i * line_height), line, fill=CAPTION_COLOR)
+        result = framed
+
+    return result
+
+
+def get_overlay(cache_dir: str, image_data: Dict[str, Any], annotations: List[Dict[str, Any]],
+                max_size: Optional[int] = None) -> Tuple[str, bool]:
+    """Return the cached overlay for an image, rendering it if needed.
+
+    Args:
+        cache_dir: Overlay cache directory
+        image_data: Image entry from the multiple instances file
+        annotations: Annotations to draw
+        max_size: Longest side of the overlay, rounded up by ``snap_max_size``,
+            or None for full size
+
+    Returns:
+        Tuple[str, bool]: Path of the JPEG and whether it was rendered now
+    """
+    max_size = snap_max_size(max_size)
+    path = overlay_cache_path(cache_dir, image_data, annotations, max_size)
+    if os.path.exists(path):
+        return path, False
+
+    with timed("overlay_render"):
+        overlay = render_overlay(image_data, annotations, max_size)
+        with atomic_writer(path, "wb") as f:
+            overlay.save(f, format="JPEG", quality=JPEG_QUALITY)
+    return path, True
+
+
+def contact_sheet(paths: List[str], columns: int = DEFAULT_COLUMNS,
+                  tile_size: int = DEFAULT_TILE_SIZE) -> Image.Image:
+    """Tile overlay images into a single contact sheet.
+
+    Args:
+        paths: Overlay image files, in reading order
+        columns: Number of tiles per row
+        tile_size: Size of the square cell each overlay is fitted into
+
+    Returns:
+        Image.Image: The contact sheet
+    """
+    columns = max(1, min(columns, len(paths) or 1))
+    rows = max(1, math.ceil(len(paths) / columns))
+    sheet = Image.new("RGB", (columns * tile_size, rows * tile_size), (255, 255, 255))
+    for i, path in enumerate(paths):
+        with Image.open(path) as tile:
+            tile.draft("RGB", (tile_size, tile_size))
+            tile = tile.convert("RGB")
+            tile.thumbnail((tile_size, tile_size))
+            x = (i % columns) * tile_size + (tile_size - tile.width) // 2
+            y = (i // columns) * tile_size + (tile_size - tile.height) // 2
+            sheet.paste(tile, (x, y))
+    return sheet
+
+
+def encode_jpeg(image: Image.Image) -> bytes:
+    """Encode an image as JPEG bytes."""
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG", quality=JPEG_QUALITY)
+    return buffered.getvalue()
+
+
+def image_for_annotation(annotation: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Image entry an annotation belongs to, or None if it is unknown."""
+    index = data_service.image_path_to_index.get(annotation.get("image", ""))
+    if index is None:
+        return None
+    return data_service.multiple_instances_data["images"][index]
+
+
+def overlay_for_image(cache_dir: str, index: int, annotation_id: Optional[str] = None,
+                      max_size: Optional[int] = None) -> Tuple[Optional[str], str]:
+    """Overlay of an image with all of its saved annotations, or just one.
+
+    Args:
+        cache_dir: Overlay cache directory
+        index: Index of the image in the dataset
+        annotation_id: Only draw this annotation
+        max_size: Longest side of the overlay
+
+    Returns:
+        Tuple[Optional[str], str]: Path of the overlay (None on error) and a message
+    """
+    data_service.refresh_shards()
+    images = (data_service.multiple_instances_data or {}).get("images", [])
+    if index < 0 or index >= len(images):
+        return None, "Image not found"
+
+    image_data = images[index]
+    image_path = "val2017/" + image_data["file_name"]
+    annotations = [a for a in data_service.output_data if a.get("image") == image_path]
+    if annotation_id is not None:
+        annotations = [a for a in annotations if str(a.get("annotation_id")) == annotation_id]
+        if not annotations:
+            return None, "Annotation not found"
+
+    try:
+        path, _ = get_overlay(cache_dir, image_data, annotations, max_size)
+    except OSError as e:
+        return None, f"Failed to render overlay: {str(e)}"
+    return path, "OK"
+
+
+def render_contact_sheet(cache_dir: str, annotations: List[Dict[str, Any]], columns: int = DEFAULT_COLUMNS,
+                         tile_size: int = DEFAULT_TILE_SIZE) -> Image.Image:
+    """Contact sheet with one overlay per annotation.
+
+    Args:
+        cache_dir: Overlay cache directory
+        annotations: Annotations to show, in reading order
+        columns: Number of tiles per row
+        tile_size: Size of each tile
+
+    Returns:
+        Image.Image: The contact sheet
+    """
+    paths = []
+    for annotation in annotations[:MAX_SHEET_TILES]:
+        image_data = image_for_annotation(annotation)
+        if image_data is None:
+            continue
+        try:
+            paths.append(get_overlay(cache_dir, image_data, [annotation], tile_size)[0])
+        except OSError as e:
+            print(f"Warning: Failed to render overlay for {annotation.get('annotation_id')}: {e}")
+    return contact_sheet(paths, columns, tile_size)
@@ -0,0 +1,97 @@
+"""On-demand per-request profiling for the RefCOCOS Annotator.
+
+When ``PROFILE_ENABLED`` is set, a request is profiled with cProfile if it
+sends an ``X-Profile: 1`` header or a ``profile=1`` query flag, or if it is
+picked by 1-in-``PROFILE_SAMPLE_RATE`` sampling. Profiles are written to
+``PROFILE_DIR`` as ``<endpoint>_<timestamp>.prof`` and can be inspected with
+``python -m pstats`` or snakeviz.
+"""
+import cProfile
+import itertools
+import os
+import re
+import threading
+import time
+from typing import Optional
+
+from flask import Flask, g, request
+
+from refcocos_annotator import config
+
+# Only one cProfile profiler can be active per interpreter on newer Pythons,
+# so concurrent requests are profiled one at a time and the rest are skipped
+_profiler_lock = threading.Lock()
+_request_counter = itertools.count(1)
+
+
+def _endpoint_slug() -> str:
+    rule = request.url_rule
+    name = rule.rule if rule is not None else request.path
+    return re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_") or "root"
+
+
+def _wants_profile() -> bool:
+    """Decide whether the current request should be profiled."""
+    if config.PROFILE_ENDPOINTS:
+        rule = request.url_rule
+        if rule is None or rule.rule not in config.PROFILE_ENDPOINTS:
+            return False
+
+    if request.headers.get("X-Profile", "") in ("1", "true") or request.args.get("profile") in ("1", "true"):
+        return True
+
+    return config.PROFILE_SAMPLE_RATE > 0 and next(_request_counter) % config.PROFILE_SAMPLE_RATE == 0
+
+
+def _before_request() -> None:
+    if not config.PROFILE_ENABLED or not _wants_profile():
+        return
+    if not _profiler_lock.acquire(blocking=False):
+        return
+
+    profiler = cProfile.Profile()
+    g.profiler = profiler
+    profiler.enable()
+
+
+def _finish() -> Optional[str]:
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return None
+
+    try:
+        profiler.disable()
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        now = time.time()
+        timestamp = time.strftime("%Y%m%dT%H%M%S", time.localtime(now)) + f"_{int(now % 1 * 1e6):06d}"
+        path = os.path.join(config.PROFILE_DIR, f"{_endpoint_slug()}_{timestamp}.prof")
+        profiler.dump_stats(path)
+        return path
+    finally:
+        _profiler_lock.release()
+
+
+def _after_request(response):
+    path = _finish()
+    if path is not None:
+        response.headers["X-Profile-File"] = path
+    return response
+
+
+def _teardown_request(exc: Optional[BaseException]) -> None:
+    # Requests that raised skip after_request; still write their profile
+    _finish()
+
+
+def init_app(app: Flask) -> None:
+    """Install the profiling hooks on ``app``.
+
+    The hooks are always installed so profiling can be toggled through
+    ``config.PROFILE_ENABLED`` without recreating the app.
+
+    Args:
+        app: Flask application instance
+    """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
@@ -0,0 +1,319 @@
+"""Annotation query service for the RefCOCOS Annotator.
+
+Secondary indexes over the ``categories`` fields, ``image_index`` and caption
+tokens are kept up to date through ``data_service`` change notifications, so
+a query only touches the posting sets of its filters and the matching
+records instead of scanning every annotation.
+"""
+import re
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from refcocos_annotator.services import data_service
+
+# Fields that can be used for filtering and how their values are indexed
+CATEGORY_FIELDS = ["hops", "type", "occluded", "empty_case", "distractors"]
+NUMERIC_FIELDS = {"hops", "distractors", "image_index"}
+SORT_FIELDS = {"annotation_id", "image_index", "hops", "distractors", "caption"}
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 1000
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+AnnotationKey = Tuple[str, str]
+
+
+def tokenize(caption: str) -> List[str]:
+    """Split a caption into lowercase word tokens.
+
+    Args:
+        caption: Caption text
+
+    Returns:
+        List[str]: Tokens in order of appearance
+    """
+    return _TOKEN_RE.findall((caption or "").lower())
+
+
+def annotation_key(annotation: Dict[str, Any]) -> AnnotationKey:
+    """Key identifying an annotation; IDs are only unique per image."""
+    return annotation.get("image", ""), str(annotation.get("annotation_id", ""))
+
+
+def _normalize(value: Any) -> Any:
+    """Normalize an indexed value so "3" and 3, or "true" and True, match."""
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return int(value) if float(value).is_integer() else value
+    text = str(value).strip()
+    if text.lower() in ("true", "false"):
+        return text.lower() == "true"
+    try:
+        return int(text)
+    except ValueError:
+        return text.lower()
+
+
+def _field_values(annotation: Dict[str, Any], field: str) -> Iterable[Any]:
+    """Indexed values of ``field`` for an annotation."""
+    if field == "image_index":
+        value = annotation.get("image_index")
+        return [] if value is None else [_normalize(value)]
+    if field == "caption":
+        return set(tokenize(annotation.get("normal_caption", "")))
+
+    value = (annotation.get("categories") or {}).get(field)
+    if isinstance(value, list):
+        return {_normalize(v) for v in value}
+    return [_normalize(value)]
+
+
+class QueryError(ValueError):
+    """Raised for malformed query parameters."""
+
+
+class AnnotationIndex:
+    """Posting-set indexes from field values to annotation keys."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.records: Dict[AnnotationKey, Dict[str, Any]] = {}
+        self.postings: Dict[str, Dict[Any, Set[AnnotationKey]]] = {}
+        # Set by ``invalidate``: where to read the annotations on the next query
+        self._source: Optional[Callable[[], Iterable[Dict[str, Any]]]] = None
+
+    def clear(self) -> None:
+        with self._lock:
+            self.records = {}
+            self.postings = {field: {} for field in CATEGORY_FIELDS + ["image_index", "caption"]}
+            self._source = None
+
+    def invalidate(self, source: Callable[[], Iterable[Dict[str, Any]]]) -> None:
+        """Drop the index and rebuild it from ``source()`` on the next query.
+
+        Building the posting sets for a large dataset takes seconds, so a load
+        defers it until the index is actually used. Changes reported before
+        then are already part of what ``source()`` returns.
+        """
+        with self._lock:
+            self.clear()
+            self._source = source
+
+    def _ensure_built(self) -> None:
+        with self._lock:
+            if self._source is not None:
+                # Copy first: the source may be changed by a save while building
+                self.rebuild(list(self._source()))
+
+    def add(self, annotation: Dict[str, Any]) -> None:
+        key = annotation_key(annotation)
+        with self._lock:
+            if self._source is not None:
+                return
+            if key in self.records:
+                self.remove(self.records[key])
+            self.records[key] = annotation
+            for field, index in self.postings.items():
+                for value in _field_values(annotation, field):
+                    index.setdefault(value, set()).add(key)
+
+    def remove(self, annotation: Dict[str, Any]) -> None:
+        key = annotation_key(annotation)
+        with self._lock:
+            if self._source is not None or self.records.get(key) is not annotation:
+                return
+            del self.records[key]
+            for field, index in self.postings.items():
+                for value in _field_values(annotation, field):
+                    keys = index.get(value)
+                    if keys is not None:
+                        keys.discard(key)
+                        if not keys:
+                            del index[value]
+
+    def rebuild(self, annotations: Iterable[Dict[str, Any]]) -> None:
+        with self._lock:
+            self.clear()
+            for annotation in annotations:
+                self.add(annotation)
+
+    def _range_keys(self, field: str, spec: str) -> Set[AnnotationKey]:
+        """Keys whose numeric ``field`` matches "n", "n+" or "a-b"."""
+        try:
+            if spec.endswith("+"):
+                low, high = int(spec[:-1]), None
+            elif "-" in spec.strip("-"):
+                low_text, high_text = spec.split("-", 1)
+                low, high = int(low_text), int(high_text)
+            else:
+                low = high = int(spec)
+        except ValueError:
+            raise QueryError(f"Invalid value for {field}: {spec}")
+
+        keys = set()
+        # Iterate over the distinct values, not over the annotations
+        for value, posting in self.postings[field].items():
+            if isinstance(value, int) and not isinstance(value, bool) and value >= low \
+                    and (high is None or value <= high):
+                keys |= posting
+        return keys
+
+    def candidate_sets(self, filters: Dict[str, List[str]]) -> List[Set[AnnotationKey]]:
+        """Posting sets for each filter; a record matches if it is in all of them."""
+        sets = []
+        for field, specs in filters.items():
+            if field not in self.postings:
+                raise QueryError(f"Unknown filter field: {field}")
+            for spec in specs:
+                if field == "caption":
+                    tokens = tokenize(spec)
+                    if not tokens:
+                        raise QueryError("Caption filter has no words")
+                    sets.extend(self.postings[field].get(token, set()) for token in tokens)
+                elif field in NUMERIC_FIELDS:
+                    sets.append(self._range_keys(field, spec))
+                else:
+                    sets.append(self.postings[field].get(_normalize(spec), set()))
+        return sets
+
+    def query(self, filters: Dict[str, List[str]], sort: Optional[str] = None,
+              offset: int = 0, limit: int = DEFAULT_LIMIT) -> Dict[str, Any]:
+        """Run a conjunctive query.
+
+        Args:
+            filters: Field name to list of values; all of them must match
+            sort: Field to sort by, prefixed with "-" for descending order
+            offset: Number of results to skip
+            limit: Maximum number of results to return
+
+        Returns:
+            Dict: Total number of matches and the requested page of annotations
+        """
+        descending = bool(sort) and sort.startswith("-")
+        sort_field = sort.lstrip("-") if sort else None
+        if sort_field is not None and sort_field not in SORT_FIELDS:
+            raise QueryError(f"Cannot sort by {sort_field}")
+
+        with self._lock:
+            self._ensure_built()
+            sets = self.candidate_sets(filters)
+            if sets:
+                # Intersect starting from the smallest posting set
+                sets.sort(key=len)
+                result = set(sets[0])
+                for keys in sets[1:]:
+                    if not result:
+                        break
+                    result &= keys
+            else:
+                result = set(self.records)
+
+            matches = [self.records[key] for key in result]
+
+        if sort_field is not None:
+            matches.sort(key=lambda a: _sort_key(a, sort_field), reverse=descending)
+        else:
+            # Default to file order within an image
+            matches.sort(key=lambda a: _sort_key(a, "image_index"))
+
+        return {
+            "total": len(matches),
+            "offset": offset,
+            "limit": limit,
+            "annotations": matches[offset:offset + limit],
+        }
+
+
+def _sort_key(annotation: Dict[str, Any], field: str) -> Tuple:
+    if field == "caption":
+        value = annotation.get("normal_caption", "")
+    elif field in ("annotation_id", "image_index"):
+        value = annotation.get(field)
+    else:
+        value = (annotation.get("categories") or {}).get(field)
+    value = _normalize(value)
+    # Missing values sort last; numbers before strings
+    if value is None:
+        return (2, 0, "")
+    if isinstance(value, (int, float)):
+        return (0, value, "")
+    return (1, 0, str(value))
+
+
+# Index over the annotations currently held by data_service
+annotation_index = AnnotationIndex()
+annotation_index.clear()
+
+
+def _handle_change(event: str, annotation: Optional[Dict[str, Any]],
+                   previous: Optional[Dict[str, Any]]) -> None:
+    if event == "load":
+        annotation_index.invalidate(lambda: data_service.output_data)
+    elif event == "save":
+        if previous is not None:
+            annotation_index.remove(previous)
+        annotation_index.add(annotation)
+    elif event == "delete":
+        annotation_index.remove(annotation)
+
+
+data_service.add_change_listener(_handle_change)
+annotation_index.invalidate(lambda: data_service.output_data)
+
+
+def parse_query_args(args: Dict[str, List[str]]) -> Tuple[Dict[str, List[str]], Optional[str], int, int]:
+    """Split request arguments into filters, sort field and pagination.
+
+    Args:
+        args: Mapping of argument name to list of values
+
+    Returns:
+        Tuple: filters, sort, offset and limit
+    """
+    filters = {}
+    sort = None
+    offset, limit = 0, DEFAULT_LIMIT
+    for name, values in args.items():
+        if name == "sort":
+            sort = values[-1]
+        elif name in ("offset", "limit"):
+            try:
+                value = int(values[-1])
+            except ValueError:
+                raise QueryError(f"Invalid {name}: {values[-1]}")
+            if value < 0:
+                raise QueryError(f"Invalid {name}: {value}")
+            if name == "offset":
+                offset = value
+            else:
+                limit = min(value, MAX_LIMIT)
+        elif name == "cache":
+            # Cache-busting parameter added by the client
+            continue
+        else:
+            filters[name] = values
+    return filters, sort, offset, limit
+
+
+def query_annotations(args: Dict[str, List[str]]) -> Dict[str, Any]:
+    """Query saved annotations.
+
+    Supported filters are hops, type, occluded, empty_case, distractors,
+    image_index and caption. Numeric fields accept "n", "n+" and "a-b";
+    repeating a filter requires all of its values to match (e.g. two
+    ``type`` values), and caption matches annotations containing every word.
+
+    Args:
+        args: Request arguments, e.g. ``{"hops": ["3"], "type": ["exclude"]}``
+
+    Returns:
+        Dict: Query results or an error
+    """
+    try:
+        filters, sort, offset, limit = parse_query_args(args)
+        data_service.refresh_shards()
+        return annotation_index.query(filters, sort, offset, limit)
+    except QueryError as e:
+        return {"error": str(e)}
@@ -0,0 +1,241 @@
+"""Output storage partitioned by image index range for the RefCOCOS Annotator.
+
+When ``RANGE_SHARD_DIR`` is configured, annotations are kept in shard files
+that each hold the annotations of ``RANGE_SHARD_SIZE`` consecutive images
+instead of in one ``OUTPUT_FILE``. A save or delete rewrites only the shard of
+the annotation's image, so the cost of a write depends on the shard size and
+not on the size of the dataset. Shards use the output file layout::
+
+    manifest.json           schema version, shard size and the shard files
+    range-000000.json       annotations of images 0 .. RANGE_SHARD_SIZE-1
+    range-000500.json       ...
+    unindexed.json          annotations without a usable image_index
+
+The manifest is only rewritten when a shard is added, before the new shard
+file is written, so a listed shard that does not exist yet is simply empty.
+``utils/range_shards.py`` converts between this layout and a single file.
+"""
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Tuple
+
+from refcocos_annotator.services import migration_service
+from refcocos_annotator.utils.file_utils import atomic_write_json, atomic_writer, write_json_array
+
+MANIFEST_NAME = "manifest.json"
+UNINDEXED_NAME = "unindexed.json"
+# Shard number of annotations without a usable image_index
+UNINDEXED = -1
+# Names of shard files, listed in the manifest or left over from an earlier store
+SHARD_NAME_PATTERN = re.compile(r"^(range-\d+|unindexed)\.json$")
+# Number of shards read at the same time when loading
+LOAD_WORKERS = min(8, os.cpu_count() or 1)
+
+RecordKey = Tuple[str, Any]
+
+
+def _record_key(record: Dict[str, Any]) -> RecordKey:
+    return record.get("image", ""), record.get("annotation_id")
+
+
+def _read_shard(path: str) -> Tuple[int, List[Dict[str, Any]]]:
+    """Schema version and records of a shard file; a missing shard is empty."""
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return migration_service.SCHEMA_VERSION, []
+    return migration_service.split_output(json.loads(raw))
+
+
+class RangeStore:
+    """Annotations of a shard directory, grouped by shard in memory."""
+
+    def __init__(self, directory: str, shard_size: int):
+        self.directory = directory
+        # The manifest's shard size wins once the store exists
+        self.shard_size = shard_size
+        self._shards: Dict[int, Dict[RecordKey, Dict[str, Any]]] = {}
+        self._shard_of_key: Dict[RecordKey, int] = {}
+        self._listed: set = set()
+        self._locks: Dict[int, threading.Lock] = {}
+        self._guard = threading.Lock()
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, MANIFEST_NAME)
+
+    def exists(self) -> bool:
+        """Whether the directory holds a store (i.e. has a manifest)."""
+        return os.path.exists(self.manifest_path)
+
+    def shard_of(self, record: Dict[str, Any]) -> int:
+        """Shard number of a record."""
+        index = record.get("image_index")
+        if isinstance(index, int) and not isinstance(index, bool) and index >= 0:
+            return index // self.shard_size
+        return UNINDEXED
+
+    def shard_path(self, shard: int) -> str:
+        """Path of a shard file."""
+        name = UNINDEXED_NAME if shard == UNINDEXED else f"range-{shard * self.shard_size:06d}.json"
+        return os.path.join(self.directory, name)
+
+    def fingerprint(self) -> Tuple[Tuple[str, int, int], ...]:
+        """Names, sizes and mtimes of the files in the directory, to detect changes made elsewhere."""
+        if not os.path.isdir(self.directory):
+            return ()
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                st = entry.stat()
+                entries.append((entry.name, st.st_size, st.st_mtime_ns))
+        return tuple(sorted(entries))
+
+    def _lock_for(self, shard: int) -> threading.Lock:
+        with self._guard:
+            return self._locks.setdefault(shard, threading.Lock())
+
+    def _write_manifest(self) -> None:
+        shards = []
+        for shard in sorted(self._listed):
+            entry = {"file": os.path.basename(self.shard_path(shard))}
+            if shard != UNINDEXED:
+                entry["first_image_index"] = shard * self.shard_size
+                entry["last_image_index"] = (shard + 1) * self.shard_size - 1
+            shards.append(entry)
+        atomic_write_json(self.manifest_path, {
+            "schema_version": migration_service.SCHEMA_VERSION,
+            "shard_size": self.shard_size,
+            "shards": shards,
+        })
+
+    def _write_shard(self, shard: int, records: List[Dict[str, Any]]) -> None:
+        with atomic_writer(self.shard_path(shard)) as f:
+            write_json_array(f, records, key="annotations",
+                             header={"schema_version": migration_service.SCHEMA_VERSION})
+
+    def load(self, workers: int = LOAD_WORKERS) -> Tuple[int, List[Dict[str, Any]]]:
+        """Read all shards listed in the manifest in parallel.
+
+        Later saves and deletes rewrite the shards as loaded; after migrating
+        the records, persist them with ``write_all`` instead.
+
+        Args:
+            workers: Number of shards read at the same time
+
+        Returns:
+            Tuple[int, List]: Lowest schema version among the shards and all
+            records, least recently saved first
+        """
+        listed = self._read_manifest()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            loaded = list(pool.map(_read_shard, [path for _, path in listed]))
+
+        with self._guard:
+            self._shards, self._shard_of_key = {}, {}
+            for (shard, _), (_, shard_records) in zip(listed, loaded):
+                group = {_record_key(record): record for record in shard_records}
+                self._shards[shard] = group
+                self._shard_of_key.update(dict.fromkeys(group, shard))
+            self._listed = set(self._shards)
+
+        version = min((shard_version for shard_version, _ in loaded), default=migration_service.SCHEMA_VERSION)
+        records = [record for _, shard_records in loaded for record in shard_records]
+        # Keep the most recent save last, as in a single output file
+        records.sort(key=lambda record: record.get("updated_at") or 0)
+        return version, records
+
+    def iter_records(self) -> Iterator[Dict[str, Any]]:
+        """Stream the records of all listed shards, one shard in memory at a time.
+
+        Records are not migrated and come in shard order, not save order.
+        """
+        for _, path in self._read_manifest():
+            yield from _read_shard(path)[1]
+
+    def _read_manifest(self) -> List[Tuple[int, str]]:
+        """Shard numbers and paths listed in the manifest; adopts its shard size."""
+        with open(self.manifest_path, "r") as f:
+            manifest = json.load(f)
+        self.shard_size = manifest["shard_size"]
+        return [(self._shard_number(entry), os.path.join(self.directory, entry["file"]))
+                for entry in manifest["shards"]]
+
+    def _shard_number(self, entry: Dict[str, Any]) -> int:
+        if "first_image_index" not in entry:
+            return UNINDEXED
+        return entry["first_image_index"] // self.shard_size
+
+    def write_all(self, records: List[Dict[str, Any]]) -> int:
+        """Write records as a new store, e.g. when converting a single output file.
+
+        Args:
+            records: All annotation records
+
+        Returns:
+            int: Number of shard files written
+        """
+        with self._guard:
+            self._shards, self._shard_of_key = {}, {}
+            for record in records:
+                shard = self.shard_of(record)
+                key = _record_key(record)
+                self._shards.setdefault(shard, {})[key] = record
+                self._shard_of_key[key] = shard
+
+            os.makedirs(self.directory, exist_ok=True)
+            for shard, group in self._shards.items():
+                self._write_shard(shard, list(group.values()))
+            # The manifest goes last: a directory without one is not a store yet.
+            # Shards of an earlier store that are not rewritten are dropped from it.
+            self._listed = set(self._shards)
+            self._write_manifest()
+            self._remove_unlisted()
+        return len(self._shards)
+
+    def _remove_unlisted(self) -> None:
+        """Delete shard files of an earlier store, e.g. one with another shard size."""
+        listed = {os.path.basename(self.shard_path(shard)) for shard in self._listed}
+        for name in os.listdir(self.directory):
+            if SHARD_NAME_PATTERN.match(name) and name not in listed:
+                os.remove(os.path.join(self.directory, name))
+
+    def apply(self, op: str, annotation: Dict[str, Any]) -> None:
+        """Persist a save or delete by rewriting the shard of the annotation.
+
+        Args:
+            op: "save" or "delete"
+            annotation: The saved annotation, or the deleted one
+        """
+        key = _record_key(annotation)
+        shard = self.shard_of(annotation)
+        with self._guard:
+            moved_from = self._shard_of_key.get(key)
+        if moved_from is not None and moved_from != shard:
+            # The image index changed; drop the record from its old shard
+            self._rewrite(moved_from, lambda records: records.pop(key, None))
+        if op == "save":
+            self._rewrite(shard, lambda records: records.__setitem__(key, annotation))
+            with self._guard:
+                self._shard_of_key[key] = shard
+        else:
+            self._rewrite(shard, lambda records: records.pop(key, None))
+            with self._guard:
+                self._shard_of_key.pop(key, None)
+
+    def _rewrite(self, shard: int, change) -> None:
+        with self._lock_for(shard):
+            with self._guard:
+                records = self._shards.setdefault(shard, {})
+                change(records)
+                snapshot = list(records.values())
+                added = shard not in self._listed
+                if added:
+                    self._listed.add(shard)
+                    self._write_manifest()
+            self._write_shard(shard, snapshot)
+
@@ -0,0 +1,196 @@
+"""Work scheduler for the RefCOCOS Annotator.
+
+Images that still need annotations are kept in a priority queue ordered by
+how many annotations they already have and then by dataset order. An
+annotator asking for work gets a lease on the front image; leased images are
+never handed to anyone else until the lease is released or expires.
+Annotation counts follow ``data_service`` changes, and each change costs
+one heap operation, so handing out the next task does not depend on how
+much of the dataset is already done.
+"""
+import heapq
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from refcocos_annotator import config
+from refcocos_annotator.services import data_service
+from refcocos_annotator.services.shard_service import sanitize_annotator
+
+
+class Scheduler:
+    """Priority queue of images needing annotations with expiring leases."""
+
+    def __init__(self, target: int, lease_seconds: float):
+        self._lock = threading.Lock()
+        self.target = target
+        self.lease_seconds = lease_seconds
+        self.num_images = 0
+        self.counts: List[int] = []
+        # Heap of (annotation count, image index); entries whose count is out
+        # of date are skipped when popped
+        self._queue: List[Tuple[int, int]] = []
+        self._queued: Dict[int, int] = {}
+        # image index -> (annotator, expiry), annotator -> image index
+        self.leases: Dict[int, Tuple[str, float]] = {}
+        self._by_annotator: Dict[str, int] = {}
+        # Heap of (expiry, image index) used to find expired leases
+        self._expiry: List[Tuple[float, int]] = []
+
+    def rebuild(self, num_images: int, counts: List[int]) -> None:
+        """Reset the queue from per-image annotation counts; existing leases are dropped."""
+        with self._lock:
+            self.num_images = num_images
+            self.counts = counts
+            self.leases, self._by_annotator, self._expiry = {}, {}, []
+            self._queue = [(count, index) for index, count in enumerate(counts) if count < self.target]
+            heapq.heapify(self._queue)
+            self._queued = {index: count for count, index in self._queue}
+
+    def _enqueue(self, index: int) -> None:
+        count = self.counts[index]
+        if count < self.target and index not in self.leases and self._queued.get(index) != count:
+            self._queued[index] = count
+            heapq.heappush(self._queue, (count, index))
+
+    def _release(self, index: int) -> None:
+        annotator, _ = self.leases.pop(index)
+        if self._by_annotator.get(annotator) == index:
+            del self._by_annotator[annotator]
+        self._enqueue(index)
+
+    def _expire(self, now: float) -> None:
+        while self._expiry and self._expiry[0][0] <= now:
+            expiry, index = heapq.heappop(self._expiry)
+            lease = self.leases.get(index)
+            # Renewed or released leases leave stale expiry entries behind
+            if lease is not None and lease[1] == expiry:
+                self._release(index)
+
+    def _lease(self, index: int, annotator: str, now: float) -> float:
+        expiry = now + self.lease_seconds
+        self.leases[index] = (annotator, expiry)
+        self._by_annotator[annotator] = index
+        heapq.heappush(self._expiry, (expiry, index))
+        return expiry
+
+    def next_task(self, annotator: str, now: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Lease the next image for ``annotator``.
+
+        An annotator holding a lease on an image that still needs work gets
+        the same image back with a renewed lease.
+
+        Args:
+            annotator: Annotator name
+            now: Current time, for testing
+
+        Returns:
+            Dict: The leased image index and lease expiry, or None if no image needs work
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._expire(now)
+
+            index = self._by_annotator.get(annotator)
+            if index is not None:
+                if self.counts[index] < self.target:
+                    return self._task(index, self._lease(index, annotator, now))
+                self._release(index)
+
+            while self._queue:
+                count, index = heapq.heappop(self._queue)
+                if self._queued.get(index) != count:
+                    continue
+                del self._queued[index]
+                if index in self.leases or self.counts[index] >= self.target:
+                    continue
+                return self._task(index, self._lease(index, annotator, now))
+            return None
+
+    def release_task(self, annotator: str, index: int) -> bool:
+        """Give up a lease; the image is queued again if it still needs work.
+
+        Returns:
+            bool: Whether ``annotator`` held a lease on ``index``
+        """
+        with self._lock:
+            lease = self.leases.get(index)
+            if lease is None or lease[0] != annotator:
+                return False
+            self._release(index)
+            return True
+
+    def update_count(self, index: int, delta: int) -> None:
+        """Adjust an image's annotation count after a save or delete."""
+        with self._lock:
+            if 0 <= index < len(self.counts):
+                self.counts[index] = max(0, self.counts[index] + delta)
+                self._enqueue(index)
+
+    def _task(self, index: int, expiry: float) -> Dict[str, Any]:
+        return {"index": index, "lease_expires": expiry, "annotations": self.counts[index], "target": self.target}
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            self._expire(time.time())
+            return {
+                "images": self.num_images,
+                "queued": len(self._queued),
+                "leased": len(self.leases),
+                "done": sum(1 for count in self.counts if count >= self.target),
+            }
+
+
+scheduler = Scheduler(config.TASK_TARGET_ANNOTATIONS, config.TASK_LEASE_SECONDS)
+
+
+def _rebuild() -> None:
+    images = (data_service.multiple_instances_data or {}).get("images", [])
+    counts = [0] * len(images)
+    for annotation in data_service.output_data:
+        index = data_service.image_path_to_index.get(annotation.get("image", ""))
+        if index is not None:
+            counts[index] += 1
+    scheduler.rebuild(len(images), counts)
+
+
+def _handle_change(event: str, annotation: Optional[Dict[str, Any]],
+                   previous: Optional[Dict[str, Any]]) -> None:
+    if event == "load":
+        _rebuild()
+    elif event == "save":
+        if previous is not None:
+            # An edit moves the annotation at most between images
+            scheduler.update_count(data_service.image_path_to_index.get(previous.get("image", ""), -1), -1)
+        scheduler.update_count(data_service.image_path_to_index.get(annotation.get("image", ""), -1), 1)
+    elif event == "delete":
+        scheduler.update_count(data_service.image_path_to_index.get(annotation.get("image", ""), -1), -1)
+
+
+data_service.add_change_listener(_handle_change)
+_rebuild()
+
+
+def next_task(annotator: Optional[str]) -> Dict[str, Any]:
+    """Lease the next image needing annotations for an annotator.
+
+    Args:
+        annotator: Annotator name from the request
+
+    Returns:
+        Dict: The task, including the image ID, or an error
+    """
+    if not data_service.multiple_instances_data:
+        return {"error": "No data loaded"}
+
+    data_service.refresh_shards()
+    task = scheduler.next_task(sanitize_annotator(annotator))
+    if task is None:
+        return {"index": None, "message": "No images need annotations"}
+    task["image_id"] = data_service.multiple_instances_data["images"][task["index"]]["image_id"]
+    return task
+
+
+def release_task(annotator: Optional[str], index: int) -> bool:
+    """Release an annotator's lease on an image."""
+    return scheduler.release_task(sanitize_annotator(annotator), index)
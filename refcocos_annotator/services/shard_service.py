@@ -0,0 +1,263 @@
+"""Per-annotator output shards for the RefCOCOS Annotator.
+
+When ``ANNOTATOR_SHARD_DIR`` is configured, saves and deletes are appended as
+one-line JSON operations to ``<annotator>.jsonl`` in that directory instead
+of rewriting ``OUTPUT_FILE``. Every annotator writes to their own file, so
+writers never contend. ``OUTPUT_FILE`` stays the merged base; the live view
+is the base with all shard operations replayed on top, and
+``utils/merge_shards.py`` folds the shards back into the base offline.
+
+Replaying an operation is idempotent (a save upserts, a delete of a missing
+record is a no-op), so shards may safely be read more than once.
+
+Writers hold an ``flock`` on the shard while appending, and append again to
+the new file if the shard was renamed while they waited, so once
+``wait_for_writers`` returns for a renamed shard nothing more is written to it.
+"""
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows; merge_shards.py then relies on rereading the shards
+    fcntl = None
+
+SHARD_SUFFIX = ".jsonl"
+# Shards being folded into the base by merge_shards.py keep this extra suffix
+MERGING_SUFFIX = ".merging"
+DEFAULT_ANNOTATOR = "default"
+
+_ANNOTATOR_RE = re.compile(r"[^A-Za-z0-9_.-]+")
+
+# One lock per annotator shard; different annotators never wait on each other
+_shard_locks: Dict[str, threading.Lock] = {}
+_shard_locks_guard = threading.Lock()
+
+Operation = Dict[str, Any]
+RecordKey = Tuple[str, str]
+
+
+def sanitize_annotator(annotator: Optional[str]) -> str:
+    """Turn an annotator name into a safe shard file stem.
+
+    Args:
+        annotator: Annotator name from the request
+
+    Returns:
+        str: Sanitized name, or the default annotator
+    """
+    name = _ANNOTATOR_RE.sub("_", (annotator or "").strip()).strip("._")
+    return name[:64] or DEFAULT_ANNOTATOR
+
+
+def shard_path(shard_dir: str, annotator: str) -> str:
+    """Path of an annotator's shard file."""
+    return os.path.join(shard_dir, sanitize_annotator(annotator) + SHARD_SUFFIX)
+
+
+def list_shards(shard_dir: str, include_merging: bool = True) -> List[str]:
+    """List shard files in ``shard_dir``.
+
+    Args:
+        shard_dir: Shard directory
+        include_merging: Also return shards that are being merged
+
+    Returns:
+        List[str]: Shard file paths in name order
+    """
+    if not os.path.isdir(shard_dir):
+        return []
+    suffixes = (SHARD_SUFFIX, SHARD_SUFFIX + MERGING_SUFFIX) if include_merging else (SHARD_SUFFIX,)
+    return sorted(os.path.join(shard_dir, name) for name in os.listdir(shard_dir) if name.endswith(suffixes))
+
+
+def _lock_for(path: str) -> threading.Lock:
+    with _shard_locks_guard:
+        return _shard_locks.setdefault(path, threading.Lock())
+
+
+def append_operation(shard_dir: str, annotator: str, op: str, annotation: Dict[str, Any]) -> Operation:
+    """Append a save or delete operation to an annotator's shard.
+
+    Args:
+        shard_dir: Shard directory
+        annotator: Annotator performing the operation
+        op: "save" or "delete"
+        annotation: The saved annotation, or the deleted one
+
+    Returns:
+        Dict: The operation that was written
+    """
+    entry = {
+        "op": op,
+        "ts": int(time.time() * 1000),
+        "annotator": sanitize_annotator(annotator),
+        "image": annotation.get("image", ""),
+        "annotation_id": annotation.get("annotation_id"),
+    }
+    if op == "save":
+        entry["annotation"] = annotation
+
+    path = shard_path(shard_dir, annotator)
+    line = json.dumps(entry, separators=(",", ":")) + "\n"
+    with _lock_for(path):
+        os.makedirs(shard_dir, exist_ok=True)
+        while True:
+            # A single write in append mode keeps lines whole even with several processes
+            with open(path, "a") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    if os.fstat(f.fileno()).st_ino != _inode(path):
+                        # merge_shards.py renamed the shard meanwhile; append to the new one
+                        continue
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            return entry
+
+
+def _inode(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_ino
+    except FileNotFoundError:
+        return None
+
+
+def wait_for_writers(path: str) -> None:
+    """Wait until appends in progress on a renamed shard have finished.
+
+    Writers that opened the shard before it was renamed finish their write
+    under the shard's ``flock``; later ones see the rename and write to the
+    new file instead.
+    """
+    if fcntl is None:
+        return
+    with open(path, "rb") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+
+def read_operations(path: str, offset: int = 0) -> Tuple[List[Operation], int]:
+    """Read complete operations appended to a shard after ``offset``.
+
+    A trailing line without a newline (a write in progress) is left for the
+    next read.
+
+    Args:
+        path: Shard file path
+        offset: Byte offset already consumed
+
+    Returns:
+        Tuple[List, int]: New operations and the new offset
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+
+    end = data.rfind(b"\n") + 1
+    ops = []
+    for line in data[:end].splitlines():
+        if line.strip():
+            try:
+                ops.append(json.loads(line))
+            except json.JSONDecodeError:
+                print(f"Warning: Skipping malformed line in {path}")
+    return ops, offset + end
+
+
+def read_all_operations(paths: List[str]) -> Tuple[List[Operation], Dict[str, int]]:
+    """Read every operation from ``paths`` in timestamp order.
+
+    Args:
+        paths: Shard file paths
+
+    Returns:
+        Tuple[List, Dict]: Operations sorted by time and the consumed offset per file
+    """
+    ops = []
+    offsets = {}
+    for path in paths:
+        file_ops, offsets[path] = read_operations(path)
+        # Sort key keeps per-file order for operations in the same millisecond
+        ops.extend(((op.get("ts", 0), path, n), op) for n, op in enumerate(file_ops))
+    ops.sort(key=lambda item: item[0])
+    return [op for _, op in ops], offsets
+
+
+def apply_operations(records: List[Dict[str, Any]],
+                     ops: List[Operation]) -> List[Tuple[str, Dict[str, Any], Optional[Dict[str, Any]]]]:
+    """Replay operations onto a list of records in place.
+
+    Args:
+        records: Annotation records to update
+        ops: Operations to replay
+
+    Returns:
+        List: (event, annotation, previous) for every operation that changed something
+    """
+    positions: Dict[RecordKey, int] = {
+        (r.get("image", ""), r.get("annotation_id")): i for i, r in enumerate(records)
+    }
+
+    changes = []
+    deleted = False
+    for op in ops:
+        key = (op.get("image", ""), op.get("annotation_id"))
+        position = positions.get(key)
+
+        if op.get("op") == "save":
+            annotation = op["annotation"]
+            if position is None:
+                positions[key] = len(records)
+                records.append(annotation)
+                changes.append(("save", annotation, None))
+            elif records[position] != annotation:
+                previous = records[position]
+                records[position] = annotation
+                changes.append(("save", annotation, previous))
+        elif op.get("op") == "delete" and position is not None:
+            # Leave a hole and compact once at the end instead of shifting per delete
+            changes.append(("delete", records[position], None))
+            records[position] = None
+            del positions[key]
+            deleted = True
+
+    if deleted:
+        records[:] = [r for r in records if r is not None]
+    return changes
+
+
+def stream_with_operations(records: Iterable[Dict[str, Any]], ops: List[Operation]) -> Iterator[Dict[str, Any]]:
+    """Streaming counterpart of ``apply_operations`` for records read lazily.
+
+    Only the final state per operated record is kept in memory, so the base
+    records can be streamed from disk.
+
+    Args:
+        records: Base annotation records, e.g. from ``iter_json_array``
+        ops: Operations to replay, in order
+
+    Yields:
+        Dict: Records of the live store; new records come last
+    """
+    final: Dict[RecordKey, Optional[Dict[str, Any]]] = {}
+    for op in ops:
+        key = (op.get("image", ""), op.get("annotation_id"))
+        final[key] = op["annotation"] if op.get("op") == "save" else None
+
+    for record in records:
+        key = (record.get("image", ""), record.get("annotation_id"))
+        if key in final:
+            replacement = final.pop(key)
+            if replacement is not None:
+                yield replacement
+        else:
+            yield record
+
+    for record in final.values():
+        if record is not None:
+            yield record
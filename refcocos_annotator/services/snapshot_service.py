@@ -0,0 +1,128 @@
+"""Binary startup snapshots for the RefCOCOS Annotator.
+
+Parsing the JSON data files dominates start-up and ``/api/reload``. After a
+file has been parsed, the resulting Python objects are pickled to
+``SNAPSHOT_DIR`` together with the size, mtime and content hash of the
+source file. A later load whose source still matches unpickles the snapshot
+instead of parsing JSON; if only the mtime differs (e.g. the file was
+touched or copied) the content hash decides.
+
+Snapshots are only ever read from the local snapshot directory, which must
+not be writable by untrusted users since unpickling can execute code.
+"""
+import gc
+import hashlib
+import os
+import pickle
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional, Tuple
+
+from refcocos_annotator import config
+from refcocos_annotator.services.metrics_service import timed
+from refcocos_annotator.utils.file_utils import atomic_writer
+
+# Bump when the layout of cached payloads changes
+SNAPSHOT_FORMAT = 1
+# Protocol 5 (Python 3.8+) pickles large buffers out of band and loads fastest
+SNAPSHOT_PROTOCOL = min(5, pickle.HIGHEST_PROTOCOL)
+
+_CHUNK_SIZE = 1 << 20
+
+
+def file_digest(path: str) -> str:
+    """BLAKE2b digest of a file's content."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextmanager
+def gc_paused() -> Iterator[None]:
+    """Pause the cyclic garbage collector while building many objects.
+
+    Loading creates millions of small containers but no garbage, and the
+    collector would otherwise run repeatedly over the growing heap.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def snapshot_path(snapshot_dir: str, source: str, kind: str) -> str:
+    """Snapshot file for a source file and payload kind."""
+    name = hashlib.sha1(os.path.abspath(source).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(snapshot_dir, f"{kind}_{name}.pickle")
+
+
+def _read_snapshot(path: str, source: str, kind: str, st: os.stat_result) -> Optional[Any]:
+    """Payload of a snapshot if it still matches ``source``, else None."""
+    try:
+        with open(path, "rb") as f:
+            # The small header is a separate pickle so a stale snapshot is
+            # rejected without unpickling its payload
+            header = pickle.load(f)
+            if header.get("format") != SNAPSHOT_FORMAT or header.get("kind") != kind \
+                    or header.get("size") != st.st_size:
+                return None
+            if header.get("mtime_ns") != st.st_mtime_ns and header.get("digest") != file_digest(source):
+                return None
+            with gc_paused():
+                return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+        return None
+
+
+def _write_snapshot(path: str, kind: str, st: os.stat_result, digest: str, payload: Any) -> None:
+    header = {
+        "format": SNAPSHOT_FORMAT,
+        "kind": kind,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "digest": digest,
+    }
+    try:
+        with atomic_writer(path, "wb") as f:
+            pickle.dump(header, f, protocol=SNAPSHOT_PROTOCOL)
+            pickle.dump(payload, f, protocol=SNAPSHOT_PROTOCOL)
+    except OSError as e:
+        print(f"Warning: Could not write snapshot {path}: {e}")
+
+
+def load(source: str, kind: str, parse: Callable[[bytes], Any]) -> Tuple[Any, bool]:
+    """Load the parsed form of ``source``, from its snapshot when possible.
+
+    Args:
+        source: JSON data file
+        kind: Name of the payload, part of the snapshot file name
+        parse: Builds the payload from the raw file content
+
+    Returns:
+        Tuple[Any, bool]: The payload and whether it came from a snapshot
+    """
+    st = os.stat(source)
+    path = snapshot_path(config.SNAPSHOT_DIR, source, kind) if config.SNAPSHOT_DIR else None
+
+    if path is not None and os.path.exists(path):
+        with timed("snapshot_load"):
+            payload = _read_snapshot(path, source, kind, st)
+        if payload is not None:
+            return payload, True
+
+    with timed("json_parse"):
+        with open(source, "rb") as f:
+            raw = f.read()
+        with gc_paused():
+            payload = parse(raw)
+
+    if path is not None:
+        digest = hashlib.blake2b(raw, digest_size=16).hexdigest()
+        with timed("snapshot_write"):
+            _write_snapshot(path, kind, st, digest, payload)
+    return payload, False
+
@@ -0,0 +1,230 @@
+"""Bulk validation of saved annotations for the RefCOCOS Annotator.
+
+All annotations are checked at once: their boxes and image sizes are
+gathered into numpy arrays and every rule is evaluated as array operations
+over the whole set, including the IoU of each annotation against every COCO
+instance of its image. Validating 100k annotations takes a few seconds, most
+of it spent reading the records into arrays.
+
+numpy is imported lazily, so the annotator itself runs without it.
+"""
+from typing import Any, Dict, Iterable, List, Optional
+
+from refcocos_annotator.services.metrics_service import timed
+
+# Rule name -> description, in report order
+RULES = {
+    "unknown_image": "image is not in the multiple instances file",
+    "image_index": "image_index does not point at the annotation's image",
+    "image_size": "width/height differ from the source image",
+    "solution_missing": "solution is not a box of four numbers",
+    "solution_degenerate": "solution has zero or negative width or height",
+    "solution_out_of_bounds": "solution extends beyond the image",
+    "normalized_solution": "normalized_solution does not match solution",
+    "instance_match": "solution does not match any COCO instance",
+}
+
+DEFAULT_IOU_THRESHOLD = 0.5
+# The UI rounds normalized coordinates half up, Python half to even
+DEFAULT_NORMALIZED_TOLERANCE = 1
+
+
+def require_numpy():
+    """Import numpy, which the bulk checks need but the annotator itself does not."""
+    try:
+        import numpy as np
+    except ImportError:
+        raise RuntimeError("Annotation validation requires numpy: pip install numpy")
+    return np
+
+
+def parse_box(value: Any) -> Optional[List[float]]:
+    """A box of four numbers as floats, or None."""
+    if not isinstance(value, (list, tuple)) or len(value) != 4:
+        return None
+    try:
+        return [float(v) for v in value]
+    except (TypeError, ValueError):
+        return None
+
+
+def solution_array(np, records: List[Dict[str, Any]], field: str = "solution"):
+    """Boxes of a field of all records as rows, NaN where the field is not a box."""
+    boxes = np.full((len(records), 4), np.nan)
+    for i, record in enumerate(records):
+        box = parse_box(record.get(field))
+        if box is not None:
+            boxes[i] = box
+    return boxes
+
+
+def instance_arrays(np, images: List[Dict[str, Any]]):
+    """COCO instances of all images as arrays.
+
+    Returns:
+        Tuple: [x1, y1, x2, y2] rows of all instances, offsets of each image's
+        first instance (with a final end offset), and the instance count of
+        each instance's category
+    """
+    boxes = []
+    category_counts = []
+    offsets = np.zeros(len(images) + 1, dtype=np.int64)
+    for i, image in enumerate(images):
+        for category in image.get("categories_with_multiple_instances", []):
+            instances = category.get("instances", [])
+            for bbox in instances:
+                x, y, w, h = bbox
+                boxes.append((x, y, x + w, y + h))
+                category_counts.append(category.get("count", len(instances)))
+        offsets[i + 1] = len(boxes)
+    return (np.array(boxes, dtype=np.float64).reshape(-1, 4), offsets,
+            np.array(category_counts, dtype=np.int64))
+
+
+def _area(boxes):
+    return (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+
+def best_matches(np, solutions, image_indices, instances, offsets):
+    """Best matching instance of each solution among the instances of its image.
+
+    Returns:
+        Tuple: Highest IoU of each solution (0 if its image has no instances)
+        and the index of that instance in ``instances`` (-1 if none overlaps)
+    """
+    starts = offsets[image_indices]
+    counts = offsets[image_indices + 1] - starts
+    best = np.zeros(len(solutions))
+    best_instance = np.full(len(solutions), -1, dtype=np.int64)
+    if not counts.sum():
+        return best, best_instance
+
+    # One row per (annotation, instance of its image) pair
+    owner = np.repeat(np.arange(len(solutions)), counts)
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    pair_instance = np.repeat(starts, counts) + np.arange(len(owner)) - first
+    pair_instances = instances[pair_instance]
+    pair_solutions = solutions[owner]
+
+    inter_w = np.clip(np.minimum(pair_solutions[:, 2], pair_instances[:, 2])
+                      - np.maximum(pair_solutions[:, 0], pair_instances[:, 0]), 0, None)
+    inter_h = np.clip(np.minimum(pair_solutions[:, 3], pair_instances[:, 3])
+                      - np.maximum(pair_solutions[:, 1], pair_instances[:, 1]), 0, None)
+    intersection = inter_w * inter_h
+    union = _area(pair_solutions) + _area(pair_instances) - intersection
+    iou = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+    np.maximum.at(best, owner, iou)
+
+    # First pair of each annotation reaching its best IoU
+    winners = np.flatnonzero((iou == best[owner]) & (iou > 0))
+    owners, first_winner = np.unique(owner[winners], return_index=True)
+    best_instance[owners] = pair_instance[winners[first_winner]]
+    return best, best_instance
+
+
+def validate_annotations(annotations: Iterable[Dict[str, Any]], images: List[Dict[str, Any]],
+                         image_path_to_index: Dict[str, int], iou_threshold: float = DEFAULT_IOU_THRESHOLD,
+                         normalized_tolerance: int = DEFAULT_NORMALIZED_TOLERANCE) -> Dict[str, Any]:
+    """Check annotations against their images and each other's fields.
+
+    Args:
+        annotations: Saved annotations
+        images: Image entries from the multiple instances file
+        image_path_to_index: Mapping of "val2017/<file_name>" to image index
+        iou_threshold: Minimum IoU with a COCO instance for ``instance_match``
+        normalized_tolerance: Allowed difference per normalized coordinate
+
+    Returns:
+        Dict: Number of annotations checked and, per violated rule, the
+        offending annotations with details
+    """
+    np = require_numpy()
+
+    with timed("validation_gather"):
+        records = list(annotations)
+        n = len(records)
+        image_index = np.full(n, -1, dtype=np.int64)
+        stored_index = np.full(n, -1, dtype=np.int64)
+        sizes = np.zeros((n, 2), dtype=np.float64)
+        solutions = solution_array(np, records)
+        normalized = solution_array(np, records, "normalized_solution")
+        empty = np.zeros(n, dtype=bool)
+        for i, record in enumerate(records):
+            image_index[i] = image_path_to_index.get(record.get("image", ""), -1)
+            try:
+                stored_index[i] = int(record.get("image_index", -1))
+            except (TypeError, ValueError):
+                pass
+            try:
+                sizes[i] = (float(record.get("width")), float(record.get("height")))
+            except (TypeError, ValueError):
+                sizes[i] = np.nan
+            empty[i] = bool((record.get("categories") or {}).get("empty_case")) and not record.get("solution")
+
+        image_sizes = np.array([(img["width"], img["height"]) for img in images], dtype=np.float64).reshape(-1, 2)
+        instances, offsets, _ = instance_arrays(np, images)
+
+    with timed("validation_rules"), np.errstate(divide="ignore", invalid="ignore"):
+        known = image_index >= 0
+        source = np.where(known, image_index, 0)
+        source_sizes = image_sizes[source] if len(images) else np.full((n, 2), np.nan)
+        has_box = ~np.isnan(solutions).any(axis=1)
+        x1, y1, x2, y2 = solutions.T
+        width, height = source_sizes.T
+        degenerate = has_box & ((x2 <= x1) | (y2 <= y1))
+        boxed = known & has_box & ~degenerate
+
+        expected = np.round(solutions / np.tile(sizes, 2) * 1000)
+        normalized_off = has_box & (np.isnan(normalized).any(axis=1)
+                                    | (np.abs(expected - normalized) > normalized_tolerance).any(axis=1))
+
+        best_iou = np.zeros(n)
+        if boxed.any():
+            best_iou[boxed], _ = best_matches(np, solutions[boxed], image_index[boxed], instances, offsets)
+
+        failed = {
+            "unknown_image": ~known,
+            "image_index": known & (stored_index != image_index),
+            "image_size": known & (sizes != source_sizes).any(axis=1),
+            "solution_missing": ~has_box & ~empty,
+            "solution_degenerate": degenerate,
+            "solution_out_of_bounds": known & has_box & ((x1 < 0) | (y1 < 0) | (x2 > width) | (y2 > height)),
+            "normalized_solution": normalized_off,
+            "instance_match": boxed & (best_iou < iou_threshold),
+        }
+
+    def detail(rule: str, i: int) -> Any:
+        if rule == "image_index":
+            return {"image_index": records[i].get("image_index"), "expected": int(image_index[i])}
+        if rule == "image_size":
+            return {"size": sizes[i].tolist(), "expected": source_sizes[i].tolist()}
+        if rule in ("solution_degenerate", "solution_out_of_bounds"):
+            return {"solution": records[i].get("solution"), "image_size": source_sizes[i].tolist()}
+        if rule == "normalized_solution":
+            return {"normalized_solution": records[i].get("normalized_solution"),
+                    "expected": None if np.isnan(expected[i]).any() else expected[i].astype(int).tolist()}
+        if rule == "instance_match":
+            return {"best_iou": round(float(best_iou[i]), 3)}
+        return None
+
+    violations = {}
+    for rule in RULES:
+        rows = np.flatnonzero(failed[rule])
+        if len(rows):
+            violations[rule] = [
+                {
+                    "annotation_id": records[i].get("annotation_id"),
+                    "image": records[i].get("image"),
+                    "detail": detail(rule, i),
+                }
+                for i in rows
+            ]
+    return {"checked": n, "violations": violations}
+
+
+def summarize(report: Dict[str, Any]) -> str:
+    """One-line summary of a validation report."""
+    if not report["violations"]:
+        return f"{report['checked']} annotations valid"
+    counts = ", ".join(f"{rule}: {len(rows)}" for rule, rows in report["violations"].items())
+    return f"{report['checked']} annotations checked, violations: {counts}"
@@ -52,10 +52,24 @@
         let currentAnnotationIndex = 0;
         let totalAnnotations = 0;
         let currentAnnotationId = null;
+        let storeVersion = null;
+        let boxMatch = null;  // Server match of the drawn custom box against the instances
 
         // Add cache-busting parameter to all API requests
         const cacheBuster = Date.now();
 
+        // Annotator name from ?annotator=... (remembered for later visits);
+        // selects the server-side output shard when sharding is enabled
+        const annotatorParam = new URLSearchParams(window.location.search).get('annotator');
+        if (annotatorParam) {
+            localStorage.setItem('annotator', annotatorParam);
+        }
+        const annotator = annotatorParam || localStorage.getItem('annotator') || '';
+        const jsonHeaders = { 'Content-Type': 'application/json' };
+        if (annotator) {
+            jsonHeaders['X-Annotator'] = annotator;
+        }
+
         // Debug flag - set to true for verbose console logging
         const DEBUG = true;
 
@@ -110,6 +124,8 @@
         const nextAnnotationBtn = document.getElementById('next-annotation-btn');
         const newAnnotationBtn = document.getElementById('new-annotation-btn');
         const deleteAnnotationBtn = document.getElementById('delete-annotation-btn');
+        const undoBtn = document.getElementById('undo-btn');
+        const redoBtn = document.getElementById('redo-btn');
         const annotationProgress = document.getElementById('annotation-progress');
 
         prevAnnotationBtn.addEventListener('click', function() {
@@ -152,6 +168,19 @@
             }
         });
 
+        undoBtn.addEventListener('click', () => undoRedo('undo'));
+        redoBtn.addEventListener('click', () => undoRedo('redo'));
+
+        // Ctrl+Z / Ctrl+Shift+Z (or Ctrl+Y) outside of text fields, which keep their own undo
+        document.addEventListener('keydown', function(e) {
+            if (!(e.ctrlKey || e.metaKey) || ['INPUT', 'TEXTAREA'].includes(e.target.tagName)) return;
+            const key = e.key.toLowerCase();
+            if (key === 'z' || key === 'y') {
+                e.preventDefault();
+                undoRedo(key === 'y' || e.shiftKey ? 'redo' : 'undo');
+            }
+        });
+
         // Replace toggle boxes button with eye icon
         toggleViewIcon.addEventListener('click', function() {
             showOnlySelected = !showOnlySelected;
@@ -603,6 +632,18 @@
             });
 
             customDiv.appendChild(customBboxDiv);
+
+            // Offer to replace the drawn box with the instance it matches
+            if (customBoxCoords !== null && boxMatch && boxMatch.snap) {
+                const snap = boxMatch.snap;
+                const snapDiv = document.createElement('div');
+                snapDiv.className = 'bbox-option';
+                snapDiv.textContent = `Snap to ${snap.category_name} Box ${snap.instance_index + 1} (IoU ${snap.iou.toFixed(2)})` +
+                    (boxMatch.ambiguous ? ' - ambiguous' : '');
+                snapDiv.addEventListener('click', () => selectInstance(snap.category_index, snap.instance_index));
+                customDiv.appendChild(snapDiv);
+            }
+
             bboxSelector.appendChild(customDiv);
 
             // For each category with multiple instances
@@ -624,30 +665,7 @@
                     bboxDiv.textContent = `Box ${bboxIndex + 1}: [${Math.round(x)}, ${Math.round(y)}, ${Math.round(w)}, ${Math.round(h)}]`;
 
                     // Selection event
-                    bboxDiv.addEventListener('click', () => {
-                        // Save custom box coords before changing selection
-                        if (customBoxCoords !== null) {
-                            savedCustomBoxCoords = [...customBoxCoords];
-                        }
-                        
-                        // Update selection
-                        selectedCategoryIndex = catIndex;
-                        selectedBboxIndex = bboxIndex;
-                        selectedBbox = convertBboxFormat(bbox);
-                        customBoxCoords = null;
-                        isDrawingCustomBox = false;
-
-                        // Update UI
-                        updateEmptyCaseStatus(false);
-                        calculateDistractors();
-                        isSavedToFile = false;
-                        updateSaveStatus();
-                        updateStatusMessage();
-
-                        // Redraw all bboxes with new selection
-                        createBboxSelector();
-                        drawBboxes();
-                    });
+                    bboxDiv.addEventListener('click', () => selectInstance(catIndex, bboxIndex));
 
                     categoryDiv.appendChild(bboxDiv);
                 });
@@ -656,6 +674,56 @@
             });
         }
 
+        // Select one of the COCO instance boxes as the annotation's box
+        function selectInstance(catIndex, bboxIndex) {
+            // Save custom box coords before changing selection
+            if (customBoxCoords !== null) {
+                savedCustomBoxCoords = [...customBoxCoords];
+            }
+
+            // Update selection
+            const bbox = currentImageData.categories_with_multiple_instances[catIndex].instances[bboxIndex];
+            selectedCategoryIndex = catIndex;
+            selectedBboxIndex = bboxIndex;
+            selectedBbox = convertBboxFormat(bbox);
+            customBoxCoords = null;
+            isDrawingCustomBox = false;
+
+            // Update UI
+            updateEmptyCaseStatus(false);
+            calculateDistractors();
+            isSavedToFile = false;
+            updateSaveStatus();
+            updateStatusMessage();
+
+            // Redraw all bboxes with new selection
+            createBboxSelector();
+            drawBboxes();
+        }
+
+        // Ask the server which instance a drawn box corresponds to
+        function matchCustomBox(box) {
+            boxMatch = null;
+            fetch(`/api/match/${currentIndex}?bbox=${box.join(',')}`)
+                .then(response => response.json())
+                .then(data => {
+                    if (data.error || customBoxCoords !== box) return;
+                    boxMatch = data;
+                    if (data.snap) {
+                        // The drawn box stands for that instance, so count its category's other instances
+                        distractor.textContent = (data.snap.category_count - 1).toString();
+                        setupDistractorEdit();
+                    }
+                    if (data.ambiguous) {
+                        const [first, second] = data.matches;
+                        status.textContent = `Drawn box overlaps ${first.category_name} Box ${first.instance_index + 1} ` +
+                            `and ${second.category_name} Box ${second.instance_index + 1} almost equally`;
+                    }
+                    createBboxSelector();
+                })
+                .catch(err => console.error('Error matching box:', err));
+        }
+
         // Add function to update status message based on current state
         function updateStatusMessage() {
             // Check what's missing: bbox, caption, category labels
@@ -760,10 +828,13 @@
                 image_index: currentIndex
             };
 
-            // Send to server to save
+            // Send to server to save; an edit only applies to the version we loaded
+            const existing = (savedData[currentImageData.image_id] || []).find(
+                a => a.annotation_id === annotationData.annotation_id
+            );
             fetch(`/api/save_reference?cache=${cacheBuster}`, {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: existing ? versionHeaders(existing) : jsonHeaders,
                 body: JSON.stringify({
                     image_id: currentImageData.image_id,
                     annotation: annotationData
@@ -774,6 +845,7 @@
                 if (data.success) {
                     // Store current annotation ID
                     currentAnnotationId = annotationData.annotation_id;
+                    annotationData.version = data.version;
                     
                     // Update saved data for this image
                     if (!savedData[currentImageData.image_id]) {
@@ -818,6 +890,8 @@
                     updateReferenceCount();
 
                     if (callback) callback();
+                } else if ('current' in data) {
+                    showConflict(data, annotationData.annotation_id);
                 } else {
                     alert('Error: ' + data.message);
                 }
@@ -888,12 +962,39 @@
             });
         }
 
+        // Lease the next image that needs annotations for this annotator
+        function findNextTaskIndex() {
+            return fetch(`/api/next_task?cache=${cacheBuster}`, { method: 'POST', headers: jsonHeaders })
+                .then(response => response.json())
+                .then(data => {
+                    if (data.error || data.index === null) {
+                        debug('No task leased:', data.error || data.message);
+                        return findLastCreatedAnnotationIndex();
+                    }
+                    debug(`Leased image ${data.index} until`, new Date(data.lease_expires * 1000));
+                    return data.index;
+                })
+                .catch(err => {
+                    console.error('Error leasing next task:', err);
+                    return findLastCreatedAnnotationIndex();
+                });
+        }
+
         // Load image and bbox data
         function loadImage(index, callback) {
             debug('Loading image', index);
             savedIndicator.style.display = 'none';
 
-            fetch(`/api/image/${index}?cache=${cacheBuster}`)
+            // Only request as many pixels as the canvas can show
+            const container = document.getElementById('canvas-container');
+            const pixelRatio = window.devicePixelRatio || 1;
+            const maxWidth = Math.ceil(container.clientWidth * pixelRatio);
+            const maxHeight = Math.ceil(container.clientHeight * pixelRatio);
+            const sizeParams = maxWidth && maxHeight ? `&max_width=${maxWidth}&max_height=${maxHeight}` : '';
+
+            // The image itself is fetched by the browser from image_url, which lets
+            // the server pick WebP or JPEG from the Accept header and lets it be cached
+            fetch(`/api/image/${index}?cache=${cacheBuster}&embed=0${sizeParams}`)
                 .then(response => response.json())
                 .then(data => {
                     if (data.error) {
@@ -995,7 +1096,7 @@
                         status.textContent = "Error loading image";
                     };
 
-                    currentImage.src = data.image_data;
+                    currentImage.src = data.image_url || data.image_data;
                 })
                 .catch(err => {
                     console.error('Error loading image data:', err);
@@ -1015,7 +1116,10 @@
 
                     // First load all saved data
                     return fetch(`/api/saved_data?cache=${cacheBuster}`)
-                        .then(response => response.json())
+                        .then(response => {
+                            storeVersion = response.headers.get('X-Store-Version');
+                            return response.json();
+                        })
                         .then(data => {
                             // Store all saved data
                             savedData = data;
@@ -1024,8 +1128,12 @@
                             // Update the reference count
                             updateReferenceCount();
 
-                            // Now find the most recently created annotation image
-                            return findLastCreatedAnnotationIndex();
+                            // Follow other annotators' changes from this version on
+                            subscribeToEvents();
+
+                            // Named annotators get their own image from the scheduler;
+                            // otherwise resume at the most recently created annotation
+                            return annotator ? findNextTaskIndex() : findLastCreatedAnnotationIndex();
                         });
                 })
                 .then(index => {
@@ -1147,6 +1255,7 @@
                 
                 // Store coordinates with safe values
                 customBoxCoords = [safeX1, safeY1, safeX2, safeY2];
+                matchCustomBox(customBoxCoords);
                 
                 // Reset drawing state
                 isDrawingCustomBox = false;
@@ -1407,7 +1516,7 @@
             // Delete the current annotation via API
             fetch(`/api/delete_annotation?cache=${cacheBuster}`, {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: versionHeaders(annotation),
                 body: JSON.stringify({
                     image_id: currentImageData.image_id,
                     annotation_id: annotation.annotation_id
@@ -1475,6 +1584,8 @@
                     }
                     
                     status.textContent = "Annotation deleted successfully!";
+                } else if ('current' in data) {
+                    showConflict(data, annotation.annotation_id);
                 } else {
                     // If server says annotation not found, handle it client-side anyway
                     if (data.message && data.message.includes("not found")) {
@@ -1540,6 +1651,105 @@
             });
         }
 
+        // Apply a save or delete pushed by the server to savedData
+        function applyAnnotationEvent(event) {
+            if (!event.image_id) return;
+            const annotations = savedData[event.image_id] || [];
+            const annotationId = event.type === 'save' ? event.annotation.annotation_id : event.annotation_id;
+            const index = annotations.findIndex(a => a.annotation_id === annotationId);
+
+            if (event.type === 'save') {
+                if (index >= 0) {
+                    annotations[index] = event.annotation;
+                } else {
+                    annotations.push(event.annotation);
+                }
+                savedData[event.image_id] = annotations;
+            } else if (index >= 0) {
+                annotations.splice(index, 1);
+            }
+
+            updateReferenceCount();
+            if (currentImageData && currentImageData.image_id === event.image_id) {
+                totalAnnotations = annotations.length;
+                updateAnnotationProgress();
+            }
+        }
+
+        // Headers for changing a saved annotation only if nobody changed it since we loaded it
+        function versionHeaders(annotation) {
+            return Object.assign({}, jsonHeaders, { 'If-Match': `"${annotation.version || 0}"` });
+        }
+
+        // Someone else changed or deleted the annotation meanwhile: show the server's version instead
+        function showConflict(data, annotationId) {
+            alert(data.message + '. Showing the current version; reapply your changes if needed.');
+            applyAnnotationEvent(data.current
+                ? { type: 'save', image_id: currentImageData.image_id, annotation: data.current }
+                : { type: 'delete', image_id: currentImageData.image_id, annotation_id: annotationId });
+            const annotationIndex = (savedData[currentImageData.image_id] || []).findIndex(
+                a => a.annotation_id === annotationId
+            );
+            if (annotationIndex >= 0) {
+                loadAnnotation(currentIndex, annotationIndex);
+            } else {
+                loadImage(currentIndex);
+            }
+        }
+
+        // Revert or re-apply this annotator's last save or delete and show the affected annotation
+        function undoRedo(action) {
+            fetch(`/api/${action}?cache=${cacheBuster}`, { method: 'POST', headers: jsonHeaders })
+                .then(response => response.json())
+                .then(data => {
+                    status.textContent = data.message;
+                    if (!data.success || data.image_index === null) return;
+
+                    applyAnnotationEvent({
+                        type: data.op,
+                        image_id: data.image_id,
+                        annotation: data.annotation,
+                        annotation_id: data.annotation.annotation_id
+                    });
+                    const annotationIndex = (savedData[data.image_id] || []).findIndex(
+                        a => a.annotation_id === data.annotation.annotation_id
+                    );
+                    if (annotationIndex >= 0) {
+                        loadAnnotation(data.image_index, annotationIndex);
+                    } else {
+                        loadImage(data.image_index);
+                    }
+                })
+                .catch(err => console.error(`Error during ${action}:`, err));
+        }
+
+        // Refetch everything when the server cannot replay the missed events
+        function reloadSavedData() {
+            fetch(`/api/saved_data?cache=${Date.now()}`)
+                .then(response => response.json())
+                .then(data => {
+                    savedData = data;
+                    updateReferenceCount();
+                    if (currentImageData) {
+                        totalAnnotations = (savedData[currentImageData.image_id] || []).length;
+                        updateAnnotationProgress();
+                    }
+                })
+                .catch(err => console.error('Error reloading saved data:', err));
+        }
+
+        // Receive saves and deletes as they happen instead of polling
+        function subscribeToEvents() {
+            if (!window.EventSource) return;
+
+            const url = storeVersion !== null ? `/api/events?since=${storeVersion}` : '/api/events';
+            const source = new EventSource(url);
+            source.addEventListener('save', e => applyAnnotationEvent(JSON.parse(e.data)));
+            source.addEventListener('delete', e => applyAnnotationEvent(JSON.parse(e.data)));
+            source.addEventListener('reload', () => reloadSavedData());
+            source.onerror = () => debug('Event stream interrupted, reconnecting');
+        }
+
         // Fix the updateReferenceCount function to correctly count references
         function updateReferenceCount() {
             // Count all annotations across all images in savedData
@@ -0,0 +1,82 @@
+"""Script to snapshot the annotation file and diff snapshots.
+
+    annotation_history.py snapshot [--name before-cleanup]
+    annotation_history.py list
+    annotation_history.py diff before-cleanup latest
+
+Snapshots are stored content-addressed in HISTORY_DIR (see
+``history_service``), so each snapshot only adds the records that changed.
+"""
+import argparse
+import json
+import os
+import sys
+
+# Add parent directory to path to import from refcocos_annotator
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+from refcocos_annotator.config import HISTORY_DIR, OUTPUT_FILE
+from refcocos_annotator.services import history_service
+from refcocos_annotator.utils.file_utils import iter_json_array
+
+
+def parse_args():
+    """Parse command-line arguments"""
+    parser = argparse.ArgumentParser(description='Snapshot and diff the annotation set')
+    parser.add_argument('--history-dir', type=str, default=HISTORY_DIR,
+                        help=f'History directory (default: {HISTORY_DIR})')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    snapshot = commands.add_parser('snapshot', help='Store a snapshot of the annotation file')
+    snapshot.add_argument('--output-file', type=str, default=OUTPUT_FILE,
+                          help=f'Annotation file to snapshot (default: {OUTPUT_FILE})')
+    snapshot.add_argument('--name', type=str, default=None, help='Snapshot name (default: current time)')
+
+    commands.add_parser('list', help='List snapshots')
+
+    diff = commands.add_parser('diff', help='Show what changed between two snapshots')
+    diff.add_argument('old', type=str, help='Earlier snapshot')
+    diff.add_argument('new', type=str, nargs='?', default='latest', help='Later snapshot (default: latest)')
+    diff.add_argument('--json', type=str, default=None, help='Also write the diff to this JSON file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.command == 'snapshot':
+        print(f"Reading output file: {args.output_file}")
+        ref = history_service.create_snapshot(args.history_dir, iter_json_array(args.output_file, key="annotations"),
+                                              args.name, source=os.path.abspath(args.output_file))
+        print(f"Snapshot {ref['name']}: {ref['count']} annotations (root {ref['root'][:12]})")
+
+    elif args.command == 'list':
+        for ref in history_service.list_snapshots(args.history_dir):
+            print(f"{ref['name']:<30} {ref['created_at']}  {ref['count']:>8} annotations  {ref['source'] or ''}")
+
+    elif args.command == 'diff':
+        try:
+            diff = history_service.diff_snapshots(args.history_dir, args.old, args.new)
+        except KeyError as e:
+            sys.exit(e.args[0])
+        except ValueError as e:
+            sys.exit(str(e))
+        print(f"{diff['from']} -> {diff['to']}: {len(diff['added'])} added, {len(diff['removed'])} removed, "
+              f"{len(diff['modified'])} modified ({diff['leaves_compared']} leaves compared)")
+        for record in diff['added']:
+            print(f"  + [{record.get('annotation_id')}] {record.get('image')}: {record.get('normal_caption')}")
+        for record in diff['removed']:
+            print(f"  - [{record.get('annotation_id')}] {record.get('image')}: {record.get('normal_caption')}")
+        for change in diff['modified']:
+            print(f"  ~ [{change['annotation_id']}] {change['image']}")
+            for field, (old, new) in change['changes'].items():
+                print(f"      {field}: {json.dumps(old)} -> {json.dumps(new)}")
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(diff, f, indent=2)
+            print(f"\nDiff saved to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Script to fill in or check the distractor counts of all annotations.
+
+The expected count of every annotation is derived from the instances of its
+image in one vectorized pass (see ``distractor_service``). By default only
+missing counts are filled in; ``--overwrite`` also corrects counts that
+disagree, and ``--check`` only reports. Annotations whose drawn box matches
+no instance are left alone.
+
+With ANNOTATOR_SHARD_DIR set, run ``merge_shards.py`` first: only the output
+file is rewritten. With RANGE_SHARD_DIR set, the range shards are read and
+rewritten instead of the output file.
+"""
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+
+# Add parent directory to path to import from refcocos_annotator
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+from refcocos_annotator.config import MULTIPLE_INSTANCES_FILE, OUTPUT_FILE, RANGE_SHARD_DIR, RANGE_SHARD_SIZE
+from refcocos_annotator.services import migration_service
+from refcocos_annotator.services.range_shard_service import RangeStore
+from refcocos_annotator.services.distractor_service import DEFAULT_IOU_THRESHOLD, UNSET_VALUES, expected_distractors
+from refcocos_annotator.utils.file_utils import atomic_writer, iter_json_array, write_json_array
+
+# Number of example changes to show in the summary
+MAX_EXAMPLES = 10
+
+
+def parse_args():
+    """Parse command-line arguments"""
+    parser = argparse.ArgumentParser(description='Fill in or check distractor counts of all annotations')
+    parser.add_argument('--output-file', type=str, default=OUTPUT_FILE,
+                        help=f'Annotation file to update (default: {OUTPUT_FILE})')
+    parser.add_argument('--range-dir', type=str, default=RANGE_SHARD_DIR,
+                        help=f'Update the range shards in this directory instead of the output file '
+                             f'(default: {RANGE_SHARD_DIR or "off"})')
+    parser.add_argument('--instances-file', type=str, default=MULTIPLE_INSTANCES_FILE,
+                        help=f'Multiple instances file (default: {MULTIPLE_INSTANCES_FILE})')
+    parser.add_argument('--iou', type=float, default=DEFAULT_IOU_THRESHOLD,
+                        help=f'Minimum IoU for a drawn box to count as an instance (default: {DEFAULT_IOU_THRESHOLD})')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Also replace counts that differ from the derived ones')
+    parser.add_argument('--check', action='store_true',
+                        help='Only report missing and differing counts; exit with status 1 if there are any')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Report what would change without writing the output file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    print(f"Reading multiple instances file: {args.instances_file}")
+    images = list(iter_json_array(args.instances_file, key="images"))
+    image_path_to_index = {}
+    for i, img in enumerate(images):
+        image_path_to_index.setdefault("val2017/" + img["file_name"], i)
+
+    store = RangeStore(args.range_dir, RANGE_SHARD_SIZE) if args.range_dir else None
+    if store is not None:
+        if not store.exists():
+            sys.exit(f"{args.range_dir} holds no range shards")
+        print(f"Reading range shards: {args.range_dir}")
+        version, annotations = store.load()
+    else:
+        print(f"Reading output file: {args.output_file}")
+        header = {}
+        annotations = list(iter_json_array(args.output_file, key="annotations", header=header))
+        # A flat list or a header without a version is schema 0, as in split_output
+        version = header.get("schema_version", 0)
+    if migration_service.needs_migration(version):
+        migrated = migration_service.migrate_records(annotations, version, image_path_to_index)
+        print(f"Migrated {migrated} annotations from schema version {version}")
+
+    start = time.perf_counter()
+    expected = expected_distractors(annotations, images, image_path_to_index, args.iou)
+    print(f"Derived distractor counts for {len(annotations)} annotations in {time.perf_counter() - start:.2f}s")
+
+    summary = Counter()
+    examples = []
+    for annotation, count in zip(annotations, expected.tolist()):
+        # Only records whose count is written get a categories dict
+        current = annotation.get("categories", {}).get("distractors")
+        if count < 0:
+            summary["underivable"] += 1
+            continue
+        if current in UNSET_VALUES:
+            change = "missing"
+        elif str(current) != str(count):
+            change = "differing"
+        else:
+            summary["consistent"] += 1
+            continue
+
+        summary[change] += 1
+        if len(examples) < MAX_EXAMPLES:
+            examples.append(f"{annotation.get('annotation_id', '?')}: {current!r} -> {count} ({change})")
+        if not args.check and (change == "missing" or args.overwrite):
+            annotation.setdefault("categories", {})["distractors"] = str(count)
+            summary["updated"] += 1
+
+    for key in ("consistent", "missing", "differing", "underivable"):
+        print(f"  {key}: {summary[key]}")
+    if examples:
+        print("Examples:")
+        for example in examples:
+            print(f"  {example}")
+
+    if args.check:
+        sys.exit(1 if summary["missing"] or summary["differing"] else 0)
+
+    if summary["differing"]:
+        if args.overwrite:
+            # These may have been corrected by hand
+            print(f"{'Would replace' if args.dry_run else 'Replacing'} {summary['differing']} existing counts "
+                  f"that differ from the derived ones")
+        else:
+            print(f"Kept {summary['differing']} existing counts that differ; pass --overwrite to replace them")
+
+    if args.dry_run or not summary["updated"]:
+        print(f"{summary['updated']} counts would be updated" if args.dry_run else "Nothing to update")
+        return
+
+    if store is not None:
+        store.write_all(annotations)
+        print(f"Updated {summary['updated']} counts in {args.range_dir}")
+        return
+    with atomic_writer(args.output_file) as f:
+        write_json_array(f, annotations, key="annotations",
+                         header={"schema_version": migration_service.SCHEMA_VERSION})
+    print(f"Updated {summary['updated']} counts in {args.output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Script to build or refresh the manifest of an image directory.
+
+Every image is read once by a pool of threads to record its size, mtime,
+content hash and real dimensions (see ``image_manifest_service``). When the
+manifest already exists, only images whose size or mtime changed are read
+again, so re-running after adding images is cheap. ``--check`` compares the
+real dimensions with those in the multiple instances file.
+"""
+import argparse
+import os
+import sys
+import time
+
+# Add parent directory to path to import from refcocos_annotator
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+from refcocos_annotator.config import IMAGE_MANIFEST_FILE, MULTIPLE_INSTANCES_FILE
+from refcocos_annotator.services import image_manifest_service
+from refcocos_annotator.utils.file_utils import iter_json_array
+
+# Number of mismatches to show in the summary
+MAX_EXAMPLES = 10
+
+
+def parse_args():
+    """Parse command-line arguments"""
+    parser = argparse.ArgumentParser(description='Build the manifest of an image directory')
+    parser.add_argument('--img-dir', type=str, default='val2017',
+                        help='Image directory (default: val2017)')
+    parser.add_argument('--manifest-file', type=str, default=IMAGE_MANIFEST_FILE,
+                        help=f'Manifest to write (default: {IMAGE_MANIFEST_FILE})')
+    parser.add_argument('--full', action='store_true',
+                        help='Read every image again, even if its size and mtime did not change')
+    parser.add_argument('--check', action='store_true',
+                        help='Report images of the multiple instances file that are missing or have other dimensions')
+    parser.add_argument('--instances-file', type=str, default=MULTIPLE_INSTANCES_FILE,
+                        help=f'Multiple instances file for --check (default: {MULTIPLE_INSTANCES_FILE})')
+    parser.add_argument('-j', '--workers', type=int, default=image_manifest_service.DEFAULT_WORKERS,
+                        help=f'Number of threads (default: {image_manifest_service.DEFAULT_WORKERS})')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not os.path.isdir(args.img_dir):
+        sys.exit(f"Image directory {args.img_dir} not found")
+
+    previous = None if args.full else image_manifest_service.read_manifest(args.manifest_file)
+    if previous is not None and previous["image_dir"] != os.path.abspath(args.img_dir):
+        previous = None
+
+    start = time.perf_counter()
+    manifest, scanned = image_manifest_service.build_manifest(args.img_dir, previous, args.workers)
+    elapsed = time.perf_counter() - start
+    image_manifest_service.write_manifest(args.manifest_file, manifest)
+    unreadable = sum(1 for info in manifest["images"].values() if info[3] is None)
+    print(f"Wrote {args.manifest_file}: {len(manifest['images'])} images, {scanned} read "
+          f"in {elapsed:.2f}s, {unreadable} unreadable")
+
+    if args.check:
+        problems = []
+        for image in iter_json_array(args.instances_file, key="images"):
+            info = image_manifest_service.entry(manifest, image["path"])
+            if info is None:
+                problems.append(f"{image['path']}: not in the manifest")
+            elif (info["width"], info["height"]) != (image["width"], image["height"]):
+                problems.append(f"{image['path']}: {image['width']}x{image['height']} in the instances file, "
+                                f"{info['width']}x{info['height']} on disk")
+        print(f"{len(problems)} images missing or with other dimensions")
+        for problem in problems[:MAX_EXAMPLES]:
+            print(f"  {problem}")
+        sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""File helpers for streaming and atomically writing annotation files."""
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import Any, Dict, IO, Iterable, Iterator, Optional
+
+_WHITESPACE = " \t\n\r"
+
+
+class _StreamReader:
+    """Incrementally decode JSON values from a file, keeping only a window in memory."""
+
+    def __init__(self, f: IO[str], chunk_size: int):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self, skip: str = _WHITESPACE) -> str:
+        """Skip characters in ``skip`` and return the next character ('' at EOF)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in skip:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError(f"Expected '{char}' in {self.f.name}")
+        self.pos += 1
+
+    def value(self) -> Any:
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof or not self.fill():
+                    raise
+                continue
+
+            # A scalar that ends exactly at the buffer edge may be truncated
+            if end == len(self.buf) and not self.eof and self.fill():
+                continue
+
+            self.pos = end
+            return obj
+
+    def array(self) -> Iterator[Any]:
+        """Yield the elements of the array starting at the current position."""
+        self.expect("[")
+        while True:
+            char = self.peek(_WHITESPACE + ",")
+            if char == "]":
+                self.pos += 1
+                return
+            if not char:
+                raise ValueError(f"Unexpected end of file in {self.f.name}")
+            yield self.value()
+
+
+def iter_json_array(path: str, key: Optional[str] = None, header: Optional[Dict[str, Any]] = None,
+                    chunk_size: int = 1 << 16) -> Iterator[Any]:
+    """Yield the elements of a JSON array one at a time.
+
+    Only a window of the file is kept in memory, so arbitrarily large
+    annotation files can be processed without a full ``json.load``. The
+    array may be the top-level value or, when ``key`` is given, a member of
+    a top-level object; other members that precede it are stored in ``header``.
+
+    Args:
+        path: Path to the JSON file
+        key: Name of the array member if the top-level value is an object
+        header: Dict receiving the object members that precede the array
+        chunk_size: Number of characters to read per chunk
+
+    Yields:
+        Each decoded array element in file order
+    """
+    with open(path, "r") as f:
+        reader = _StreamReader(f, chunk_size)
+        first = reader.peek()
+
+        if first == "[":
+            yield from reader.array()
+            return
+        if first != "{" or key is None:
+            raise ValueError(f"{path} does not contain a JSON array")
+
+        reader.expect("{")
+        while reader.peek(_WHITESPACE + ",") == '"':
+            name = reader.value()
+            reader.expect(":")
+            if name == key:
+                yield from reader.array()
+                return
+            value = reader.value()
+            if header is not None:
+                header[name] = value
+        raise ValueError(f"{path} has no '{key}' array")
+
+
+def write_json_array(f: IO[str], items: Iterable[Any], key: Optional[str] = None,
+                     header: Optional[Dict[str, Any]] = None) -> int:
+    """Write items as a JSON array, producing the same layout as ``json.dump(indent=2)``.
+
+    When ``key`` is given the array is written as the last member of a
+    top-level object whose other members come from ``header``.
+
+    Args:
+        f: Open text file to write to
+        items: Iterable of JSON-serialisable items
+        key: Name of the array member, or None for a top-level array
+        header: Object members written before the array
+
+    Returns:
+        int: Number of items written
+    """
+    indent = "\n  "
+    if key is not None:
+        f.write("{")
+        for name, value in (header or {}).items():
+            encoded = json.dumps(value, indent=2).replace("\n", indent)
+            f.write(f"\n  {json.dumps(name)}: {encoded},")
+        f.write(f"\n  {json.dumps(key)}: ")
+        indent = "\n    "
+
+    count = 0
+    for item in items:
+        f.write("[" + indent if count == 0 else "," + indent)
+        f.write(json.dumps(item, indent=2).replace("\n", indent))
+        count += 1
+    f.write(indent[:-2] + "]" if count else "[]")
+
+    if key is not None:
+        f.write("\n}")
+    return count
+
+
+@contextmanager
+def atomic_writer(path: str, mode: str = "w") -> Iterator[IO]:
+    """Open a temporary file next to ``path`` and move it into place on success.
+
+    Readers never observe a partially written file: the temporary file is
+    flushed, fsynced and then renamed over ``path``. On error it is removed
+    and the original file is left untouched.
+
+    Args:
+        path: Final destination of the file
+        mode: "w" for a text file or "wb" for a binary one
+
+    Yields:
+        A writable file handle
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+    try:
+        # mkstemp creates files as 0600; keep the permissions of the file we replace
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_write_json(path: str, data: Any, indent: int = 2) -> None:
+    """Atomically replace ``path`` with the JSON encoding of ``data``.
+
+    Args:
+        path: Destination file path
+        data: JSON-serialisable data
+        indent: Indentation passed to ``json.dump``
+    """
+    with atomic_writer(path) as f:
+        json.dump(data, f, indent=indent)
+
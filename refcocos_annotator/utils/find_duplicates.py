@@ -0,0 +1,53 @@
+"""Script to find clusters of near-duplicate captions in an annotation file."""
+import argparse
+import json
+import os
+import sys
+
+# Add parent directory to path to import from refcocos_annotator
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+from refcocos_annotator.config import OUTPUT_FILE
+from refcocos_annotator.services.dedup_service import DEFAULT_THRESHOLD, CaptionIndex
+from refcocos_annotator.utils.file_utils import iter_json_array
+
+
+def parse_args():
+    """Parse command-line arguments"""
+    parser = argparse.ArgumentParser(description='Find near-duplicate captions using MinHash/LSH')
+    parser.add_argument('--output-file', type=str, default=OUTPUT_FILE,
+                        help=f'Annotation file to scan (default: {OUTPUT_FILE})')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f'Minimum Jaccard similarity of caption shingles (default: {DEFAULT_THRESHOLD})')
+    parser.add_argument('--same-image', action='store_true',
+                        help='Only report duplicates on the same image')
+    parser.add_argument('--json', type=str, default=None,
+                        help='Also write the clusters to this JSON file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    print(f"Reading output file: {args.output_file}")
+    index = CaptionIndex()
+    count = 0
+    for annotation in iter_json_array(args.output_file, key="annotations"):
+        index.add(annotation)
+        count += 1
+
+    clusters = index.clusters(args.threshold, args.same_image)
+    print(f"Found {len(clusters)} duplicate clusters among {count} annotations")
+    for i, cluster in enumerate(clusters, start=1):
+        print(f"\n{i}. {len(cluster)} annotations")
+        for member in cluster:
+            print(f"   [{member['annotation_id']}] {member['image']}: {member['normal_caption']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(clusters, f, indent=2)
+        print(f"\nClusters saved to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Script to fold per-annotator output shards back into the output file.
+
+Each shard in ``ANNOTATOR_SHARD_DIR`` is first renamed to ``*.jsonl.merging``
+so annotators keep appending to fresh shards while the merge runs; the
+server replays both kinds of files, so no operation is ever invisible. The
+merged annotations are written atomically to the output file and the merged
+shards are removed afterwards; an append that still reached a renamed shard
+after it was read is merged before the shard is removed. Run it when annotators are idle or on a
+schedule; until then the server merges the shards lazily in memory.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from typing import Any, Dict, List
+
+# Add parent directory to path to import from refcocos_annotator
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+from refcocos_annotator.config import ANNOTATOR_SHARD_DIR, MULTIPLE_INSTANCES_FILE, OUTPUT_FILE
+from refcocos_annotator.services import migration_service, shard_service
+from refcocos_annotator.utils.file_utils import atomic_write_json
+from refcocos_annotator.utils.update_annotations import build_image_path_index
+
+
+def merge_shards(shard_dir: str, output_file: str, instances_file: str,
+                 archive_dir: str = None, dry_run: bool = False) -> int:
+    """Merge all shards in ``shard_dir`` into ``output_file``.
+
+    Args:
+        shard_dir: Directory with the annotator shards
+        output_file: Merged annotation file to update
+        instances_file: Multiple instances file, used to migrate an old output file
+        archive_dir: Move merged shards here instead of deleting them
+        dry_run: Report what would be merged without touching any file
+
+    Returns:
+        int: Number of operations merged
+    """
+    if not dry_run:
+        # Hand the current shards over to the merge; new writes start new files
+        for path in shard_service.list_shards(shard_dir, include_merging=False):
+            os.replace(path, path + shard_service.MERGING_SUFFIX)
+
+    paths = [p for p in shard_service.list_shards(shard_dir)
+             if dry_run or p.endswith(shard_service.MERGING_SUFFIX)]
+    if not paths:
+        print("No shards to merge")
+        return 0
+    if not dry_run:
+        # Appends started before the rename end up in the renamed shards
+        for path in paths:
+            shard_service.wait_for_writers(path)
+
+    version, records = 0, []
+    if os.path.exists(output_file):
+        with open(output_file, "r") as f:
+            version, records = migration_service.split_output(json.load(f))
+    if migration_service.needs_migration(version):
+        migration_service.migrate_records(records, version, build_image_path_index(instances_file))
+
+    ops, offsets = shard_service.read_all_operations(paths)
+    changes = shard_service.apply_operations(records, ops)
+    saves = sum(1 for event, _, _ in changes if event == "save")
+    print(f"Merging {len(ops)} operations from {len(paths)} shards: "
+          f"{saves} saves, {len(changes) - saves} deletes, {len(records)} annotations in total")
+
+    if dry_run:
+        print("Dry run: output file not written")
+        return len(ops)
+
+    atomic_write_json(output_file, migration_service.wrap_output(records))
+    print(f"Wrote {output_file}")
+
+    late = _merge_late_operations(paths, offsets, records, output_file)
+    for path in paths:
+        if archive_dir:
+            os.makedirs(archive_dir, exist_ok=True)
+            shutil.move(path, os.path.join(archive_dir, os.path.basename(path)))
+        else:
+            os.remove(path)
+    return len(ops) + late
+
+
+def _merge_late_operations(paths: List[str], offsets: Dict[str, int], records: List[Dict[str, Any]],
+                           output_file: str) -> int:
+    """Merge operations appended to the renamed shards after they were read.
+
+    Only happens where writers cannot lock the shards; rewrites the output
+    file until every shard ends where it was last read.
+
+    Returns:
+        int: Number of operations merged
+    """
+    merged = 0
+    while True:
+        late_ops, growing = [], False
+        for path in paths:
+            new_ops, offsets[path] = shard_service.read_operations(path, offsets[path])
+            late_ops.extend(new_ops)
+            growing = growing or os.path.getsize(path) > offsets[path]
+        if late_ops:
+            # Stable sort keeps the order within a shard
+            late_ops.sort(key=lambda op: op.get("ts", 0))
+            shard_service.apply_operations(records, late_ops)
+            atomic_write_json(output_file, migration_service.wrap_output(records))
+            print(f"Merged {len(late_ops)} operations written during the merge")
+            merged += len(late_ops)
+        elif growing:
+            # A line is still being written
+            time.sleep(0.01)
+        else:
+            return merged
+
+
+def parse_args():
+    """Parse command-line arguments"""
+    parser = argparse.ArgumentParser(description='Merge per-annotator shards into the output file')
+    parser.add_argument('--shard-dir', type=str, default=ANNOTATOR_SHARD_DIR,
+                        help=f'Shard directory (default: {ANNOTATOR_SHARD_DIR})')
+    parser.add_argument('--output-file', type=str, default=OUTPUT_FILE,
+                        help=f'Annotation file to update (default: {OUTPUT_FILE})')
+    parser.add_argument('--instances-file', type=str, default=MULTIPLE_INSTANCES_FILE,
+                        help=f'Multiple instances file (default: {MULTIPLE_INSTANCES_FILE})')
+    parser.add_argument('--archive-dir', type=str, default=None,
+                        help='Keep merged shards in this directory instead of deleting them')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Report what would be merged without writing anything')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.shard_dir:
+        sys.exit("No shard directory: set ANNOTATOR_SHARD_DIR or pass --shard-dir")
+    merge_shards(args.shard_dir, args.output_file, args.instances_file, args.archive_dir, args.dry_run)
@@ -0,0 +1,84 @@
+"""Script to convert between the single output file and range shards.
+
+    range_shards.py split [--output-file results/refcocos_test.json]
+    range_shards.py export [--output-file results/refcocos_export.json]
+
+``split`` partitions an output file into a range shard directory (see
+``range_shard_service``); the server also does this on first start when the
+directory has no manifest yet. ``export`` writes all shards back into one
+file in the output file layout, for tools that read a single file such as
+``convert_to_hf.py``. Run ``export`` when annotators are idle, or accept that
+saves made while it reads the shards may be missing from the export.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+# Add parent directory to path to import from refcocos_annotator
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+from refcocos_annotator.config import MULTIPLE_INSTANCES_FILE, OUTPUT_FILE, RANGE_SHARD_DIR, RANGE_SHARD_SIZE
+from refcocos_annotator.services import migration_service
+from refcocos_annotator.services.range_shard_service import RangeStore
+from refcocos_annotator.utils.file_utils import atomic_writer, write_json_array
+from refcocos_annotator.utils.update_annotations import build_image_path_index
+
+
+def parse_args():
+    """Parse command-line arguments"""
+    parser = argparse.ArgumentParser(description='Convert between the output file and range shards')
+    parser.add_argument('--range-dir', type=str, default=RANGE_SHARD_DIR,
+                        help=f'Range shard directory (default: {RANGE_SHARD_DIR})')
+    parser.add_argument('--instances-file', type=str, default=MULTIPLE_INSTANCES_FILE,
+                        help=f'Multiple instances file, used to migrate old records (default: {MULTIPLE_INSTANCES_FILE})')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    split = commands.add_parser('split', help='Partition an output file into range shards')
+    split.add_argument('--output-file', type=str, default=OUTPUT_FILE,
+                       help=f'Annotation file to split (default: {OUTPUT_FILE})')
+    split.add_argument('--shard-size', type=int, default=RANGE_SHARD_SIZE,
+                       help=f'Images per shard (default: {RANGE_SHARD_SIZE})')
+    split.add_argument('--force', action='store_true',
+                       help='Replace an existing range shard store')
+
+    export = commands.add_parser('export', help='Write all range shards into a single output file')
+    export.add_argument('--output-file', type=str, default=OUTPUT_FILE,
+                        help=f'Annotation file to write (default: {OUTPUT_FILE})')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not args.range_dir:
+        sys.exit("No range shard directory: set RANGE_SHARD_DIR or pass --range-dir")
+
+    if args.command == 'split':
+        store = RangeStore(args.range_dir, args.shard_size)
+        if store.exists() and not args.force:
+            sys.exit(f"{args.range_dir} already holds range shards; pass --force to replace them")
+        print(f"Reading output file: {args.output_file}")
+        with open(args.output_file, "r") as f:
+            version, records = migration_service.split_output(json.load(f))
+        if migration_service.needs_migration(version):
+            migration_service.migrate_records(records, version, build_image_path_index(args.instances_file))
+        count = store.write_all(records)
+        print(f"Wrote {len(records)} annotations to {count} shards of {args.shard_size} images in {args.range_dir}")
+
+    elif args.command == 'export':
+        store = RangeStore(args.range_dir, RANGE_SHARD_SIZE)
+        if not store.exists():
+            sys.exit(f"{args.range_dir} holds no range shards")
+        start = time.perf_counter()
+        version, records = store.load()
+        if migration_service.needs_migration(version):
+            migration_service.migrate_records(records, version, build_image_path_index(args.instances_file))
+        with atomic_writer(args.output_file) as f:
+            write_json_array(f, records, key="annotations",
+                             header={"schema_version": migration_service.SCHEMA_VERSION})
+        print(f"Exported {len(records)} annotations to {args.output_file} in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
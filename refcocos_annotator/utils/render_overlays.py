@@ -0,0 +1,100 @@
+"""Script to render review overlays and contact sheets for saved annotations.
+
+Every selected annotation is rendered onto its image together with the COCO
+instance boxes, in parallel worker processes. Overlays land in the same cache
+the server uses, so a QA pass started from the CLI also warms
+``/api/overlay`` and ``/api/contact_sheet``. With ``--contact-sheets`` the
+overlays are additionally tiled into numbered sheets for fast browsing.
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs
+
+# Add parent directory to path to import from refcocos_annotator
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+from refcocos_annotator.config import MULTIPLE_INSTANCES_FILE, OUTPUT_FILE, OVERLAY_CACHE_DIR
+from refcocos_annotator.services import data_service, overlay_service, query_service
+
+
+def _render(task):
+    cache_dir, image_data, annotation, max_size = task
+    try:
+        return overlay_service.get_overlay(cache_dir, image_data, [annotation], max_size)
+    except OSError as e:
+        print(f"Warning: Failed to render {annotation.get('annotation_id')}: {e}")
+        return None, False
+
+
+def parse_args():
+    """Parse command-line arguments"""
+    parser = argparse.ArgumentParser(description='Render annotation overlays and contact sheets')
+    parser.add_argument('--output-file', type=str, default=OUTPUT_FILE,
+                        help=f'Annotation file (default: {OUTPUT_FILE})')
+    parser.add_argument('--instances-file', type=str, default=MULTIPLE_INSTANCES_FILE,
+                        help=f'Multiple instances file (default: {MULTIPLE_INSTANCES_FILE})')
+    parser.add_argument('--cache-dir', type=str, default=OVERLAY_CACHE_DIR,
+                        help=f'Overlay cache directory (default: {OVERLAY_CACHE_DIR})')
+    parser.add_argument('--query', type=str, default='',
+                        help='Filters in /api/query syntax, e.g. "hops=3&type=exclude" (default: all)')
+    parser.add_argument('--max-size', type=int, default=overlay_service.DEFAULT_TILE_SIZE,
+                        help=f'Longest side of each overlay, 0 for full size '
+                             f'(default: {overlay_service.DEFAULT_TILE_SIZE})')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of rendering processes (default: CPU count)')
+    parser.add_argument('--contact-sheets', type=str, default=None,
+                        help='Also write contact sheets to this directory')
+    parser.add_argument('--per-sheet', type=int, default=48,
+                        help='Overlays per contact sheet (default: 48)')
+    parser.add_argument('--columns', type=int, default=overlay_service.DEFAULT_COLUMNS,
+                        help=f'Tiles per contact sheet row (default: {overlay_service.DEFAULT_COLUMNS})')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    data_service.MULTIPLE_INSTANCES_FILE = args.instances_file
+    data_service.OUTPUT_FILE = args.output_file
+    success, message = data_service.load_data()
+    print(message)
+    if not success:
+        sys.exit(1)
+
+    query = parse_qs(args.query, keep_blank_values=True)
+    try:
+        filters, sort, offset, _ = query_service.parse_query_args(query)
+        annotations = query_service.annotation_index.query(filters, sort, offset, limit=len(data_service.output_data))
+    except query_service.QueryError as e:
+        sys.exit(str(e))
+    annotations = annotations["annotations"]
+
+    max_size = args.max_size or None
+    tasks = []
+    for annotation in annotations:
+        image_data = overlay_service.image_for_annotation(annotation)
+        if image_data is not None:
+            tasks.append((args.cache_dir, image_data, annotation, max_size))
+    print(f"Rendering {len(tasks)} of {len(annotations)} matching annotations")
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(_render, tasks, chunksize=16))
+
+    paths = [path for path, _ in results if path is not None]
+    rendered = sum(1 for _, fresh in results if fresh)
+    print(f"Overlays in {args.cache_dir}: {rendered} rendered, {len(paths) - rendered} reused from cache")
+
+    if args.contact_sheets:
+        os.makedirs(args.contact_sheets, exist_ok=True)
+        tile_size = max_size or overlay_service.DEFAULT_TILE_SIZE
+        for number, start in enumerate(range(0, len(paths), args.per_sheet), start=1):
+            sheet = overlay_service.contact_sheet(paths[start:start + args.per_sheet], args.columns, tile_size)
+            sheet_path = os.path.join(args.contact_sheets, f"sheet_{number:04d}.jpg")
+            sheet.save(sheet_path, format="JPEG", quality=overlay_service.JPEG_QUALITY)
+        print(f"Wrote {-(-len(paths) // args.per_sheet)} contact sheets to {args.contact_sheets}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,178 +1,190 @@
-"""Script to update existing annotations with image_index attribute."""
+"""Script to update existing annotations with image_index, file_name and annotation_id.
+
+The output file is streamed record by record and written atomically, so the
+migration runs in a single pass and never leaves a half-written file behind.
+Missing fields are filled in by the migrations registered in
+``migration_service``, and the file is rewritten with the current schema
+version. The server applies the same migrations in memory on load, so this
+script is only needed to persist them eagerly or to refresh image_index.
+"""
+import argparse
 import json
 import os
 import sys
-import time
-from typing import Dict, List, Any
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional
 
 # Add parent directory to path to import from refcocos_annotator
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 
 from refcocos_annotator.config import MULTIPLE_INSTANCES_FILE, OUTPUT_FILE
+from refcocos_annotator.services import migration_service
+from refcocos_annotator.utils.file_utils import atomic_writer, iter_json_array, write_json_array
+
+# Number of example changes to show in the dry-run summary
+MAX_EXAMPLES = 10
+
+
+def build_image_path_index(instances_file: str) -> Dict[str, int]:
+    """Create a mapping from image path to its index in the multiple instances file.
+
+    Args:
+        instances_file: Path to the multiple instances JSON file
+
+    Returns:
+        Dict[str, int]: Mapping of "val2017/<file_name>" to image index
+    """
+    with open(instances_file, "r") as f:
+        multiple_instances_data = json.load(f)
+
+    return {
+        "val2017/" + img["file_name"]: i
+        for i, img in enumerate(multiple_instances_data["images"])
+    }
+
+
+def migrate_record(item: Dict[str, Any], image_path_to_index: Dict[str, int],
+                   context: migration_service.MigrationContext, force: bool) -> List[str]:
+    """Update a single annotation record in place.
+
+    Args:
+        item: The annotation record
+        image_path_to_index: Mapping of image path to image index
+        context: Migration state shared across the whole file
+        force: Fill in missing fields for every record, even ones whose image is unknown
+
+    Returns:
+        List[str]: Names of the changes applied to the record
+    """
+    changes = []
+    index = image_path_to_index.get(item.get("image", ""))
+
+    if index is None:
+        changes.append("image_not_found")
+        if not force:
+            context.position += 1
+            return changes
+    elif not force and "image_index" in item and item["image_index"] != index:
+        item["image_index"] = index
+        changes.append("image_index_changed")
+
+    # Registered migrations only fill in missing fields, so running all of
+    # them is safe regardless of the version the record was written with
+    missing = [field for field in ("image_index", "file_name", "annotation_id") if field not in item]
+    migration_service.migrate_record(item, 0, context)
+    changes.extend(f"{field}_added" for field in missing if field in item)
+
+    return changes
+
+
+def _migrate_stream(items: Iterator[Dict[str, Any]], image_path_to_index: Dict[str, int],
+                    force: bool, summary: Counter, examples: List[str]) -> Iterator[Dict[str, Any]]:
+    """Apply ``migrate_record`` to a stream of records, collecting a summary."""
+    context = migration_service.MigrationContext(image_path_to_index)
+    for item in items:
+        position = context.position
+        if "annotation_id" in item:
+            context.used_ids.add(item["annotation_id"])
+
+        changes = migrate_record(item, image_path_to_index, context, force)
+        summary["total"] += 1
+        if any(change != "image_not_found" for change in changes):
+            summary["records_changed"] += 1
+        for change in changes:
+            summary[change] += 1
+        if changes and len(examples) < MAX_EXAMPLES:
+            examples.append(f"Item {position} ({item.get('annotation_id', '?')}): {', '.join(changes)}")
+
+        yield item
+
+
+def run_migration(output_file: str = OUTPUT_FILE, instances_file: str = MULTIPLE_INSTANCES_FILE,
+                  force: bool = False, dry_run: bool = False,
+                  destination: Optional[str] = None) -> Optional[Counter]:
+    """Migrate an annotation file in a single streaming pass.
+
+    Args:
+        output_file: Annotation file to read
+        instances_file: Multiple instances file used to resolve image indices
+        force: Fill in missing fields for every record instead of refreshing image_index
+        dry_run: Only report what would change, without writing anything
+        destination: File to write to (defaults to ``output_file``)
+
+    Returns:
+        Counter: Summary of applied changes, or None on error
+    """
+    print(f"Reading output file: {output_file}")
 
-def update_annotations():
-    """Add image_index attribute to all existing annotations."""
-    print(f"Reading output file: {OUTPUT_FILE}")
-    
-    # Load output data
-    try:
-        with open(OUTPUT_FILE, "r") as f:
-            output_data = json.load(f)
-    except Exception as e:
-        print(f"Error loading output data: {str(e)}")
-        return
-    
-    # Load multiple instances data
     try:
-        with open(MULTIPLE_INSTANCES_FILE, "r") as f:
-            multiple_instances_data = json.load(f)
+        image_path_to_index = build_image_path_index(instances_file)
     except Exception as e:
         print(f"Error loading multiple instances data: {str(e)}")
-        return
-    
-    # Create a mapping from image path to index
-    image_path_to_index = {}
-    for i, img in enumerate(multiple_instances_data["images"]):
-        image_path = "val2017/" + img["file_name"]
-        image_path_to_index[image_path] = i
-    
-    # Update annotations with image_index
-    updated_count = 0
-    annotations_with_id_added = 0
-    
-    for item in output_data:
-        # Get image path
-        image_path = item.get("image", "")
-        
-        # Skip if already has image_index
-        # if "image_index" in item:
-        #     continue
-        
-        # Find the index for this image
-        if image_path in image_path_to_index:
-            item["image_index"] = image_path_to_index[image_path]
-            updated_count += 1
-            
-            # Check for missing annotation_id
-            if "annotation_id" not in item:
-                # Extract file_name from image path if not present
-                if "file_name" not in item and image_path:
-                    img_filename = image_path.split("/")[-1]
-                    item["file_name"] = img_filename
-                    print(f"Added missing file_name: {img_filename}")
-                
-                # Generate annotation_id using file_name or image path
-                if "file_name" in item:
-                    img_id = item["file_name"].split(".")[0]
-                    item["annotation_id"] = f"{img_id}_{int(time.time() * 1000)}"
-                    annotations_with_id_added += 1
-                    print(f"Added missing annotation_id: {item['annotation_id']}")
-                elif image_path:
-                    img_id = image_path.split("/")[-1].split(".")[0]
-                    item["annotation_id"] = f"{img_id}_{int(time.time() * 1000)}"
-                    annotations_with_id_added += 1
-                    print(f"Added missing annotation_id from image path: {item['annotation_id']}")
-                else:
-                    # Fallback to a random ID
-                    item["annotation_id"] = f"unknown_{int(time.time() * 1000)}"
-                    annotations_with_id_added += 1
-                    print(f"Added fallback annotation_id: {item['annotation_id']}")
-        else:
-            print(f"Warning: Could not find index for image {image_path}")
-    
-    # Save updated data back to file
+        return None
+
+    summary = Counter()
+    examples = []
+    header = {}
+    records = _migrate_stream(iter_json_array(output_file, key="annotations", header=header),
+                              image_path_to_index, force, summary, examples)
+
     try:
-        with open(OUTPUT_FILE, "w") as f:
-            json.dump(output_data, f, indent=2)
-        print(f"Successfully updated {updated_count} annotations with image_index")
-        print(f"Added annotation_id to {annotations_with_id_added} annotations")
+        if dry_run:
+            for _ in records:
+                pass
+        else:
+            with atomic_writer(destination or output_file) as f:
+                write_json_array(f, records, key="annotations",
+                                 header={"schema_version": migration_service.SCHEMA_VERSION})
     except Exception as e:
-        print(f"Error saving updated data: {str(e)}")
+        print(f"Error migrating annotations: {str(e)}")
+        return None
+
+    print("Dry run, no changes written" if dry_run else f"Saved annotations to {destination or output_file}")
+    print(f"Schema version: {header.get('schema_version', 0)} -> {migration_service.SCHEMA_VERSION}")
+    print(f"Total items processed: {summary['total']}")
+    print(f"Records changed: {summary['records_changed']}")
+    for change in ("image_index_added", "image_index_changed", "file_name_added",
+                   "annotation_id_added", "image_not_found"):
+        print(f"  {change}: {summary[change]}")
+    if examples:
+        print("Examples:")
+        for example in examples:
+            print(f"  {example}")
+
+    return summary
+
+
+def update_annotations(dry_run: bool = False) -> Optional[Counter]:
+    """Refresh image_index on all annotations and fill in missing IDs."""
+    return run_migration(force=False, dry_run=dry_run)
+
 
-def force_update_annotations():
+def force_update_annotations(dry_run: bool = False) -> Optional[Counter]:
     """Force update all annotations to ensure they have annotation_id, regardless of image_index."""
-    print(f"Reading output file: {OUTPUT_FILE}")
-    
-    # Load output data
-    try:
-        with open(OUTPUT_FILE, "r") as f:
-            output_data = json.load(f)
-    except Exception as e:
-        print(f"Error loading output data: {str(e)}")
-        return
-    
-    # Load multiple instances data
-    try:
-        with open(MULTIPLE_INSTANCES_FILE, "r") as f:
-            multiple_instances_data = json.load(f)
-    except Exception as e:
-        print(f"Error loading multiple instances data: {str(e)}")
-        return
-    
-    # Create a mapping from image path to index
-    image_path_to_index = {}
-    for i, img in enumerate(multiple_instances_data["images"]):
-        image_path = "val2017/" + img["file_name"]
-        image_path_to_index[image_path] = i
-    
-    # Update all annotations regardless of image_index
-    updated_count = 0
-    annotations_with_id_added = 0
-    
-    for i, item in enumerate(output_data):
-        updated = False
-        
-        # Get image path
-        image_path = item.get("image", "")
-        
-        # Add image_index if missing
-        if "image_index" not in item and image_path in image_path_to_index:
-            item["image_index"] = image_path_to_index[image_path]
-            updated = True
-            updated_count += 1
-        
-        # Add file_name if missing but image is present
-        if "file_name" not in item and image_path:
-            img_filename = image_path.split("/")[-1]
-            item["file_name"] = img_filename
-            updated = True
-            print(f"Item {i}: Added missing file_name: {img_filename}")
-        
-        # Always ensure annotation_id is present
-        if "annotation_id" not in item:
-            if "file_name" in item:
-                img_id = item["file_name"].split(".")[0]
-                item["annotation_id"] = f"{img_id}_{int(time.time() * 1000)}"
-            elif image_path:
-                img_id = image_path.split("/")[-1].split(".")[0]
-                item["annotation_id"] = f"{img_id}_{int(time.time() * 1000)}"
-            else:
-                # Fallback to a random ID + position
-                item["annotation_id"] = f"unknown_{i}_{int(time.time() * 1000)}"
-            
-            annotations_with_id_added += 1
-            updated = True
-            print(f"Item {i}: Added missing annotation_id: {item['annotation_id']}")
-        
-        # Add small delay to ensure different timestamps
-        if updated:
-            time.sleep(0.001)
-    
-    # Save updated data back to file
-    try:
-        with open(OUTPUT_FILE, "w") as f:
-            json.dump(output_data, f, indent=2)
-        print(f"Successfully updated {updated_count} annotations with image_index")
-        print(f"Added annotation_id to {annotations_with_id_added} annotations")
-        print(f"Total items processed: {len(output_data)}")
-    except Exception as e:
-        print(f"Error saving updated data: {str(e)}")
+    return run_migration(force=True, dry_run=dry_run)
+
+
+def parse_args():
+    """Parse command-line arguments"""
+    parser = argparse.ArgumentParser(description='Update existing annotations with image_index and annotation_id')
+    parser.add_argument('--force', action='store_true',
+                        help='Fill in missing fields on every annotation instead of refreshing image_index')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Report what would change without writing the output file')
+    parser.add_argument('--output-file', type=str, default=OUTPUT_FILE,
+                        help=f'Annotation file to migrate (default: {OUTPUT_FILE})')
+    parser.add_argument('--instances-file', type=str, default=MULTIPLE_INSTANCES_FILE,
+                        help=f'Multiple instances file (default: {MULTIPLE_INSTANCES_FILE})')
+    parser.add_argument('--destination', type=str, default=None,
+                        help='Write the migrated annotations here instead of replacing the output file')
+    return parser.parse_args()
+
 
 if __name__ == "__main__":
-    # Choose which function to run
-    if len(sys.argv) > 1 and sys.argv[1] == "--force":
+    args = parse_args()
+    if args.force:
         print("Running force update to ensure all annotations have IDs")
-        force_update_annotations()
     else:
         print("Running normal update for annotations missing image_index")
-        update_annotations() 
\ No newline at end of file
+    run_migration(args.output_file, args.instances_file, force=args.force,
+                  dry_run=args.dry_run, destination=args.destination)
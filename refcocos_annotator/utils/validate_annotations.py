@@ -0,0 +1,78 @@
+"""Script to validate every annotation in an output file.
+
+Checks box bounds and shape, normalized coordinates, image size and index,
+and the match with the COCO instance boxes (see ``validation_service``), and
+prints the violations grouped by rule. Exits with status 1 if any rule is
+violated, so it can gate exports and merges.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+# Add parent directory to path to import from refcocos_annotator
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+from refcocos_annotator.config import MULTIPLE_INSTANCES_FILE, OUTPUT_FILE, VALIDATION_IOU_THRESHOLD
+from refcocos_annotator.services.validation_service import (DEFAULT_NORMALIZED_TOLERANCE, RULES, summarize,
+                                                            validate_annotations)
+from refcocos_annotator.utils.file_utils import iter_json_array
+
+
+def parse_args():
+    """Parse command-line arguments"""
+    parser = argparse.ArgumentParser(description='Validate all annotations in an output file')
+    parser.add_argument('--output-file', type=str, default=OUTPUT_FILE,
+                        help=f'Annotation file to validate (default: {OUTPUT_FILE})')
+    parser.add_argument('--instances-file', type=str, default=MULTIPLE_INSTANCES_FILE,
+                        help=f'Multiple instances file (default: {MULTIPLE_INSTANCES_FILE})')
+    parser.add_argument('--iou', type=float, default=VALIDATION_IOU_THRESHOLD,
+                        help=f'Minimum IoU with a COCO instance box (default: {VALIDATION_IOU_THRESHOLD})')
+    parser.add_argument('--normalized-tolerance', type=int, default=DEFAULT_NORMALIZED_TOLERANCE,
+                        help=f'Allowed normalized coordinate difference (default: {DEFAULT_NORMALIZED_TOLERANCE})')
+    parser.add_argument('--ignore', type=str, nargs='+', default=[], choices=list(RULES),
+                        help='Rules not to report, e.g. instance_match for custom boxes')
+    parser.add_argument('--show', type=int, default=10,
+                        help='Violations to print per rule (default: 10)')
+    parser.add_argument('--json', type=str, default=None,
+                        help='Also write the full report to this JSON file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    print(f"Reading multiple instances file: {args.instances_file}")
+    images = list(iter_json_array(args.instances_file, key="images"))
+    image_path_to_index = {}
+    for i, img in enumerate(images):
+        image_path_to_index.setdefault("val2017/" + img["file_name"], i)
+
+    print(f"Reading output file: {args.output_file}")
+    annotations = iter_json_array(args.output_file, key="annotations")
+
+    start = time.perf_counter()
+    report = validate_annotations(annotations, images, image_path_to_index, args.iou, args.normalized_tolerance)
+    for rule in args.ignore:
+        report["violations"].pop(rule, None)
+    print(f"{summarize(report)} ({time.perf_counter() - start:.2f}s)")
+
+    for rule, rows in report["violations"].items():
+        print(f"\n{rule}: {len(rows)} ({RULES[rule]})")
+        for row in rows[:args.show]:
+            detail = f" {json.dumps(row['detail'])}" if row["detail"] is not None else ""
+            print(f"   [{row['annotation_id']}] {row['image']}{detail}")
+        if len(rows) > args.show:
+            print(f"   ... and {len(rows) - args.show} more")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport saved to {args.json}")
+
+    sys.exit(1 if report["violations"] else 0)
+
+
+if __name__ == "__main__":
+    main()
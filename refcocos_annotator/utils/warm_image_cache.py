@@ -0,0 +1,86 @@
+"""Script to pre-generate the image transcode cache.
+
+Every image in the multiple instances file is transcoded to each requested
+format (and optionally size) in parallel worker processes, so that
+``/api/image_file`` serves every image from the cache from the first
+request on. Already cached transcodes are skipped, so the script can be
+re-run after new images are added.
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+# Add parent directory to path to import from refcocos_annotator
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+from refcocos_annotator.config import IMAGE_CACHE_DIR, IMAGE_MANIFEST_FILE, MULTIPLE_INSTANCES_FILE
+from refcocos_annotator.services.image_service import IMAGE_FORMATS, WEBP_SUPPORTED, transcode_image
+from refcocos_annotator.utils.file_utils import iter_json_array
+
+
+def _transcode(task):
+    cache_dir, image_path, fmt, max_width, max_height, quality, manifest_file = task
+    try:
+        path, _, created = transcode_image(cache_dir, image_path, fmt, max_width, max_height, quality, manifest_file)
+        return created, os.path.getsize(path), None
+    except OSError as e:
+        return False, 0, f"{image_path}: {e}"
+
+
+def parse_args():
+    """Parse command-line arguments"""
+    parser = argparse.ArgumentParser(description='Pre-generate WebP/JPEG transcodes of all images')
+    parser.add_argument('--instances-file', type=str, default=MULTIPLE_INSTANCES_FILE,
+                        help=f'Multiple instances file (default: {MULTIPLE_INSTANCES_FILE})')
+    parser.add_argument('--cache-dir', type=str, default=IMAGE_CACHE_DIR,
+                        help=f'Transcode cache directory (default: {IMAGE_CACHE_DIR})')
+    parser.add_argument('--formats', type=str, nargs='+', default=['webp', 'jpeg'],
+                        choices=[fmt.lower() for fmt in IMAGE_FORMATS],
+                        help='Formats to generate (default: webp jpeg)')
+    parser.add_argument('--max-width', type=int, default=None,
+                        help='Width the annotators request, if images are downscaled')
+    parser.add_argument('--max-height', type=int, default=None,
+                        help='Height the annotators request, if images are downscaled')
+    parser.add_argument('--quality', type=int, default=None,
+                        help='Encoder quality (default: per-format default)')
+    parser.add_argument('--manifest-file', type=str, default=IMAGE_MANIFEST_FILE,
+                        help=f'Image manifest; cache keys use its content hashes (default: {IMAGE_MANIFEST_FILE})')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes (default: CPU count)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    formats = [fmt.upper() for fmt in args.formats]
+    if "WEBP" in formats and not WEBP_SUPPORTED:
+        print("Warning: This Pillow build cannot write WebP; skipping it")
+        formats.remove("WEBP")
+
+    tasks = [
+        (args.cache_dir, image["path"], fmt, args.max_width, args.max_height, args.quality, args.manifest_file)
+        for image in iter_json_array(args.instances_file, key="images")
+        for fmt in formats
+    ]
+    print(f"Transcoding {len(tasks)} images ({', '.join(formats)}) into {args.cache_dir}")
+
+    created = failures = 0
+    sizes = {fmt: 0 for fmt in formats}
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for task, (was_created, size, error) in zip(tasks, pool.map(_transcode, tasks, chunksize=32)):
+            if error:
+                failures += 1
+                print(f"Warning: {error}")
+                continue
+            created += was_created
+            sizes[task[2]] += size
+
+    print(f"Done: {created} transcoded, {len(tasks) - created - failures} already cached, {failures} failed")
+    for fmt, size in sizes.items():
+        print(f"  {fmt}: {size / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()